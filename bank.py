@@ -0,0 +1,511 @@
+import base64
+import hashlib
+import json
+import os
+import random
+import logging
+import sqlite3
+import sys
+import threading
+import time
+from array import array
+from contextlib import closing
+
+logger = logging.getLogger(__name__)
+
+# _______________loading and indexing the questions DB___________________
+
+DB_PATH = os.getcwd() + '/DATA/DB.xlsx'
+COMPILED_DB_PATH = os.getcwd() + '/DATA/DB.sqlite'
+OPTIMIZED_DIR = 'DATA/OPTIMIZED'  # relative, like the question_dir of the math questions
+IMAGES_MANIFEST_PATH = OPTIMIZED_DIR + '/manifest.json'
+
+# (sheet name, columns) of every sheet in the DB, the columns are kept in this order in the compiled DB
+ENG_BUILT_SHEET = ('engBuiltQuestions',
+                   ('question', 'answer1', 'answer2', 'answer3', 'answer4', 'correct_answer', 'type', 'unit'))
+VOC_SHEET = ('wordVoc', ('english', 'hebrew', 'unit'))
+MATH_BUILT_SHEET = ('mathBuiltQuestions', ('question', 'question_dir', 'correct_answer', 'type'))
+SHEETS = (ENG_BUILT_SHEET, VOC_SHEET, MATH_BUILT_SHEET)
+NUMERIC_COLUMNS = ('correct_answer', 'unit')
+
+# the pools the bot draws from, each needs enough questions for the largest draw of MAX_DRAW questions
+ENG_BUILT_TYPES = ('eng_com', 'eng_rephrase')
+MATH_BUILT_TYPES = ('math_alg', 'math_geo', 'math_prob')
+VOC_UNITS = range(11)
+MAX_DRAW = 10
+
+RELOAD_INTERVAL = float(os.environ.get('BANK_RELOAD_INTERVAL', 10))
+
+
+class QuestionBank:
+    """
+    The questions DB, indexed once at load time into pools by question type / unit,
+    so drawing questions is a random pick from a ready pool instead of filtering the whole DB.
+    :var eng_built: question type -> list of (question, [answer1, answer2, answer3, answer4], correct_option_id)
+    :var math_built: question type -> list of (question_dir, correct_option_id), question_dir is the optimized
+                     image when there is an up to date one
+    :var voc: unit -> list of distinct (english, (hebrew translations)). unit 0 holds the words of all units.
+    :var voc_positions: english -> unit -> index of the word in voc[unit].
+    """
+
+    def __init__(self, eng_rows, voc_rows, math_rows, images_manifest=None):
+        """
+        :param eng_rows: rows of the engBuiltQuestions sheet, ordered as in ENG_BUILT_SHEET.
+        :param voc_rows: rows of the wordVoc sheet, ordered as in VOC_SHEET.
+        :param math_rows: rows of the mathBuiltQuestions sheet, ordered as in MATH_BUILT_SHEET.
+        :param images_manifest: the optimized images manifest (see: tools.optimize_images), None => read it.
+        """
+        if images_manifest is None:
+            images_manifest = read_images_manifest()
+
+        self.eng_built = {}
+        for question, answer1, answer2, answer3, answer4, correct_answer, qtype, unit in eng_rows:
+            self.eng_built.setdefault(qtype, []).append(
+                (question, [answer1, answer2, answer3, answer4], int(correct_answer) - 1))
+
+        self.math_built = {}
+        for question, question_dir, correct_answer, qtype in math_rows:
+            self.math_built.setdefault(qtype, []).append(
+                (resolve_image(question_dir, images_manifest), int(correct_answer) - 1))
+
+        translations = {0: {}}  # unit -> english -> hebrew translations
+        for english, hebrew, unit in voc_rows:
+            english, hebrew = str(english), str(hebrew)
+            translations.setdefault(int(unit), {}).setdefault(english, []).append(hebrew)
+            translations[0].setdefault(english, []).append(hebrew)
+        self.voc = {unit: [(english, tuple(hebrew)) for english, hebrew in words.items()]
+                    for unit, words in translations.items()}
+        self.voc_positions = {}  # english -> unit -> index of the word in the unit's pool (unit 0 included)
+        for unit, words in self.voc.items():
+            for index, (english, hebrew) in enumerate(words):
+                self.voc_positions.setdefault(english, {})[unit] = index
+
+    @staticmethod
+    def read_excel(path=DB_PATH):
+        """
+        Loading the questions DB from the MS Excel file.
+        :param path: path to the DB file.
+        :return: the rows of every sheet in SHEETS.
+        """
+        import pandas as pd  # only needed when the compiled DB is missing or stale
+
+        xls = pd.ExcelFile(path)
+        tables = []
+        for sheet_name, columns in SHEETS:
+            data = pd.read_excel(xls, sheet_name)[list(columns)]
+            # some words are parsed as other types (e.g. the word "False")
+            data = data.astype({column: str for column in columns if column not in NUMERIC_COLUMNS})
+            tables.append([tuple(row) for row in data.itertuples(index=False)])
+        return tables
+
+    @staticmethod
+    def read_compiled(path=COMPILED_DB_PATH):
+        """
+        Loading the questions DB from the compiled SQLite file.
+        :param path: path to the compiled DB file.
+        :return: the rows of every sheet in SHEETS.
+        """
+        with closing(sqlite3.connect(path)) as connection:
+            return [connection.execute('SELECT {} FROM {} ORDER BY rowid'.format(', '.join(columns), sheet_name))
+                    .fetchall() for sheet_name, columns in SHEETS]
+
+    @classmethod
+    def load(cls, path=DB_PATH, compiled_path=COMPILED_DB_PATH):
+        """
+        Loading and indexing the questions DB, from the compiled DB unless it is missing or stale.
+        :param path: path to the MS Excel DB file.
+        :param compiled_path: path to the compiled DB file.
+        :return: new QuestionBank.
+        """
+        if is_compiled_fresh(path, compiled_path):
+            return cls(*cls.read_compiled(compiled_path))
+
+        tables = cls.read_excel(path)
+        try:
+            write_compiled(tables, path, compiled_path)
+        except (OSError, sqlite3.Error):
+            pass  # read only file system, next start will read the MS Excel file again
+        return cls(*tables)
+
+    def __len__(self):
+        """:return: the number of questions and words in the bank."""
+        return (sum(len(pool) for pool in self.eng_built.values()) +
+                sum(len(pool) for pool in self.math_built.values()) + len(self.voc.get(0, ())))
+
+    def validate(self):
+        """
+        Checking the bank can be drawn from: every pool the bot draws from has enough questions,
+        every correct answer is one of the 4 options and every math question's image exists.
+        :return: description of every problem found, empty if the bank is valid.
+        """
+        problems = []
+        pools = [('eng_built', qtype, self.eng_built.get(qtype, []), MAX_DRAW) for qtype in ENG_BUILT_TYPES]
+        pools += [('math_built', qtype, self.math_built.get(qtype, []), MAX_DRAW) for qtype in MATH_BUILT_TYPES]
+        pools += [('voc', unit, self.voc.get(unit, []), 4 * MAX_DRAW) for unit in VOC_UNITS]  # 4 options a question
+        for name, key, pool, min_size in pools:
+            if len(pool) < min_size:
+                problems.append("{} {}: {} questions, at least {} needed".format(name, key, len(pool), min_size))
+
+        for qtype, pool in self.eng_built.items():
+            for question, answers, correct_option_id in pool:
+                if correct_option_id not in range(4):
+                    problems.append("eng_built {}: correct_answer {} of: {}".format(
+                        qtype, correct_option_id + 1, question[:50]))
+        for qtype, pool in self.math_built.items():
+            for question_dir, correct_option_id in pool:
+                if correct_option_id not in range(4):
+                    problems.append("math_built {}: correct_answer {} of: {}".format(
+                        qtype, correct_option_id + 1, question_dir))
+                if not os.path.isfile(question_dir):
+                    problems.append("math_built {}: missing image {}".format(qtype, question_dir))
+        return problems
+
+
+class BankReloader:
+    """
+    Reloading the questions bank when its MS Excel file changes, on a background thread:
+    the new bank is built and validated completely before it is handed over, so draws keep using
+    the current bank until then and never see a half built one.
+    :var on_reload: called with every new valid QuestionBank, to swap it in.
+    """
+
+    def __init__(self, on_reload, path=DB_PATH, compiled_path=COMPILED_DB_PATH, interval=RELOAD_INTERVAL):
+        """
+        :param on_reload: called with every new valid QuestionBank.
+        :param path: path to the MS Excel DB file to watch.
+        :param compiled_path: path to the compiled DB file.
+        :param interval: seconds between checks of the file.
+        """
+        self.on_reload = on_reload
+        self.path = path
+        self.compiled_path = compiled_path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.loaded_stat = self.stat()
+
+    def start(self):
+        threading.Thread(target=self.watch, name='bank-reloader', daemon=True).start()
+
+    def stat(self):
+        """:return: (mtime, size) of the watched file, None if it's missing."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def watch(self):
+        """Reloading once the file changed and then stayed the same for an interval (wasn't still being written)."""
+        seen = self.loaded_stat
+        while True:
+            time.sleep(self.interval)
+            current = self.stat()
+            if current is not None and current == seen and current != self.loaded_stat:
+                question_bank, seconds, problems = self.reload()
+                if problems:
+                    logger.error("Questions bank not reloaded: %s", "; ".join(problems))
+                else:
+                    logger.info("Questions bank reloaded in %.0f ms", seconds * 1000)
+            seen = current
+
+    def reload(self):
+        """
+        Loading, indexing and validating the bank, and handing it to on_reload if it is valid.
+        :return: (the new QuestionBank or None if it is invalid, seconds it took, problems found).
+        """
+        with self.lock:
+            start = time.perf_counter()
+            stat = self.stat()
+            try:
+                question_bank = QuestionBank.load(self.path, self.compiled_path)
+                problems = question_bank.validate()
+            except Exception as e:  # e.g. a malformed MS Excel file
+                question_bank, problems = None, ["{}: {}".format(type(e).__name__, e)]
+            self.loaded_stat = stat  # not retried until the file changes again
+            if problems:
+                return None, time.perf_counter() - start, problems
+            self.on_reload(question_bank)
+            return question_bank, time.perf_counter() - start, []
+
+
+class DrawCursor:
+    """
+    A user's walk through a shuffled order of a questions pool, so draws don't repeat a question
+    until the whole pool was drawn, then the pool is shuffled again.
+    The order is kept as an array of 2 bytes indexes (4 bytes for pools over 65535 questions).
+    :var order: the pool's indexes in shuffled order.
+    :var next: position in order of the next question to draw.
+    """
+    __slots__ = ('order', 'next')
+
+    def __init__(self, order=None, next=0):
+        self.order = order if order is not None else array('H')
+        self.next = next
+
+    def shuffle(self, pool_size):
+        self.order = array('H' if pool_size <= 0xFFFF else 'I', range(pool_size))
+        random.shuffle(self.order)
+        self.next = 0
+
+    def take(self, num_samples, pool_size):
+        """
+        :param num_samples: the number of questions to draw, at most pool_size.
+        :param pool_size: the number of questions in the pool (the pool is shuffled again if it changed).
+        :return: indexes in the pool of the drawn questions, all different.
+        """
+        if len(self.order) != pool_size:
+            self.shuffle(pool_size)
+        taken = self.order[self.next:self.next + num_samples].tolist()
+        self.next += len(taken)
+        if len(taken) < num_samples:  # the pool was drawn completely
+            drawn = set(taken)
+            self.shuffle(pool_size)
+            while len(taken) < num_samples:
+                index = self.order[self.next]
+                self.next += 1
+                if index not in drawn:
+                    taken.append(index)
+        return taken
+
+    def copy(self):
+        """:return: a cursor walking on from this one, independently (the order is never changed in place)."""
+        return DrawCursor(self.order, self.next)
+
+    def to_dict(self):
+        order = self.order
+        if sys.byteorder != 'little':  # kept little endian
+            order = array(order.typecode, order)
+            order.byteswap()
+        return {'type': self.order.typecode, 'order': base64.b64encode(order.tobytes()).decode(), 'next': self.next}
+
+    @staticmethod
+    def from_dict(data):
+        order = array(data['type'])
+        order.frombytes(base64.b64decode(data['order']))
+        if sys.byteorder != 'little':
+            order.byteswap()
+        return DrawCursor(order, data['next'])
+
+
+def draw(pool_size, num_samples, cursor=None):
+    """
+    :param pool_size: the number of questions in the pool.
+    :param num_samples: the number of questions to draw.
+    :param cursor: the user's DrawCursor of the pool, None => independent random draw.
+    :return: indexes in the pool of the drawn questions, all different.
+    """
+    if cursor is None:
+        return random.sample(range(pool_size), num_samples)
+    return cursor.take(num_samples, pool_size)
+
+
+class WeightTree:
+    """
+    A user's weights of the questions in a pool, kept in a Fenwick (binary indexed) tree so changing a weight
+    and drawing a question by the weights both take O(log n).
+    Questions start at BASE_WEIGHT, a wrong answer doubles the question's weight and a right one halves it,
+    so draws lean toward the questions the user gets wrong.
+    :var tree: the Fenwick tree, tree[i] is the sum of the weights of questions i - lowbit(i) to i - 1.
+    """
+    __slots__ = ('tree',)
+
+    BASE_WEIGHT = 4
+    MIN_WEIGHT = 1
+    MAX_WEIGHT = 64
+
+    def __init__(self, pool_size=0, tree=None):
+        if tree is None:
+            tree = array('I', (self.BASE_WEIGHT * (i & -i) for i in range(pool_size + 1)))
+        self.tree = tree
+
+    def __len__(self):
+        return len(self.tree) - 1
+
+    def total(self):
+        return self.prefix_sum(len(self))
+
+    def prefix_sum(self, count):
+        """
+        :param count: number of questions from the start of the pool.
+        :return: the sum of their weights.
+        """
+        tree, total = self.tree, 0
+        while count > 0:
+            total += tree[count]
+            count &= count - 1
+        return total
+
+    def weight(self, index):
+        return self.prefix_sum(index + 1) - self.prefix_sum(index)
+
+    def add(self, index, delta):
+        tree = self.tree
+        index += 1
+        while index < len(tree):
+            tree[index] += delta
+            index += index & -index
+
+    def find(self, value):
+        """
+        :param value: 0 <= value < total().
+        :return: index of the question whose weight range holds the value.
+        """
+        tree, position = self.tree, 0
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            if position + step < len(tree) and tree[position + step] <= value:
+                position += step
+                value -= tree[position]
+            step >>= 1
+        return position
+
+    def sample(self, num_samples):
+        """
+        :param num_samples: the number of questions to draw, at most the pool's size.
+        :return: indexes in the pool of the drawn questions, all different, each drawn by its weight.
+        """
+        taken = []
+        for i in range(num_samples):
+            index = self.find(random.randrange(self.total()))
+            taken.append((index, self.weight(index)))
+            self.add(index, -taken[-1][1])  # not drawn again in this draw
+        for index, weight in taken:
+            self.add(index, weight)
+        return [index for index, weight in taken]
+
+    def record(self, index, correct):
+        """
+        Updating a question's weight by the user's answer.
+        :param index: index of the question in the pool.
+        :param correct: whether the user answered right.
+        """
+        weight = self.weight(index)
+        new_weight = max(self.MIN_WEIGHT, weight // 2) if correct else min(self.MAX_WEIGHT, weight * 2)
+        self.add(index, new_weight - weight)
+
+    def mean_weight(self):
+        return self.total() / len(self) if len(self) else self.BASE_WEIGHT
+
+    def to_dict(self):
+        tree = self.tree
+        if sys.byteorder != 'little':  # kept little endian
+            tree = array(tree.typecode, tree)
+            tree.byteswap()
+        return {'type': self.tree.typecode, 'tree': base64.b64encode(tree.tobytes()).decode()}
+
+    @staticmethod
+    def from_dict(data):
+        tree = array(data['type'])
+        tree.frombytes(base64.b64decode(data['tree']))
+        if sys.byteorder != 'little':
+            tree.byteswap()
+        return WeightTree(tree=tree)
+
+
+def read_images_manifest(path=IMAGES_MANIFEST_PATH):
+    """
+    :param path: path to the optimized images manifest.
+    :return: original image path -> its manifest entry, empty if the images weren't optimized.
+    """
+    try:
+        with open(path, encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def resolve_image(question_dir, images_manifest):
+    """
+    :param question_dir: path to the question's original image.
+    :param images_manifest: the optimized images manifest.
+    :return: path to the optimized image, or the original one if it wasn't optimized since it last changed.
+             The mtime and size are checked first, the content hash only when the mtime changed.
+    """
+    entry = images_manifest.get(question_dir)
+    if entry is None or not os.path.isfile(entry['path']):
+        return question_dir
+    try:
+        stat = os.stat(question_dir)
+    except OSError:
+        return question_dir
+    if stat.st_size != entry['source_bytes']:
+        return question_dir
+    if stat.st_mtime != entry['source_mtime'] and file_hash(question_dir) != entry['source_sha256']:
+        return question_dir
+    return entry['path']
+
+
+# _______________compiling the DB___________________
+
+def file_hash(path):
+    """
+    :param path: path to the file.
+    :return: sha256 hex digest of the file's content.
+    """
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def is_compiled_fresh(path=DB_PATH, compiled_path=COMPILED_DB_PATH):
+    """
+    Checking if the compiled DB was compiled from the current MS Excel DB.
+    The mtime and size are checked first, the content hash only when they changed.
+    :param path: path to the MS Excel DB file.
+    :param compiled_path: path to the compiled DB file.
+    :return: True if the compiled DB can be used, also when the MS Excel DB is missing (deployed without it).
+    """
+    if not os.path.exists(compiled_path):
+        return False
+    try:
+        with closing(sqlite3.connect(compiled_path)) as connection:
+            source = dict(connection.execute('SELECT key, value FROM source').fetchall())
+    except sqlite3.Error:
+        return False
+
+    if source.get('sheets') != repr(SHEETS):  # compiled by a version with other columns
+        return False
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return True
+    if source.get('mtime') == repr(stat.st_mtime) and source.get('size') == str(stat.st_size):
+        return True
+    return source.get('sha256') == file_hash(path)
+
+
+def write_compiled(tables, path=DB_PATH, compiled_path=COMPILED_DB_PATH):
+    """
+    Writing the DB rows to the compiled SQLite file, replacing it atomically.
+    :param tables: the rows of every sheet in SHEETS.
+    :param path: path to the MS Excel DB file the rows were read from.
+    :param compiled_path: path to the compiled DB file.
+    """
+    tmp_path = '{}.{}.tmp'.format(compiled_path, os.getpid())  # bot worker processes may compile at once
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    stat = os.stat(path)
+    with closing(sqlite3.connect(tmp_path)) as connection, connection:
+        connection.execute('CREATE TABLE source (key TEXT PRIMARY KEY, value TEXT)')
+        connection.executemany('INSERT INTO source VALUES (?, ?)',
+                               [('mtime', repr(stat.st_mtime)), ('size', str(stat.st_size)),
+                                ('sha256', file_hash(path)), ('sheets', repr(SHEETS))])
+        for (sheet_name, columns), rows in zip(SHEETS, tables):
+            connection.execute('CREATE TABLE {} ({})'.format(sheet_name, ', '.join(columns)))
+            connection.executemany('INSERT INTO {} VALUES ({})'.format(sheet_name, ', '.join('?' * len(columns))),
+                                   rows)
+    os.replace(tmp_path, compiled_path)
+
+
+def compile_db(path=DB_PATH, compiled_path=COMPILED_DB_PATH):
+    """
+    Compiling the MS Excel DB into the SQLite file the bot loads at startup.
+    :param path: path to the MS Excel DB file.
+    :param compiled_path: path to the compiled DB file.
+    """
+    write_compiled(QuestionBank.read_excel(path), path, compiled_path)
+
+
+if __name__ == '__main__':
+    compile_db()
+    print("Compiled " + DB_PATH + " -> " + COMPILED_DB_PATH)
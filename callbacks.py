@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+CALLBACK_DEDUP_TTL = float(os.environ.get('CALLBACK_DEDUP_TTL', 5))
+MAX_TRACKED_CALLBACKS = 100000
+
+duplicates = metrics.counter('callback_duplicates_total', "Callbacks dropped as duplicate taps", ['reason'])
+
+
+class CallbackGuard:
+    """
+    Dropping duplicate taps on the menus' buttons (users tap again while the client still shows the spinner):
+    a tap on a button of a message as it was shown (chat id, message id, the message's edits, callback data)
+    is handled once, the same tap within the TTL is dropped, and a chat's question batch is sent one at a time
+    (the in-flight marker, see: begin). A menu edited back into a menu it showed before is tapped anew.
+    The tap starting a question batch is remembered until the TTL passes after the batch was sent,
+    so the taps queued behind the batch are dropped too.
+    """
+
+    def __init__(self, ttl=CALLBACK_DEDUP_TTL, max_size=MAX_TRACKED_CALLBACKS):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.taps = OrderedDict()  # (chat id, message id, edits, callback data) -> expiry time, oldest first
+        self.latest = {}  # chat id -> the chat's last handled tap
+        self.in_flight = set()  # chat ids sending a question batch
+        self.lock = threading.Lock()
+
+    def duplicate(self, chat_id, message_id, data, edits=0):
+        """
+        Remembering a tap, if it wasn't handled before.
+        :param chat_id: the chat the tapped message is in.
+        :param message_id: the tapped message's id.
+        :param data: the tapped button's callback data.
+        :param edits: the number of times the message was edited into another menu.
+        :return: whether the same tap was handled within the TTL (the tap should be dropped).
+        """
+        tap = (chat_id, message_id, edits, data)
+        now = time.monotonic()
+        with self.lock:
+            self.expire(now)
+            if tap in self.taps:
+                duplicates.inc(reason='repeated')
+                return True
+            self.taps[tap] = now + self.ttl
+            self.latest[chat_id] = tap
+        return False
+
+    def begin(self, chat_id):
+        """
+        Marking the chat as sending a question batch.
+        :param chat_id: the chat's id.
+        :return: False if the chat is already sending one (the batch should be dropped).
+        """
+        with self.lock:
+            if chat_id in self.in_flight:
+                duplicates.inc(reason='in_flight')
+                return False
+            self.in_flight.add(chat_id)
+        return True
+
+    def end(self, chat_id):
+        """
+        Marking the chat's question batch as sent, the tap which asked for it is remembered for the TTL from now.
+        :param chat_id: the chat's id.
+        """
+        with self.lock:
+            self.in_flight.discard(chat_id)
+            tap = self.latest.get(chat_id)
+            if tap in self.taps:
+                self.taps[tap] = time.monotonic() + self.ttl
+                self.taps.move_to_end(tap)
+
+    def expire(self, now):
+        """Forgetting the taps past their TTL and the oldest ones above max size, the lock must be held."""
+        while self.taps:
+            tap, expiry = next(iter(self.taps.items()))
+            if expiry >= now and len(self.taps) <= self.max_size:
+                break
+            del self.taps[tap]
+            if self.latest.get(tap[0]) == tap:
+                del self.latest[tap[0]]
+
+    def __len__(self):
+        return len(self.taps)
@@ -0,0 +1,95 @@
+import atexit
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DIGEST_INTERVAL = float(os.environ.get('NEW_USERS_DIGEST_INTERVAL', 5 * 60))
+DIGEST_SIZE = int(os.environ.get('NEW_USERS_DIGEST_SIZE', 50))
+MAX_LISTED = 30
+
+new_users = metrics.counter('new_users_total', "Chats which started using the bot")
+digests = metrics.counter('new_users_digests_total', "New users digests sent to the admin", ['result'])
+
+
+class NewUsersDigest:
+    """
+    Telling the admin about new users in periodic digests instead of a message per user:
+    the handlers only add the new chat (see: add), a background thread sends the digest of the chats added
+    since the last one, every interval or as soon as size chats are waiting.
+    A digest lists up to MAX_LISTED chats and counts the rest. A digest which fails to send is dropped.
+    """
+
+    def __init__(self, send, interval=DIGEST_INTERVAL, size=DIGEST_SIZE):
+        """
+        :param send: sends the digest's text to the admin.
+        :param interval: max seconds between a new user and the digest telling about it.
+        :param size: the number of waiting new users which sends the digest right away.
+        """
+        self.send = send
+        self.interval = interval
+        self.size = size
+        self.listed = []  # descriptions of the waiting new chats, up to MAX_LISTED
+        self.count = 0  # number of waiting new chats
+        self.since = None  # time.time() of the first waiting new chat
+        self.lock = threading.Lock()
+        self.full = threading.Event()
+
+    def start(self):
+        """Starting the thread sending the digests (in the process handling the updates, after forking)."""
+        threading.Thread(target=self.send_loop, name='new-users-digest', daemon=True).start()
+        atexit.register(self.flush)
+
+    def add(self, chat):
+        """
+        Adding a new chat to the next digest, without waiting.
+        :param chat: the new chat (telebot Chat).
+        """
+        new_users.inc()
+        with self.lock:
+            if self.count == 0:
+                self.since = time.time()
+            self.count += 1
+            if len(self.listed) < MAX_LISTED:
+                self.listed.append(chat_text(chat))
+            if self.count >= self.size:
+                self.full.set()
+
+    def send_loop(self):
+        while True:
+            self.full.wait(self.interval)
+            self.flush()
+
+    def flush(self):
+        """Sending the digest of the waiting new chats, if there are any."""
+        with self.lock:
+            count, listed, since = self.count, self.listed, self.since
+            self.count, self.listed, self.since = 0, [], None
+            self.full.clear()
+        if count == 0:
+            return
+        lines = ["{} new users since {}:".format(count, time.strftime('%H:%M', time.localtime(since)))] + listed
+        if count > len(listed):
+            lines.append("... and {} more".format(count - len(listed)))
+        try:
+            self.send("\n".join(lines))
+            digests.inc(result='sent')
+        except Exception:
+            digests.inc(result='failed')
+            logger.exception("Failed sending the new users digest")
+
+
+def chat_text(chat):
+    """
+    :param chat: telebot Chat.
+    :return: one line describing the chat: its id, username and name.
+    """
+    names = [str(chat.id)]
+    if chat.username:
+        names.append("@" + chat.username)
+    names += [name for name in (chat.first_name, chat.last_name, chat.title) if name]
+    return " ".join(names)
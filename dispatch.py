@@ -0,0 +1,141 @@
+import logging
+import os
+import queue
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', 8))
+DISPATCH_QUEUE_SIZE = int(os.environ.get('DISPATCH_QUEUE_SIZE', 100))
+
+
+class ChatDispatcher:
+    """
+    Running updates on a bounded pool of worker threads, in order per chat:
+    every chat has its own queue of calls, and a chat is handed to a free worker only while it has a call waiting
+    and none running. So all the updates of a chat run one after the other, in the order they arrived,
+    while a slow chat holds a single worker and the other chats' updates run on the rest.
+    The submitted calls are bounded, submitting when they are full blocks (backpressure on the poller).
+    :var workers: number of worker threads.
+    :var chats: chat id -> the chat's waiting calls, for every chat with a call waiting or running.
+    :var runnable: the chats with a call waiting and none running, in the order they became runnable.
+    :var pending: number of submitted calls which aren't done yet.
+    """
+
+    def __init__(self, workers=DISPATCH_WORKERS, queue_size=DISPATCH_QUEUE_SIZE):
+        """
+        :param workers: number of worker threads.
+        :param queue_size: max number of submitted calls per worker thread.
+        """
+        self.workers = workers
+        self.max_pending = workers * queue_size
+        self.chats = {}
+        self.runnable = queue.SimpleQueue()
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.room = threading.Condition(self.lock)  # notified when a call is done
+        self.threads = [threading.Thread(target=self.work, name='dispatch-{}'.format(i), daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, chat_id, function, *args, timeout=None):
+        """
+        Queueing a call after the chat's waiting calls, blocking while the submitted calls are full.
+        :param chat_id: the chat the call belongs to (None for updates without a chat).
+        :param function: the function to call.
+        :param args: the function's arguments.
+        :param timeout: max seconds to wait for room, None => wait as long as needed.
+        :raise queue.Full: if there was no room within the timeout.
+        """
+        with self.lock:
+            if not self.room.wait_for(lambda: self.pending < self.max_pending, timeout):
+                raise queue.Full
+            self.pending += 1
+            calls = self.chats.get(chat_id)
+            if calls is None:
+                self.chats[chat_id] = deque([(function, args)])
+                self.runnable.put(chat_id)
+            else:  # the chat is runnable or running already
+                calls.append((function, args))
+
+    def join(self):
+        """Waiting until every submitted call is done."""
+        with self.lock:
+            self.room.wait_for(lambda: self.pending == 0)
+
+    def work(self):
+        """
+        Worker loop: running the next call of the next runnable chat,
+        the chat is runnable again (at the back) if it has more calls waiting.
+        """
+        while True:
+            chat_id = self.runnable.get()
+            with self.lock:
+                function, args = self.chats[chat_id].popleft()
+            try:
+                function(*args)
+            except Exception:
+                logger.exception("Failed handling an update")
+            finally:
+                with self.lock:
+                    self.pending -= 1
+                    if self.chats[chat_id]:
+                        self.runnable.put(chat_id)
+                    else:
+                        del self.chats[chat_id]
+                    self.room.notify_all()
+
+
+def update_chat_id(update):
+    """
+    :param update: telebot Update.
+    :return: the id of the chat the update belongs to, None if it doesn't belong to a chat.
+    """
+    if update.message is not None:
+        return update.message.chat.id
+    if update.callback_query is not None and update.callback_query.message is not None:
+        return update.callback_query.message.chat.id
+    if update.poll_answer is not None:  # quiz answers come from the user, whose private chat has the same id
+        return update.poll_answer.user.id
+    return None
+
+
+def update_json_chat_id(update):
+    """
+    :param update: an update as received from Telegram (JSON dict).
+    :return: the id of the chat the update belongs to, None if it doesn't belong to a chat (see: update_chat_id).
+    """
+    if 'message' in update:
+        return update['message']['chat']['id']
+    if 'callback_query' in update and 'message' in update['callback_query']:
+        return update['callback_query']['message']['chat']['id']
+    if 'poll_answer' in update and 'user' in update['poll_answer']:
+        return update['poll_answer']['user']['id']
+    return None
+
+
+def dispatch_updates(bot, dispatcher, handle=None, receive=None):
+    """
+    Making the bot hand its new updates to the dispatcher instead of handling them on the polling thread.
+    The bot should be created with threaded=False, so the handlers run on the dispatcher's worker.
+    :param bot: the TeleBot.
+    :param dispatcher: the ChatDispatcher.
+    :param handle: called on the dispatcher's worker with every update, None => the bot's handlers.
+    :param receive: called with every update as it's received, before it waits behind its chat's updates
+                    (e.g. acknowledging the callbacks), None => nothing.
+    """
+    if handle is None:
+        process_new_updates = bot.process_new_updates
+        handle = lambda update: process_new_updates([update])
+
+    def submit_updates(updates):
+        for update in updates:
+            # marked as handled right away, so the next poll doesn't fetch updates still waiting in a queue
+            bot.last_update_id = max(bot.last_update_id, update.update_id)
+            if receive is not None:
+                receive(update)
+            dispatcher.submit(update_chat_id(update), handle, update)
+
+    bot.process_new_updates = submit_updates
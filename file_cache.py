@@ -0,0 +1,105 @@
+import json
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows, a single bot process
+    fcntl = None
+
+from bank import file_hash
+
+FILE_ID_CACHE_PATH = os.environ.get('FILE_ID_CACHE', os.getcwd() + '/DATA/file_ids.json')
+
+
+class FileIdCache:
+    """
+    Persistent map from a file path to the Telegram file_id returned when the file was first uploaded,
+    so the file can be sent again by its file_id without uploading it.
+    An entry is valid only while the file's content is the same as when it was uploaded.
+    :var path: path to the JSON sidecar file the cache is saved in.
+    The bot's worker processes share the file: a save merges this process' changes into the file's current entries.
+    :var entries: file path -> {"file_id", "sha256", "mtime", "size"}
+    :var changes: file path -> its entry, None => removed, the changes not saved yet.
+    """
+
+    def __init__(self, path=FILE_ID_CACHE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = self.load()
+        self.changes = {}
+
+    def get(self, file_path):
+        """
+        :param file_path: path of the file to send.
+        :return: the file_id of the file, or None if it wasn't uploaded or its content changed since.
+        """
+        entry = self.entries.get(file_path)
+        if entry is None:
+            return None
+
+        stat = os.stat(file_path)
+        if entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            return entry['file_id']
+        if entry['sha256'] == file_hash(file_path):  # touched but not changed
+            with self.lock:
+                entry['mtime'], entry['size'] = stat.st_mtime, stat.st_size
+                self.changes[file_path] = entry
+                self.save()
+            return entry['file_id']
+
+        self.discard(file_path)
+        return None
+
+    def set(self, file_path, file_id):
+        """
+        Saving the file_id Telegram returned after uploading the file.
+        :param file_path: path of the uploaded file.
+        :param file_id: the file_id of the uploaded file.
+        """
+        stat = os.stat(file_path)
+        with self.lock:
+            self.entries[file_path] = self.changes[file_path] = {
+                'file_id': file_id, 'sha256': file_hash(file_path), 'mtime': stat.st_mtime, 'size': stat.st_size}
+            self.save()
+
+    def discard(self, file_path):
+        """
+        Removing the file's entry (e.g. when Telegram doesn't accept its file_id anymore).
+        :param file_path: path of the file.
+        """
+        with self.lock:
+            if self.entries.pop(file_path, None) is not None:
+                self.changes[file_path] = None
+                self.save()
+
+    def load(self):
+        """:return: the entries in the sidecar file, empty if there is none."""
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        """
+        Writing the cache to its sidecar file: the file's current entries (other processes may have saved theirs)
+        with this process' changes, under a lock file. The lock must be held.
+        """
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(self.path + '.lock', 'a') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)  # released when the file is closed
+                entries = self.load()
+                for file_path, entry in self.changes.items():
+                    if entry is None:
+                        entries.pop(file_path, None)
+                    else:
+                        entries[file_path] = entry
+                with open(tmp_path, 'w', encoding='utf-8') as file:
+                    json.dump(entries, file)
+                os.replace(tmp_path, self.path)
+        except OSError:
+            return  # the cache still works in memory, the changes are saved with the next save
+        self.entries, self.changes = entries, {}
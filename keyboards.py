@@ -0,0 +1,80 @@
+from telebot import types
+from menu import MenuType, QuestionType, AmountQuestion, Unit, MenuAnswer
+
+# _______________inline keyboards of all menus, built once at startup___________________
+# The keyboards are kept serialized: telebot sends a JSON string reply_markup as is,
+# instead of serializing the same keyboard on every message.
+
+
+def button(text, menu_type, option):
+    """
+    :param text: the button's text.
+    :param menu_type: the menu the button is on.
+    :param option: the option the button selects.
+    :return: inline button with the encoded MenuAnswer as callback data.
+    """
+    return types.InlineKeyboardButton(text, callback_data=MenuAnswer(menu_type, option).encode())
+
+
+def keyboard(rows):
+    """
+    :param rows: rows of inline buttons.
+    :return: the serialized inline keyboard.
+    """
+    return types.InlineKeyboardMarkup(rows).to_json()
+
+
+def unit_rows(num_of_units=10):
+    """
+    :param num_of_units: the number of units in the DB.
+    :return: rows of three unit buttons, the button of all units is last.
+    """
+    buttons = [button(str(i), MenuType.UNIT, Unit(str(i))) for i in range(1, num_of_units + 1)]
+    rows = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+    all_units_btn = button("הכל", MenuType.UNIT, Unit.COMBINATION)
+    if len(rows[-1]) < 3:
+        rows[-1].append(all_units_btn)
+    else:
+        rows.append([all_units_btn])
+    return rows
+
+
+MAIN_MENU = keyboard([
+    [button('אנגלית', MenuType.MAIN, MenuType.ENGLISH)],
+    [button('עברית', MenuType.MAIN, MenuType.HEBREW), button('חשבון', MenuType.MAIN, MenuType.MATH)],
+    [button('הכל', MenuType.MAIN, MenuType.COMBINATION)],
+])
+
+ENGLISH_MAIN_MENU = keyboard([
+    [button('תרגום אוצר מילים', MenuType.ENGLISH, MenuType.ENG_VOC),
+     button('השלמת משפטים', MenuType.ENGLISH, QuestionType.ENG_COM)],
+    [button('ערבוב תרגילים', MenuType.ENGLISH, QuestionType.ENG_MIX),
+     button('ניסוח משפט מחדש', MenuType.ENGLISH, QuestionType.ENG_REPHRASE)],
+])
+
+ENGLISH_VOC_MENU = keyboard([
+    [button('תרגום אגנלית לעברית', MenuType.ENG_VOC, QuestionType.ENG_VOC_ENG),
+     button('תרגום עברית לאנגלית', MenuType.ENG_VOC, QuestionType.ENG_VOC_HEB)],
+    [button('תרגום אנגלית <-> עברית', MenuType.ENG_VOC, QuestionType.ENG_VOC_MIX)],
+])
+
+MATH_MAIN_MENU = keyboard([
+    [button('אלגברה', MenuType.MATH, QuestionType.MATH_ALGEBRA),
+     button('גאומטריה', MenuType.MATH, QuestionType.MATH_GEOMETRY)],
+    [button('בעיות מילוליות', MenuType.MATH, QuestionType.MATH_PROBLEM),
+     button('ערבוב תרגילים', MenuType.MATH, QuestionType.MATH_MIX)],
+])
+
+UNIT_NUM_MENU = keyboard(unit_rows())
+
+AMOUNT_MENU = keyboard([
+    [button('1', MenuType.AMOUNT, AmountQuestion.ONE),
+     button('5', MenuType.AMOUNT, AmountQuestion.FIVE),
+     button('10', MenuType.AMOUNT, AmountQuestion.TEN)],
+    [types.InlineKeyboardButton('בהצלחה ', callback_data="null")],
+])
+
+REPEAT_MENU = keyboard([
+    [button('תפריט', MenuType.REPEAT, MenuType.MAIN)],
+    [button('שוב פעם', MenuType.REPEAT, QuestionType.REPEAT)],
+])
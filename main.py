@@ -1,581 +1,1051 @@
-import json
 import telebot
 from telebot import types
-import pandas as pd
+from telebot.apihelper import ApiTelegramException
+import logging
 import os
+import queue
 import random
+import signal
+import sys
+import threading
 import session
-from menu import MenuType, QuestionType, AmountQuestion, Unit, MenuAnswer, MenuAnswerEncoder
+import callbacks
+import dispatch
+import digest
+import polls
+import prefetch
+import profiling
+import outbound
+import webhook
+import workers
+import bank
+from bank import QuestionBank
+from file_cache import FileIdCache
+from outbound import calls
+import keyboards
+import metrics
+from menu import MenuType, QuestionType, MenuAnswer, MENU_OPTIONS
 
 # _______________initializing the bot and DBs___________________
 
+logger = logging.getLogger(__name__)
+
 #Connecting to the API using environment variable (also set on the Heroku cloud)
-API_TOKEN = os.environ['API_TOKEN']
-bot = telebot.TeleBot(API_TOKEN)
+# read without failing, so the module can be imported without a token (e.g. by tools.microbenchmark),
+# running the bot requires it (see: __main__)
+API_TOKEN = os.environ.get('API_TOKEN')
+if os.environ.get('TELEGRAM_API_URL'):  # e.g. a local Bot API server or the load test's fake (tools.fake_telegram)
+    telebot.apihelper.API_URL = os.environ['TELEGRAM_API_URL']
+bot = telebot.TeleBot(API_TOKEN or '0:unset', threaded=False)  # the handlers run on the dispatcher's workers
+sender = outbound.OutboundQueue(bot)  # all the messages are queued on it, sent under Telegram's rate limits
+
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')  # polling | webhook
+# the metrics are served on http://<host>:METRICS_PORT/metrics, each worker's on the next ports (0 => not served)
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+# Telegram's limits of quiz polls and albums
+POLL_QUESTION_LENGTH = 300
+POLL_OPTION_LENGTH = 100
+MEDIA_GROUP_SIZE = 10
+MESSAGE_LENGTH = 4096
+NUMBERED_OPTIONS = ["1", "2", "3", "4"]
 
 INITIAL_MESSAGE = "Hello! \n Welcome to the Psychometric Bot!"
-chat = int(os.environ['CHAT'])
-xls = pd.ExcelFile(os.getcwd() + '/DATA/DB.xlsx')
-engQuestions = pd.read_excel(xls, 'engBuiltQuestions')
-engVoc = pd.read_excel(xls, 'wordVoc')
-mathQuestions = pd.read_excel(xls, 'mathBuiltQuestions')
-users_sessions = {}
+chat = int(os.environ.get('CHAT', 0))  # the admin's chat id, required to run the bot
+ADMIN_COMMANDS = ('reload', 'profile', 'profile_report')  # run by every worker (see: is_admin_command)
+worker_name = ""  # names the worker process in its answers to the admin, when there are several (see: worker_main)
+question_bank = QuestionBank.load()  # swapped for a new bank when DB.xlsx changes (see: swap_bank)
+photo_cache = FileIdCache()
+users_sessions = session.SessionStore()  # SESSION_STORE env var chooses where sessions are kept
+
+# shuffle => a user gets every question of a pool before any repeats |
+# adaptive => draws lean toward the questions, units and question types the user answers wrong
+QUESTION_SELECTION = os.environ.get('QUESTION_SELECTION', 'shuffle')
+prefetched = prefetch.PrefetchCache()  # chat id -> the user's next batch of questions, prepared in advance
+dispatcher = None  # the ChatDispatcher running the handlers, set when the bot runs
+
+
+def swap_bank(new_bank):
+    """
+    Replacing the questions bank with a newly loaded one, draws started before keep the bank they started with.
+    :param new_bank: the new valid QuestionBank.
+    """
+    global question_bank
+    question_bank = new_bank
+    prefetched.clear()  # drawn from the previous bank
+
+
+reloader = bank.BankReloader(swap_bank)
+
+handler_seconds = metrics.histogram('handler_seconds', "Time the handlers of the users' actions took", ['handler'])
+handler_errors = metrics.counter('handler_errors_total', "Handlers failed with an exception", ['handler'])
+generator_seconds = metrics.histogram('question_generator_seconds', "Time drawing questions took", ['generator'])
+menu_answers = metrics.counter('menu_answers_total', "Menu buttons the users clicked", ['menu', 'option'])
+question_batches = metrics.counter('question_batches_total', "Question batches sent, by the user's selection",
+                                   ['subject', 'question_type', 'source'])
+metrics.gauge('active_sessions', "Sessions cached in memory", function=lambda: len(users_sessions))
+new_users_digest = digest.NewUsersDigest(lambda text: sender.call(chat, 'send_message', chat, text))  # to the admin
+callback_guard = callbacks.CallbackGuard()  # drops the users' duplicate taps
+profiler = profiling.UpdateProfiler()  # off until the admin sends /profile
+open_polls = polls.PollTracker()  # poll id -> (chat id, correct option id, questions asked [(pool key, index, pool size)])
 
 
 @bot.poll_answer_handler(func=lambda pollAnswer: True)
+@metrics.timed(handler_seconds, handler_errors, handler='poll_answer')
 def get_poll_answer(poll_answer):
-    # print(poll_answer.poll_id)
-    return poll_answer
+    '''Scoring the user's answer to a quiz (see: track_poll) into their stats and question weights'''
+    entry = open_polls.pop(poll_answer.poll_id)
+    if entry is None:
+        return
+    chat_id, correct_option_id, asked = entry
+    user_session = users_sessions.get(chat_id)
+    if user_session is None:
+        return
+    correct = poll_answer.option_ids == [correct_option_id]
+    user_session.count_answer(asked[0][0], correct)
+    if QUESTION_SELECTION == 'adaptive':
+        for pool_key, index, pool_size in asked:
+            weights = user_session.weights.get(pool_key)
+            if weights is None or len(weights) != pool_size:
+                weights = user_session.weights[pool_key] = bank.WeightTree(pool_size)
+            weights.record(index, correct)
+    users_sessions.save(chat_id)  # written to the store with the next batch of sessions
+    if QUESTION_SELECTION == 'adaptive':
+        schedule_prefetch(chat_id)  # drawn by the new weights
+
+
+@bot.message_handler(commands=['stats'])
+def stats(message):
+    '''Sending the user's right answers so far, by subject, question type and unit'''
+    user_session = users_sessions.get(message.chat.id)
+    if user_session is None or not user_session.stats:
+        sender.send_message(message.chat.id, "You haven't answered any question yet")
+        return
+    sender.send_message(message.chat.id, stats_text(user_session.stats))
+
+
+def stats_text(user_stats):
+    """
+    :param user_stats: the user's session stats, pool key -> [answers, right answers].
+    :return: the stats message, a line per subject and under it a line per question type / unit.
+    """
+    subjects = {}  # subject -> [(name, answers, right answers)]
+    for pool_key, (answered, right) in sorted(user_stats.items(), key=lambda item: stats_order(item[0])):
+        subject, name = STATS_NAMES.get(pool_key) or ("English", "Vocabulary unit " + pool_key.split(":")[1])
+        subjects.setdefault(subject, []).append((name, answered, right))
+
+    lines = ["Your answers:"]
+    for subject, rows in subjects.items():
+        lines.append("\n{}: {}".format(subject, score_text(sum(row[1] for row in rows), sum(row[2] for row in rows))))
+        lines += [" {}: {}".format(name, score_text(answered, right)) for name, answered, right in rows]
+    return "\n".join(lines)
+
+
+def stats_order(pool_key):
+    pool_type, name = pool_key.split(":")
+    return ("eng", "voc", "math").index(pool_type), int(name) if name.isnumeric() else 0, name
+
+
+def score_text(answered, right):
+    return "{}/{} ({:.0f}%)".format(right, answered, 100 * right / answered)
+
+
+@bot.message_handler(commands=['reload'], func=lambda message: message.chat.id == chat)
+def reload_bank(message):
+    '''Admin command: reloading the questions bank now, on a background thread'''
+    threading.Thread(target=report_reload, args=(message.chat.id,), name='bank-reload', daemon=True).start()
+
+
+def report_reload(chat_id):
+    """
+    Reloading the questions bank and sending the result.
+    :param chat_id: the admin's chat id.
+    """
+    new_bank, seconds, problems = reloader.reload()
+    if problems:
+        admin_reply(chat_id, "The questions bank wasn't reloaded ({:.0f} ms), problems:\n".format(seconds * 1000)
+                    + "\n".join(problems[:20]) + ("\n..." if len(problems) > 20 else ""))
+    else:
+        admin_reply(chat_id, "The questions bank was reloaded in {:.0f} ms: {} questions".format(
+            seconds * 1000, len(new_bank)))
+
+
+@bot.message_handler(commands=['profile'], func=lambda message: message.chat.id == chat)
+def start_profile(message):
+    '''Admin command: /profile [updates] [chat id] profiles the next updates (of the chat only), /profile off stops'''
+    args = message.text.split()[1:]
+    if args[:1] == ['off']:
+        profiler.stop()
+        admin_reply(message.chat.id, "Profiling stopped, /profile_report sends the profiles")
+        return
+    try:
+        count = int(args[0]) if args else 10
+        chat_id = int(args[1]) if len(args) > 1 else None
+    except ValueError:
+        admin_reply(message.chat.id, "Usage: /profile [updates] [chat id] | /profile off")
+        return
+    profiler.start(count, chat_id)
+    admin_reply(message.chat.id, "Profiling the next {} updates{} (for up to {:.0f} minutes)".format(
+        count, "" if chat_id is None else " of chat {}".format(chat_id), profiler.max_seconds / 60))
+
+
+@bot.message_handler(commands=['profile_report'], func=lambda message: message.chat.id == chat)
+def profile_report(message):
+    '''Admin command: sending the profiled updates, the functions taking the most time and the stats file'''
+    text, path = profiler.report()
+    for start in range(0, len(text), MESSAGE_LENGTH):
+        admin_reply(message.chat.id, text[start:start + MESSAGE_LENGTH - len(worker_name)])
+    if path is not None:  # for pstats / snakeviz
+        sender.send_document(message.chat.id, read_file(path), visible_file_name='profile.prof')
+
+
+def admin_reply(chat_id, text):
+    """
+    Answering an admin command, named by the worker answering it (see: is_admin_command).
+    :param chat_id: the admin's chat id.
+    :param text: the answer.
+    """
+    sender.send_message(chat_id, worker_name + text)
+
+
+def is_admin_command(update):
+    """
+    :param update: the update as received from Telegram (JSON dict).
+    :return: whether it's one of the ADMIN_COMMANDS, which every worker runs for its own bank / profiler
+             (see: workers.WorkerPool).
+    """
+    message = update.get('message')
+    if message is None or message['chat']['id'] != chat or not message.get('text', '').startswith('/'):
+        return False
+    return message['text'].split()[0][1:].split('@')[0] in ADMIN_COMMANDS
+
+
+def process_update(update):
+    """
+    Handling an update by the bot's handlers, on a dispatcher's worker after its chat's earlier updates (see: dispatch),
+    under the profiler when the admin asked for it (see: start_profile).
+    :param update: telebot Update.
+    """
+    chat_id = dispatch.update_chat_id(update)
+    if profiler.wants(chat_id):
+        profiler.profile(chat_id, update_name(update), telebot.TeleBot.process_new_updates, bot, [update])
+    else:
+        telebot.TeleBot.process_new_updates(bot, [update])
+
+
+def update_name(update):
+    """
+    :param update: telebot Update.
+    :return: the kind of the update and what it asked for, e.g. "callback A:5" (without the users' texts).
+    """
+    if update.callback_query is not None:
+        return "callback " + str(update.callback_query.data)
+    if update.message is not None:
+        text = update.message.text or ""
+        return "message " + (text.split()[0] if text.startswith("/") else update.message.content_type)
+    if update.poll_answer is not None:
+        return "poll_answer"
+    return "update"
 
 
 @bot.message_handler(commands=['start'])
 def start(message):
     '''Welcome message'''
-    bot.send_message(message.chat.id, INITIAL_MESSAGE)
+    sender.send_message(message.chat.id, INITIAL_MESSAGE)
     main_menu(message.chat.id)
 
 
+# __________________drawing questions without repeats_______________________
+
+
+def draw(pool, pool_key, num_samples, user_session=None):
+    """
+    Drawing questions from a pool by the QUESTION_SELECTION strategy: walking the user's shuffled order
+    of the pool so they don't repeat until the user got every question of the pool,
+    or by the user's weights of the pool's questions.
+    :param pool: the questions pool.
+    :param pool_key: the pool's key in the user's cursors / weights.
+    :param num_samples: the number of questions to draw.
+    :param user_session: the user's session, None => independent random draw.
+    :return: indexes in the pool of the drawn questions.
+    """
+    if user_session is None:
+        return bank.draw(len(pool), num_samples)
+    if QUESTION_SELECTION == 'adaptive':
+        weights = user_session.weights.get(pool_key)
+        if weights is None or len(weights) != len(pool):  # no answers yet, every question weighs the same
+            return bank.draw(len(pool), num_samples)
+        return weights.sample(num_samples)
+    cursor = user_session.cursors.get(pool_key)
+    if cursor is None:
+        cursor = user_session.cursors[pool_key] = bank.DrawCursor()
+    return bank.draw(len(pool), num_samples, cursor)
+
+
+def mix_weights(user_session, pool_keys):
+    """
+    :param user_session: the user's session.
+    :param pool_keys: the pools a mix draws from.
+    :return: the weight of drawing from each pool: the mean weight of its questions for the user
+             (adaptive selection), else equal weights.
+    """
+    if QUESTION_SELECTION != 'adaptive' or user_session is None:
+        return [1] * len(pool_keys)
+    return [user_session.weights[pool_key].mean_weight() if pool_key in user_session.weights
+            else bank.WeightTree.BASE_WEIGHT for pool_key in pool_keys]
+
+
+def track_poll(chat_id, poll_message, correct_option_id, asked):
+    """
+    Remembering a sent quiz poll, so the user's answer is scored into their stats and question weights.
+    :param chat_id: the user's chat id.
+    :param poll_message: the sent poll's message.
+    :param correct_option_id: the index of the correct answer.
+    :param asked: the asked question in its pools: [(pool key, index, pool size)],
+                  the first is the pool it was drawn from.
+    """
+    if poll_message is not None:
+        open_polls.add(poll_message.poll.id, (chat_id, correct_option_id, asked))
+
+
 # __________________English questions functions_______________________
 
 
-def eng_built(chat_id, num_samples=1, qtype="eng_com"):
+def eng_built(user_session, num_samples=1, qtype="eng_com"):
     """
-    Sending English sentences completion / rephrase questions.
-    :param chat_id: the user's chat id to send the message to.
+    English sentences completion / rephrase questions.
+    :param user_session: the user's session.
     :param num_samples: the number of questions to send.
+    :return: the questions' batch (see: send_batch).
     """
-    question, options, correct_option_id = get_rand_sample_info_eng_built(num_samples=num_samples, qtype=qtype)
-    for i in range(num_samples):
-        bot.send_message(chat_id, "Question:\n" + question[i] + "\n\nAnswers:" +
-                         "\n\n 1: " + options[i][0] +
-                         "\n\n 2: " + options[i][1] +
-                         "\n\n 3: " + options[i][2] +
-                         "\n\n 4: " + options[i][3])
-        bot.send_poll(int(chat_id),
-                      type='quiz',
-                      question="Choose the correct answer",
-                      options=["1", "2", "3", "4"],
-                      correct_option_id=correct_option_id[i],
-                      is_anonymous=False)
+    question, options, correct_option_id, asked = get_rand_sample_info_eng_built(
+        num_samples=num_samples, qtype=qtype, user_session=user_session)
+    return [('quiz', question[i], options[i], correct_option_id[i], asked[i]) for i in range(num_samples)]
 
 
+def send_quiz(chat_id, question, options, correct_option_id):
+    """
+    Sending a question with its answers in as few calls as Telegram's poll limits allow:
+    a single quiz poll with the answers as its options, or else with the answers numbered in the poll's question.
+    A question too long for a poll is sent as a message, answered by a numbered quiz poll replying to it.
+    A job's part (see: outbound.OutboundQueue.run).
+    :param chat_id: the user's chat id to send the question to.
+    :param question: the question's text.
+    :param options: the 4 answers.
+    :param correct_option_id: the index of the correct answer.
+    :return: the poll's message.
+    """
+    options = [option.strip() for option in options]
+    if len(question) <= POLL_QUESTION_LENGTH and all(len(option) <= POLL_OPTION_LENGTH for option in options):
+        return (yield calls.send_poll(int(chat_id), type='quiz', question=question, options=options,
+                                      correct_option_id=correct_option_id, is_anonymous=False))
+
+    numbered = question + "\n" + "".join("\n{}: {}".format(i + 1, option) for i, option in enumerate(options))
+    if len(numbered) <= POLL_QUESTION_LENGTH:
+        return (yield calls.send_poll(int(chat_id), type='quiz', question=numbered, options=NUMBERED_OPTIONS,
+                                      correct_option_id=correct_option_id, is_anonymous=False))
 
-def get_rand_sample_info_eng_built(num_samples=1, qtype="eng_com"):
+    message = yield calls.send_message(chat_id, "Question:\n" + question + "\n\nAnswers:" +
+                                       "".join("\n\n {}: {}".format(i + 1, option) for i, option in enumerate(options)))
+    return (yield calls.send_poll(int(chat_id), type='quiz', question="Choose the correct answer",
+                                  options=NUMBERED_OPTIONS, correct_option_id=correct_option_id, is_anonymous=False,
+                                  reply_to_message_id=message.message_id))
+
+
+@metrics.timed(generator_seconds, generator='eng_built')
+def get_rand_sample_info_eng_built(num_samples=1, qtype="eng_com", user_session=None):
     """
     Generating English sentences completion / rephrase questions.
     :param num_samples: the number of questions to send.
-    :return: the question in quiz poll format.
+    :param user_session: the user's session to draw by (see: draw), None => questions may repeat between calls.
+    :return: the question in quiz poll format, and each question's [(pool key, index, pool size)].
     """
-    data = engQuestions.copy()
-    data = data[data['type'] == qtype]
-
-    samples = data.sample(n=num_samples)
+    pool_key, pool = "eng:" + qtype, question_bank.eng_built[qtype]
+    indexes = draw(pool, pool_key, num_samples, user_session)
     question, options, correct_option_id = [], [], []
-    for i in range(num_samples):
-        question.append(samples['question'].iloc[i])
-        options.append([
-            samples['answer1'].iloc[i], samples['answer2'].iloc[i],
-            samples['answer3'].iloc[i], samples['answer4'].iloc[i]
-        ])
-        correct_option_id.append(samples['correct_answer'].iloc[i] - 1)
-    return question, options, correct_option_id
+    for sample_question, sample_options, sample_correct_option_id in (pool[index] for index in indexes):
+        question.append(sample_question)
+        options.append(sample_options)
+        correct_option_id.append(sample_correct_option_id)
+    return question, options, correct_option_id, [[(pool_key, index, len(pool))] for index in indexes]
 
 
-def eng_voc(chat_id, unit, num_samples=1, qtype=0):
+def eng_voc(user_session, unit, num_samples=1, qtype=0):
     """
-    Sending English vocabulary translation questions by unit.
-    :param chat_id: the user's chat id to send the message to.
+    English vocabulary translation questions by unit.
+    :param user_session: the user's session.
     :param unit: the unit which the vocabulary comes from: 0 => all units | other integer => specific unit number.
     :param num_samples: the number of questions to send.
     :param qtype: the direction of translation: 0 => English to Hebrew | 1 => hebrew to english
+    :return: the questions' batch (see: send_batch).
     """
-    question, options, correct_option_id = get_rand_sample_info_eng_voc(qtype=qtype,
-                                                                        unit=unit, num_samples=num_samples)
-    for i in range(num_samples):
-        bot.send_poll(int(chat_id),
-                      type='quiz',
-                      question=question[i],
-                      options=[options[i][0], options[i][1], options[i][2], options[i][3]],
-                      correct_option_id=correct_option_id[i],
-                      is_anonymous=False)
+    question, options, correct_option_id, asked = get_rand_sample_info_eng_voc(
+        qtype=qtype, unit=unit, num_samples=num_samples, user_session=user_session)
+    return [('quiz', question[i], options[i], correct_option_id[i], asked[i]) for i in range(num_samples)]
 
 
-def get_rand_sample_info_eng_voc(unit, num_samples=1, qtype=0):
+@metrics.timed(generator_seconds, generator='eng_voc')
+def get_rand_sample_info_eng_voc(unit, num_samples=1, qtype=0, user_session=None):
     """
     Generating English vocabulary translation questions by unit.
     :param unit: the unit which the vocabulary comes from: 0 => all units | other integer => specific unit number.
     :param num_samples: the number of questions to send.
     :param qtype: the direction of translation: 0 => English to Hebrew | 1 => hebrew to english.
-    :return: the question in quiz poll format.
+    :param user_session: the user's session to draw by (see: draw), None => words may repeat between calls.
+    :return: the question in quiz poll format, and each question's [(pool key, index, pool size)].
     """
-    data = engVoc.copy()
-    col_names = ('english', 'hebrew')
-
-    if qtype == 0:
-        main, secondary = col_names
-    else:
-        main, secondary = col_names[::-1]
-
-    if unit != 0:
-        data = data[data['unit'] == unit]
-
-    valid_sample = False
-    for i in range(3):
-        samples = data.sample(n=4 * num_samples)
-        if samples['english'].nunique() == 4 * num_samples:
-            valid_sample = True
-            break
-
-    if not valid_sample:
-        samples = data.groupby(
-            col_names[0]).apply(lambda df: df.sample(1)).sample(n=4 * num_samples)
-    options = samples[secondary].to_list()
-    options = [options[i:i + 4] for i in range(0, len(options), 4)]
+    # distinct english words, so words drawn without replacement are always different options
+    current_bank = question_bank  # the same bank for the whole draw, even if it is reloaded meanwhile
+    words = current_bank.voc[unit]
+    asked = draw(words, "voc:" + str(unit), num_samples, user_session)
+    distractors = [index for index in random.sample(range(len(words)), 4 * num_samples) if index not in asked]
     correct_option_id = [random.randint(0, 3) for i in range(num_samples)]
-    question = ["Choose the correct translation of the word:\n" + str(samples[main].iloc[index * 4 + i]) for index,
-                                                                                                             i in
-                enumerate(correct_option_id)]
-    return question, options, correct_option_id
+    question, options = [], []
+    for index, correct in enumerate(correct_option_id):
+        option_indexes = distractors[index * 3:index * 3 + 3]
+        option_indexes.insert(correct, asked[index])
+        pairs = [(words[i][0], random.choice(words[i][1])) for i in option_indexes]
+        if qtype == 0:
+            question.append("Choose the correct translation of the word:\n" + pairs[correct][0])
+            options.append([hebrew for english, hebrew in pairs])
+        else:
+            question.append("Choose the correct translation of the word:\n" + pairs[correct][1])
+            options.append([english for english, hebrew in pairs])
+    return question, options, correct_option_id, [voc_pools(current_bank, unit, words[index][0]) for index in asked]
+
+
+def voc_pools(current_bank, unit, english):
+    """
+    :param current_bank: the QuestionBank the word was drawn from.
+    :param unit: the unit the word was asked from, 0 => all units.
+    :param english: the asked word.
+    :return: the word in the pools its answer weighs on, the asked unit and all units
+             (or every unit of the word when asked from all units): [(pool key, index, pool size)].
+    """
+    positions = current_bank.voc_positions[english]
+    units = positions if unit == 0 else (unit, 0)
+    return [("voc:" + str(word_unit), positions[word_unit], len(current_bank.voc[word_unit])) for word_unit in units]
 
 
-def mix_voc(chat_id, unit, num_samples=1):
+def mix_voc(user_session, unit, num_samples=1):
     """
     Generating a random translation direction (Hebrew->English or English->Hebrew).
-    :param chat_id: the user's chat id to send the message to.
+    :param user_session: the user's session.
     :param unit: the unit which the vocabulary comes from: 0 => all units | other integer => specific unit number.
     :param num_samples: the number of questions to send.
+    :return: the questions' batch (see: send_batch).
     """
     random_list = [random.randint(0, 1) for i in range(num_samples)]
     x, y = random_list.count(0), random_list.count(1)
 
+    batch = []
     if x != 0:
-        eng_voc(chat_id, unit, x, 0)
+        batch += eng_voc(user_session, unit, x, 0)
     if y != 0:
-        eng_voc(chat_id, unit, y, 1)
+        batch += eng_voc(user_session, unit, y, 1)
+    return batch
 
 
-def eng_full_mix(chat_id, num_samples=1):
+def eng_full_mix(user_session, num_samples=1):
     """
-    Sending random English questions: translation, sentence completion / rephrase.
-    :param chat_id: the user's chat id to send the message to.
+    Random English questions: translation, sentence completion / rephrase.
+    :param user_session: the user's session.
     :param num_samples: the number of questions to send.
+    :return: the questions' batch (see: send_batch).
     """
-    random_list = [random.randint(0, 3) for i in range(num_samples)]
+    random_list = random.choices(range(4), k=num_samples, weights=mix_weights(
+        user_session, ("eng:eng_com", "voc:0", "voc:0", "eng:eng_rephrase")))
     x, y, z, t = random_list.count(0), random_list.count(1), random_list.count(2), random_list.count(3)
 
+    batch = []
     if x != 0:
-        eng_built(chat_id, x, "eng_com")
+        batch += eng_built(user_session, x, "eng_com")
     if y != 0:
-        eng_voc(chat_id, 0, y, 0)
+        batch += eng_voc(user_session, 0, y, 0)
     if z != 0:
-        eng_voc(chat_id, 0, z, 1)
+        batch += eng_voc(user_session, 0, z, 1)
     if t != 0:
-        eng_built(chat_id, t, "eng_rephrase")
+        batch += eng_built(user_session, t, "eng_rephrase")
+    return batch
 
-def math_built(chat_id, num_samples=1, qtype="math_alg"):
+def math_built(user_session, num_samples=1, qtype="math_alg"):
     """
-    Sending math questions as photos.
-    :param chat_id: the user's chat id to send the message to.
+    Math questions, sent as photos.
+    :param user_session: the user's session.
     :param num_samples: the number of questions to send.
+    :return: the questions' batch (see: send_batch).
     """
-    question, correct_option_id = get_rand_sample_info_math_built(num_samples=num_samples, qtype=qtype)
-    for i in range(num_samples):
-        photo = open(question[i], 'rb')
-        bot.send_photo(chat_id, photo)
-        bot.send_poll(int(chat_id),
-                      type='quiz',
-                      question="Choose the correct answer",
-                      options=["1", "2", "3", "4"],
-                      correct_option_id=correct_option_id[i],
-                      is_anonymous=False)
+    question, correct_option_id, asked = get_rand_sample_info_math_built(num_samples=num_samples, qtype=qtype,
+                                                                         user_session=user_session)
+    return [('photos', question, [photo_cache.get(photo_path) for photo_path in question], correct_option_id, asked)]
 
 
-def get_rand_sample_info_math_built(num_samples=1, qtype="math_alg"):
+def send_math_questions(chat_id, question, file_ids, correct_option_id, asked):
+    """
+    Sending math questions as albums of up to 10 numbered photos, each album followed by the quiz polls of its photos.
+    A job's part (see: outbound.OutboundQueue.run).
+    :param chat_id: the user's chat id to send the message to.
+    :param question: paths of the questions' photos.
+    :param file_ids: the file_id of each photo when it was prepared, None for the photos not uploaded then.
+    :param correct_option_id: the index of the correct answer of each question.
+    :param asked: each question's [(pool key, index, pool size)] (see: track_poll).
+    """
+    for start in range(0, len(question), MEDIA_GROUP_SIZE):
+        album = question[start:start + MEDIA_GROUP_SIZE]
+        if len(album) == 1:
+            yield from send_cached_photo(chat_id, album[0], file_ids[start])
+        else:
+            yield from send_cached_album(chat_id, album, file_ids[start:start + MEDIA_GROUP_SIZE])
+        for i in range(start, start + len(album)):
+            poll_message = yield calls.send_poll(int(chat_id),
+                                                 type='quiz',
+                                                 question="Choose the correct answer" if len(album) == 1
+                                                 else "Question {}: choose the correct answer".format(i - start + 1),
+                                                 options=NUMBERED_OPTIONS,
+                                                 correct_option_id=correct_option_id[i],
+                                                 is_anonymous=False)
+            track_poll(chat_id, poll_message, correct_option_id[i], asked[i])
+
+
+def send_cached_photo(chat_id, photo_path, file_id=None):
+    """
+    Sending a photo by the file_id of its first upload, uploading it only if it wasn't uploaded before.
+    A job's part (see: outbound.OutboundQueue.run).
+    :param chat_id: the user's chat id to send the photo to.
+    :param photo_path: path to the photo file.
+    :param file_id: the photo's file_id if it was already looked up, None => looking it up.
+    """
+    file_id = file_id or photo_cache.get(photo_path)
+    if file_id:
+        try:
+            yield calls.send_photo(chat_id, file_id)
+            return
+        except ApiTelegramException:  # the file_id is not valid anymore
+            photo_cache.discard(photo_path)
+
+    message = yield calls.send_photo(chat_id, read_file(photo_path))
+    photo_cache.set(photo_path, message.photo[-1].file_id)
+
+
+def send_cached_album(chat_id, photo_paths, file_ids=None):
+    """
+    Sending 2-10 photos as one album, numbered by their captions. The photos uploaded before are sent by file_id.
+    A job's part (see: outbound.OutboundQueue.run).
+    :param chat_id: the user's chat id to send the album to.
+    :param photo_paths: paths to the photo files.
+    :param file_ids: the photos' file_ids if they were already looked up (None for the ones not found).
+    """
+    file_ids = [file_id or photo_cache.get(photo_path)
+                for photo_path, file_id in zip(photo_paths, file_ids or [None] * len(photo_paths))]
+    try:
+        messages = yield calls.send_media_group(chat_id, album_media(photo_paths, file_ids))
+    except ApiTelegramException:
+        if not any(file_ids):
+            raise
+        for photo_path, file_id in zip(photo_paths, file_ids):  # one of the file_ids is not valid anymore
+            if file_id:
+                photo_cache.discard(photo_path)
+        file_ids = [None] * len(photo_paths)
+        messages = yield calls.send_media_group(chat_id, album_media(photo_paths, file_ids))
+
+    for photo_path, file_id, message in zip(photo_paths, file_ids, messages):
+        if not file_id:
+            photo_cache.set(photo_path, message.photo[-1].file_id)
+
+
+def album_media(photo_paths, file_ids):
+    """
+    :param photo_paths: paths to the photo files.
+    :param file_ids: the file_id of each photo, None for the photos to upload.
+    :return: the album's InputMediaPhoto list, captioned by the photos' numbers.
+    """
+    return [types.InputMediaPhoto(file_id or read_file(photo_path), caption=str(i + 1))
+            for i, (photo_path, file_id) in enumerate(zip(photo_paths, file_ids))]
+
+
+def read_file(path):
+    """
+    :param path: path to the file.
+    :return: the file's content, sent as bytes so a retried upload sends it whole again.
+    """
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+@metrics.timed(generator_seconds, generator='math_built')
+def get_rand_sample_info_math_built(num_samples=1, qtype="math_alg", user_session=None):
     """
     Generating math problems/algebra/geomtery questions.
     :param num_samples: the number of questions to send.
-    :return: the question in quiz poll format.
+    :param user_session: the user's session to draw by (see: draw), None => questions may repeat between calls.
+    :return: the question in quiz poll format, and each question's [(pool key, index, pool size)].
     """
-    data = mathQuestions.copy()
-    data = data[data['type'] == qtype]
-
-    samples = data.sample(n=num_samples)
+    pool_key, pool = "math:" + qtype, question_bank.math_built[qtype]
+    indexes = draw(pool, pool_key, num_samples, user_session)
     question, correct_option_id = [], []
-    for i in range(num_samples):
-        question.append(samples['question_dir'].iloc[i])
-        correct_option_id.append(samples['correct_answer'].iloc[i] - 1)
-    return question, correct_option_id
+    for question_dir, sample_correct_option_id in (pool[index] for index in indexes):
+        question.append(question_dir)
+        correct_option_id.append(sample_correct_option_id)
+    return question, correct_option_id, [[(pool_key, index, len(pool))] for index in indexes]
 
-def math_full_mix(chat_id, num_samples=1):
+def math_full_mix(user_session, num_samples=1):
     """
-    Sending random math questions: algebra, geometry and problems.
-    :param chat_id: the user's chat id to send the message to.
+    Random math questions: algebra, geometry and problems.
+    :param user_session: the user's session.
     :param num_samples: the number of questions to send.
+    :return: the questions' batch (see: send_batch).
+    """
+    qtypes = ("math_alg", "math_geo", "math_prob")
+    random_list = random.choices(range(3), k=num_samples,
+                                 weights=mix_weights(user_session, ["math:" + qtype for qtype in qtypes]))
+    question, correct_option_id, asked = [], [], []
+    for index, qtype in enumerate(qtypes):
+        if random_list.count(index) != 0:
+            type_question, type_correct_option_id, type_asked = get_rand_sample_info_math_built(
+                random_list.count(index), qtype, user_session)
+            question += type_question
+            correct_option_id += type_correct_option_id
+            asked += type_asked
+    return [('photos', question, [photo_cache.get(photo_path) for photo_path in question], correct_option_id, asked)]
+
+def all_full_mix(user_session):
+    """
+    Random questions of all subjects (currently without hebrew).
+    :param user_session: the user's session.
+    :return: the questions' batch (see: send_batch).
     """
-    random_list = [random.randint(0, 2) for i in range(num_samples)]
-    x, y, z = random_list.count(0), random_list.count(1), random_list.count(2)
+    return eng_full_mix(user_session, num_samples=10) + math_full_mix(user_session, num_samples=10)
 
-    if x != 0:
-        math_built(chat_id, x, "math_alg")
-    if y != 0:
-        math_built(chat_id, y, "math_geo")
-    if z != 0:
-        math_built(chat_id, z, "math_prob")
 
-def all_full_mix(chat_id):
+def send_batch(chat_id, batch):
     """
-    Sending random questions of all subjects (currently without hebrew).
-    :param chat_id: the user's chat id to send the message to.
+    Sending a batch of questions, each step of the batch is one of:
+    ('quiz', question, options, correct option id, asked) => a quiz with its answers (see: send_quiz)
+    ('photos', photo paths, file_ids, correct option ids, asked) => math questions (see: send_math_questions)
+    A job's part (see: outbound.OutboundQueue.run).
+    :param chat_id: the user's chat id to send the questions to.
+    :param batch: the prepared questions.
     """
-    eng_full_mix(chat_id,num_samples=10)
-    math_full_mix(chat_id, num_samples=10)
+    for step in batch:
+        if step[0] == 'quiz':
+            kind, question, options, correct_option_id, asked = step
+            poll_message = yield from send_quiz(chat_id, question, options, correct_option_id)
+            track_poll(chat_id, poll_message, correct_option_id, asked)
+        else:
+            yield from send_math_questions(chat_id, *step[1:])
+
+
+def batch_bytes(batch):
+    """
+    :param batch: a prepared batch of questions (see: send_batch).
+    :return: rough estimate of the batch's memory in bytes.
+    """
+    size = 0
+    for step in batch:
+        texts = [step[1], *step[2]] if step[0] == 'quiz' else [*step[1], *filter(None, step[2])]
+        size += 200 * len(step[-1]) + sum(len(text) for text in texts)
+    return size
 
 # _______________________________menus_________________________________
-def main_menu(chat_id):
+# A menu tapped on is edited into the next menu, so a chat keeps a single menu with live buttons,
+# the menus after /start, a text message or a batch of questions are sent as new messages.
+
+
+def show_menu(chat_id, text, markup, message_id=None):
+    """
+    Showing a menu by editing the tapped menu's message into it, or sending it as a new message,
+    after the chat's queued messages (see: send_menu).
+    :param chat_id: the user's chat id.
+    :param text: the menu's text.
+    :param markup: the menu's prebuilt keyboard (see: keyboards).
+    :param message_id: the tapped menu's message, None => sending a new message.
+    """
+    sender.run(chat_id, send_menu(chat_id, text, markup, message_id))
+
+
+def send_menu(chat_id, text, markup, message_id=None):
+    """
+    The job showing a menu (see: outbound.OutboundQueue.run), its parameters are show_menu's.
+    A menu sent as a new message becomes the user's live menu, the buttons of the menu it replaces are removed
+    (and taps on them are dropped, see: callback).
+    """
+    if message_id is not None:
+        try:
+            yield calls.edit_message_text(text, chat_id=chat_id, message_id=message_id, reply_markup=markup)
+            user_session = users_sessions.get(chat_id)
+            if user_session is not None:  # the same buttons may be shown again, they're new taps (see: callback)
+                user_session.menu_edits += 1
+            return
+        except ApiTelegramException as e:
+            if 'message is not modified' in str(e.description):  # the message already shows the menu
+                return
+            # else the message can't be edited anymore (e.g. deleted), sending the menu instead
+    message = yield calls.send_message(chat_id, text, reply_markup=markup)
+    user_session = users_sessions.get(chat_id)
+    if user_session is None:
+        return
+    replaced, user_session.menu_message_id = user_session.menu_message_id, message.message_id
+    users_sessions.save(chat_id)
+    if replaced is not None and 0 < replaced < message.message_id:  # (a tap may have recorded this menu already)
+        yield from close_menu(chat_id, replaced)
+
+
+def main_menu(chat_id, message_id=None):
     """
     The main menu(1): here the user can select which subject to practice.
     :param chat_id: user's chat id
+    :param message_id: the tapped menu's message to edit into this menu, None => a new message.
     """
-    # print(json.dumps(MenuAnswer(MenuType.MAIN, MenuType.ENGLISH),indent=1, cls=MenuAnswerEncoder))
-    btn_1 = types.InlineKeyboardButton('אנגלית',
-                                       callback_data=json.dumps(MenuAnswer(MenuType.MAIN, MenuType.ENGLISH), indent=1,
-                                                                cls=MenuAnswerEncoder))
-    btn_2 = types.InlineKeyboardButton('עברית',
-                                       callback_data=json.dumps(MenuAnswer(MenuType.MAIN, MenuType.HEBREW), indent=1,
-                                                                cls=MenuAnswerEncoder))
-    btn_3 = types.InlineKeyboardButton('חשבון',
-                                       callback_data=json.dumps(MenuAnswer(MenuType.MAIN, MenuType.MATH), indent=1,
-                                                                cls=MenuAnswerEncoder))
-    btn_4 = types.InlineKeyboardButton('הכל', callback_data=json.dumps(MenuAnswer(MenuType.MAIN, MenuType.COMBINATION),
-                                                                       indent=1, cls=MenuAnswerEncoder))
-    a = [[btn_1], [btn_2, btn_3], [btn_4]]
-    buttons = types.InlineKeyboardMarkup(a)
-    bot.send_message(chat_id,
-                     "Which subject do you want to learn?",
-                     reply_markup=buttons)
-
-
-def english_main_menu(chat_id):
+    show_menu(chat_id, "Which subject do you want to learn?", keyboards.MAIN_MENU, message_id)
+
+
+def english_main_menu(chat_id, message_id=None):
     """
     English main menu(3): here the user can select which type of English questions he wants.
     :param chat_id: the user's chat id.
-    :param selection_status: current route of selection as described above (see: format_menu_callback).
-    """
-    btn_1 = types.InlineKeyboardButton('תרגום אוצר מילים',
-                                       callback_data=json.dumps(MenuAnswer(MenuType.ENGLISH, MenuType.ENG_VOC),
-                                                                indent=1, cls=MenuAnswerEncoder))
-
-    btn_2 = types.InlineKeyboardButton('השלמת משפטים',
-                                       callback_data=json.dumps(MenuAnswer(MenuType.ENGLISH, QuestionType.ENG_COM),
-                                                                indent=1, cls=MenuAnswerEncoder))
-
-    btn_3 = types.InlineKeyboardButton('ערבוב תרגילים',
-                                       callback_data=json.dumps(MenuAnswer(MenuType.ENGLISH, QuestionType.ENG_MIX),
-                                                                indent=1, cls=MenuAnswerEncoder))
-
-    btn_4 = types.InlineKeyboardButton('ניסוח משפט מחדש',
-                                       callback_data=json.dumps(
-                                           MenuAnswer(MenuType.ENGLISH, QuestionType.ENG_REPHRASE), indent=1,
-                                           cls=MenuAnswerEncoder))
-
-    a = [[btn_1, btn_2], [btn_3, btn_4]]
-    buttons = types.InlineKeyboardMarkup(a)
-    bot.send_message(chat_id, "What do you want to do?", reply_markup=buttons)
-
-
-def english_voc_menu(chat_id):
-    """
-      English vocabulary menu(7): here the user can select the language direction of translation.
-      :param chat_id: the user's chat id.
-      :param selection_status: current route of selection as described above (see: format_menu_callback).
-      """
-    btn_1 = types.InlineKeyboardButton(
-        'תרגום אגנלית לעברית',
-        callback_data=json.dumps(MenuAnswer(MenuType.ENG_VOC, QuestionType.ENG_VOC_ENG), indent=1,
-                                 cls=MenuAnswerEncoder))
-    btn_2 = types.InlineKeyboardButton(
-        'תרגום עברית לאנגלית',
-        callback_data=json.dumps(MenuAnswer(MenuType.ENG_VOC, QuestionType.ENG_VOC_HEB), indent=1,
-                                 cls=MenuAnswerEncoder))
-    btn_3 = types.InlineKeyboardButton(
-        'תרגום אנגלית <-> עברית',
-        callback_data=json.dumps(MenuAnswer(MenuType.ENG_VOC, QuestionType.ENG_VOC_MIX), indent=1,
-                                 cls=MenuAnswerEncoder))
-    a = [[btn_1, btn_2], [btn_3]]
-    buttons = types.InlineKeyboardMarkup(a)
-    bot.send_message(chat_id,
-                     "Choose translate direction",
-                     reply_markup=buttons)
-
-def math_main_menu(chat_id):
-    """
-    Math main menu(3): here the user can select which type of math questions he wants.
-    :param chat_id: the user's chat id.
-    :param selection_status: current route of selection as described above (see: format_menu_callback).
+    :param message_id: the tapped menu's message to edit into this menu, None => a new message.
     """
-    btn_1 = types.InlineKeyboardButton('אלגברה',
-                                       callback_data=json.dumps(MenuAnswer(MenuType.MATH, QuestionType.MATH_ALGEBRA),
-                                                                indent=1, cls=MenuAnswerEncoder))
+    show_menu(chat_id, "What do you want to do?", keyboards.ENGLISH_MAIN_MENU, message_id)
 
-    btn_2 = types.InlineKeyboardButton('גאומטריה',
-                                       callback_data=json.dumps(MenuAnswer(MenuType.MATH, QuestionType.MATH_GEOMETRY),
-                                                                indent=1, cls=MenuAnswerEncoder))
 
-    btn_3 = types.InlineKeyboardButton('בעיות מילוליות',
-                                       callback_data=json.dumps(MenuAnswer(MenuType.MATH, QuestionType.MATH_PROBLEM),
-                                                                indent=1, cls=MenuAnswerEncoder))
+def english_voc_menu(chat_id, message_id=None):
+    """
+    English vocabulary menu(7): here the user can select the language direction of translation.
+    :param chat_id: the user's chat id.
+    :param message_id: the tapped menu's message to edit into this menu, None => a new message.
+    """
+    show_menu(chat_id, "Choose translate direction", keyboards.ENGLISH_VOC_MENU, message_id)
 
-    btn_4 = types.InlineKeyboardButton('ערבוב תרגילים',
-                                       callback_data=json.dumps(
-                                           MenuAnswer(MenuType.MATH, QuestionType.MATH_MIX), indent=1,
-                                           cls=MenuAnswerEncoder))
 
-    a = [[btn_1, btn_2], [btn_3, btn_4]]
-    buttons = types.InlineKeyboardMarkup(a)
-    bot.send_message(chat_id, "What do you want to do?", reply_markup=buttons)
+def math_main_menu(chat_id, message_id=None):
+    """
+    Math main menu(3): here the user can select which type of math questions he wants.
+    :param chat_id: the user's chat id.
+    :param message_id: the tapped menu's message to edit into this menu, None => a new message.
+    """
+    show_menu(chat_id, "What do you want to do?", keyboards.MATH_MAIN_MENU, message_id)
 
 
-def unit_num_menu(chat_id):
+def unit_num_menu(chat_id, message_id=None):
     """
     Unit number menu(8): here the user can select from which unit in the DB the questions will be generated.
     :param chat_id: the user's chat id.
-    :param selection_status: current route of selection as described above (see: format_menu_callback).
-    """
-
-    a = []
-    num_of_units = 10
-    all_units_btn = types.InlineKeyboardButton(
-        "הכל",
-        callback_data=json.dumps(MenuAnswer(MenuType.UNIT, Unit.COMBINATION), indent=1, cls=MenuAnswerEncoder))
-    for i in range(num_of_units // 3):  # known that there are more than 3
-        btn_1 = types.InlineKeyboardButton(3 * i + 1,
-                                           callback_data=json.dumps(MenuAnswer(MenuType.UNIT, Unit(str(3 * i + 1))),
-                                                                    indent=1, cls=MenuAnswerEncoder))
-        btn_2 = types.InlineKeyboardButton(3 * i + 2,
-                                           callback_data=json.dumps(MenuAnswer(MenuType.UNIT, Unit(str(3 * i + 2))),
-                                                                    indent=1, cls=MenuAnswerEncoder))
-        btn_3 = types.InlineKeyboardButton(3 * i + 3,
-                                           callback_data=json.dumps(MenuAnswer(MenuType.UNIT, Unit(str(3 * i + 3))),
-                                                                    indent=1, cls=MenuAnswerEncoder))
-        a.append([btn_1, btn_2, btn_3])
-
-    if (num_of_units % 3) == 0:
-        a.append([all_units_btn])
-
-    if (num_of_units % 3) == 2:
-        btn_1 = types.InlineKeyboardButton(
-            num_of_units - 1,
-            callback_data=json.dumps(MenuAnswer(MenuType.UNIT, Unit(str(num_of_units - 1))), indent=1,
-                                     cls=MenuAnswerEncoder))
-
-        btn_2 = types.InlineKeyboardButton(
-            num_of_units,
-            callback_data=json.dumps(MenuAnswer(MenuType.UNIT, Unit(str(num_of_units))), indent=1,
-                                     cls=MenuAnswerEncoder))
-        a.append([btn_1, btn_2, all_units_btn])
-
-    if (num_of_units % 3) == 1:
-        btn_1 = types.InlineKeyboardButton(
-            num_of_units,
-            callback_data=json.dumps(MenuAnswer(MenuType.UNIT, Unit(str(num_of_units))), indent=1,
-                                     cls=MenuAnswerEncoder))
-
-        a.append([btn_1, all_units_btn])
-
-    buttons = types.InlineKeyboardMarkup(a)
-    bot.send_message(chat_id,
-                     "Please choose unit number:",
-                     reply_markup=buttons)
-
-
-def amount_menu(chat_id):
+    :param message_id: the tapped menu's message to edit into this menu, None => a new message.
+    """
+    show_menu(chat_id, "Please choose unit number:", keyboards.UNIT_NUM_MENU, message_id)
+
+
+def amount_menu(chat_id, message_id=None):
     """
     amount menu(9): here the user can select how many questions will be generated.
     :param chat_id: the user's chat id.
-    :param selection_status: current route of selection as described above (see: format_menu_callback).
-    """
-    btn_1 = types.InlineKeyboardButton(text='1',
-                                       callback_data=json.dumps(MenuAnswer(MenuType.AMOUNT, AmountQuestion.ONE),
-                                                                indent=1, cls=MenuAnswerEncoder))
-    btn_2 = types.InlineKeyboardButton(text='5',
-                                       callback_data=json.dumps(MenuAnswer(MenuType.AMOUNT, AmountQuestion.FIVE),
-                                                                indent=1, cls=MenuAnswerEncoder))
-    btn_3 = types.InlineKeyboardButton(text='10',
-                                       callback_data=json.dumps(MenuAnswer(MenuType.AMOUNT, AmountQuestion.TEN),
-                                                                indent=1, cls=MenuAnswerEncoder))
-    empty_button = types.InlineKeyboardButton('בהצלחה \uE404',
-                                              callback_data="null")
-    a = [[btn_1, btn_2, btn_3], [empty_button]]
-    buttons = types.InlineKeyboardMarkup(a)
-    bot.send_message(chat_id,
-                     "How many questions do you want?",
-                     reply_markup=buttons)
-
-def repeat_menu(chat_id):
+    :param message_id: the tapped menu's message to edit into this menu, None => a new message.
+    """
+    show_menu(chat_id, "How many questions do you want?", keyboards.AMOUNT_MENU, message_id)
+
+
+def repeat_menu(chat_id, message_id=None):
     """
     repeat menu(2): here the user can select either to go back the to main menu or run his last selection again.
     :param chat_id: the user's chat id.
-    :param selection_status: current route of selection as described above (see: format_menu_callback).
+    :param message_id: the tapped menu's message to edit into this menu, None => a new message.
     """
-    btn_1 = types.InlineKeyboardButton(text='תפריט',
-                                       callback_data=json.dumps(MenuAnswer(MenuType.REPEAT, MenuType.MAIN), indent=1,
-                                                                cls=MenuAnswerEncoder))
-    btn_2 = types.InlineKeyboardButton(text='שוב פעם',
-                                       callback_data=json.dumps(MenuAnswer(MenuType.REPEAT, QuestionType.REPEAT),
-                                                                indent=1, cls=MenuAnswerEncoder))
-    a = [[btn_1], [btn_2]]
-    buttons = types.InlineKeyboardMarkup(a)
-    bot.send_message(chat_id, "Again or Menu?", reply_markup=buttons)
+    show_menu(chat_id, "Again or Menu?", keyboards.REPEAT_MENU, message_id)
+
+
+def close_menu(chat_id, message_id):
+    """
+    Removing the buttons of the tapped menu, when the menu after it is sent below the questions.
+    A job's part (see: outbound.OutboundQueue.run).
+    :param chat_id: the user's chat id.
+    :param message_id: the tapped menu's message, None => nothing to remove.
+    """
+    if message_id is None:
+        return
+    user_session = users_sessions.get(chat_id)
+    if user_session is not None and user_session.menu_message_id == message_id:
+        user_session.menu_message_id = -message_id  # the messages after it are live (see: stale_menu)
+    try:
+        yield calls.edit_message_reply_markup(chat_id, message_id)
+    except ApiTelegramException:  # already without buttons, or can't be edited anymore
+        pass
 
 
 # _______________________handling user's selections (callbacks)_________________________
 
 @bot.callback_query_handler(func=lambda call: True)
+@metrics.timed(handler_seconds, handler_errors, handler='callback')
 def callback(call):
     """
     Catching user's action and calling the next function / menu accordingly.
+    The callback was acknowledged when it was received (see: acknowledge), a repeated tap is dropped
+    and so is a tap on a menu which isn't the user's live menu anymore (see: send_menu).
     :param call: the user's last action
     """
     chat_id = call.message.chat.id
     curr_session = users_sessions.get(chat_id)
+    edits = curr_session.menu_edits if curr_session else 0
+    if callback_guard.duplicate(chat_id, call.message.message_id, call.data, edits):
+        return
     if not curr_session:  # In case its an new user, adding another user to user_sessions
-        users_sessions[chat_id] = session.Session()
-        curr_session = users_sessions[chat_id]
-        bot.send_message(chat,call.message.chat)
+        curr_session = session.Session()
+        curr_session.menu_message_id = call.message.message_id
+        users_sessions[chat_id] = curr_session
+        new_users_digest.add(call.message.chat)  # sent to the admin in the next digest, off this handler
+    elif stale_menu(curr_session, call.message.message_id):
+        callbacks.duplicates.inc(reason='stale')
+        return
 
-    call_data = json.loads(call.data)
-    menu_answer = MenuAnswer.create_from_call_back(call_data)
-    make_action(menu_answer, chat_id)
+    menu_answer = MenuAnswer.decode(call.data)
+    if menu_answer is None:  # a button which isn't a menu answer
+        return
+    make_action(menu_answer, chat_id, call.message.message_id)
 
 
-def make_action(menu_answer, chat_id):
+def stale_menu(user_session, message_id):
     """
-    Change the current session of specific user according to his menu answer
-    :param menu_answer: MenuAnswer object which represents the last answer of user
-    :param chat_id: User id
+    :param user_session: the user's session.
+    :param message_id: the tapped menu's message.
+    :return: whether the menu was replaced by a newer menu or closed (see: send_menu, close_menu).
+             A menu newer than the recorded one is live, its send may not have been recorded yet.
     """
+    live = user_session.menu_message_id
+    if live is None:  # not recorded (e.g. a session from before the menus were recorded)
+        return False
+    return message_id <= -live if live < 0 else message_id < live
 
-    # _____navigation through menus________
-
-    user_session = users_sessions.get(chat_id)
-    if menu_answer.option == MenuType.ENGLISH:
-        user_session.subject = MenuType.ENGLISH
-        english_main_menu(chat_id)
-
-    elif menu_answer.option == MenuType.HEBREW:
-        user_session.subject = MenuType.HEBREW
-        bot.send_message(chat_id,"Sorry, this options is currently unavailable. Try another option")
-        main_menu(chat_id)
-
-    elif menu_answer.option == MenuType.MATH:
-        user_session.subject = MenuType.MATH
-        math_main_menu(chat_id)
-
-    elif menu_answer.option == MenuType.COMBINATION:
-        user_session.subject = MenuType.COMBINATION
-        user_session.question_type = QuestionType.FULL_MIX
-        call_questions(chat_id)
 
+def acknowledge(update):
+    """
+    Answering a received callback right away, before it waits behind its chat's updates and sends,
+    so the client stops the button's spinner (see: dispatch.dispatch_updates, workers.WorkerPool).
+    The answers aren't paced by Telegram's sending rates (see: outbound.UNPACED_METHODS).
+    :param update: telebot Update, or the update as received from Telegram (JSON dict).
+    """
+    if isinstance(update, dict):
+        callback_id = update.get('callback_query', {}).get('id')
+    else:
+        callback_id = update.callback_query and update.callback_query.id
+    if callback_id is not None:
+        sender.run(None, answer_callback(callback_id))
 
-    # english_main_menu -> english_voc_menu
-    elif menu_answer.option == MenuType.ENG_VOC:
-        english_voc_menu(chat_id)
-
-    # english_main_menu -> amount_menu (english sentence completion selected)
-    elif menu_answer.option == QuestionType.ENG_COM:
-        user_session.question_type = menu_answer.option
-        amount_menu(chat_id)
-
-    # english_main_menu -> amount_menu (english mix selected)
-    elif menu_answer.option == QuestionType.ENG_MIX:
-        user_session.question_type = menu_answer.option
-        amount_menu(chat_id)
-
-    # english_main_menu -> amount_menu (english rephrase selected)
-    elif menu_answer.option == QuestionType.ENG_REPHRASE:
-        user_session.question_type = menu_answer.option
-        amount_menu(chat_id)
 
-    # english_voc_menu -> unit_menu
-    elif menu_answer.option in (QuestionType.ENG_VOC_HEB,QuestionType.ENG_VOC_ENG,QuestionType.ENG_VOC_MIX):
-        user_session.question_type = menu_answer.option
-        unit_num_menu(chat_id)
+def answer_callback(callback_id):
+    """The job answering a callback query (see: outbound.OutboundQueue.run)."""
+    try:
+        yield calls.answer_callback_query(callback_id)
+    except ApiTelegramException:  # too old to answer (e.g. sent while the bot was down), still handled
+        pass
 
-    # math_menu -> amount_menu
-    elif menu_answer.menu_type == MenuType.MATH:
-        user_session.question_type = menu_answer.option
-        amount_menu(chat_id)
 
-    # unit_menu -> amount menu
-    elif menu_answer.menu_type == MenuType.UNIT:
-        user_session.question_unit = menu_answer.option
-        amount_menu(chat_id)
+@metrics.timed(handler_seconds, handler_errors, handler='make_action')
+def make_action(menu_answer, chat_id, message_id=None):
+    """
+    Change the current session of specific user according to his menu answer
+    (see: MENU_TRANSITIONS) and call the next menu / questions.
+    :param menu_answer: MenuAnswer object which represents the last answer of user
+    :param chat_id: User id
+    :param message_id: the tapped menu's message, edited into the next menu (None => the next menu is sent)
+    """
+    menu_answers.inc(menu=menu_answer.menu_type, option=menu_answer.option)
+    user_session = users_sessions.get(chat_id)
+    mutation, next_action = MENU_TRANSITIONS.get((menu_answer.menu_type, menu_answer.option), (RESET, main_menu))
+    for field, value in mutation.items():
+        setattr(user_session, field, menu_answer.option if value is SELECTED else value)
+    if mutation:
+        users_sessions.save(chat_id)
+        prefetched.discard(chat_id)  # prepared for the previous selection
+    next_action(chat_id, message_id)
 
-    elif menu_answer.menu_type == MenuType.AMOUNT:
-        user_session.question_amount = menu_answer.option
-        call_questions(chat_id)
 
-    elif menu_answer.option == QuestionType.REPEAT:
-        call_questions(chat_id)
+def hebrew_menu(chat_id, message_id=None):
+    """
+    Hebrew is currently unavailable: letting the user know and going back to the main menu.
+    :param chat_id: the user's chat id.
+    :param message_id: the tapped menu's message to edit into the main menu, None => a new message.
+    """
+    show_menu(chat_id, "Sorry, this options is currently unavailable. Try another option\n\n"
+                       "Which subject do you want to learn?", keyboards.MAIN_MENU, message_id)
 
-    else:
-        user_session.subjet = None
-        user_session.question_type = None
-        user_session.question_unit = None
-        user_session.question_amount = None
-        main_menu(chat_id)
 
 # ________calling questions functions_____________
-def call_questions(chat_id):
+@metrics.timed(handler_seconds, handler_errors, handler='call_questions')
+def call_questions(chat_id, message_id=None):
+    """
+    Sending the questions of the user's current selection (see: QUESTION_GENERATORS) and the repeat menu,
+    a chat's batches one at a time (see: callback_guard). The questions are queued to be sent (see: send_questions),
+    the handler returns without waiting for them.
+    :param chat_id: the user's chat id.
+    :param message_id: the tapped menu's message, its buttons are removed (the repeat menu is sent after the questions).
+    """
     user_session = users_sessions.get(chat_id)
-    if user_session.subject == None or user_session.question_type == None:
-        bot.send_message(chat_id, "You didn't select a needed option,"
+    generate = QUESTION_GENERATORS.get((user_session.subject, user_session.question_type))
+    if generate is None:
+        sender.send_message(chat_id, "You didn't select a needed option,"
                                           +" start again and be aware for not skipping any of the menus")
+        repeat_menu(chat_id)
+        return
+
+    if not callback_guard.begin(chat_id):  # the chat's previous batch is still being sent
+        return
+    try:
+        entry = prefetched.pop(chat_id, selection_key(user_session))
+        if entry is None:
+            batch, source = generate(user_session), 'generated'
+        else:
+            (batch, user_session.cursors), source = entry, 'prefetched'
+        users_sessions.save(chat_id)  # the draws moved the user's cursors
+    except Exception:
+        callback_guard.end(chat_id)
+        raise
+    question_batches.inc(subject=user_session.subject, question_type=user_session.question_type, source=source)
+    sender.run(chat_id, send_questions(chat_id, batch, message_id))
+    repeat_menu(chat_id)
+    schedule_prefetch(chat_id)
 
-    if user_session.subject == MenuType.ENGLISH:
-
-        if user_session.question_type == QuestionType.ENG_COM:
-            eng_built(chat_id, int(user_session.question_amount), "eng_com")
-
-        elif user_session.question_type == QuestionType.ENG_MIX:
-            eng_full_mix(chat_id, int(user_session.question_amount))
 
-        elif user_session.question_type == QuestionType.ENG_REPHRASE:
-            eng_built(chat_id, int(user_session.question_amount), "eng_rephrase")
+def send_questions(chat_id, batch, message_id):
+    """
+    The job sending a batch of questions (see: outbound.OutboundQueue.run),
+    the chat's next batch can start once it's done (see: callback_guard).
+    :param chat_id: the user's chat id.
+    :param batch: the prepared questions (see: send_batch).
+    :param message_id: the tapped menu's message, its buttons are removed first (see: close_menu).
+    """
+    try:
+        yield from close_menu(chat_id, message_id)
+        yield from send_batch(chat_id, batch)
+    finally:
+        callback_guard.end(chat_id)
 
-        elif user_session.question_type == QuestionType.ENG_VOC_ENG:
-            eng_voc(chat_id,
-                    int(user_session.question_unit) if user_session.question_unit.isnumeric() else 0,
-                    int(user_session.question_amount), 0)
 
-        elif user_session.question_type == QuestionType.ENG_VOC_HEB:
-            eng_voc(chat_id,
-                    int(user_session.question_unit) if user_session.question_unit.isnumeric() else 0,
-                    int(user_session.question_amount), 1)
+def selection_key(user_session):
+    """
+    :param user_session: the user's session.
+    :return: the user's selection, the questions prepared for one selection aren't used for another.
+             Adaptive draws depend on the user's answers too, a batch drawn before the last answer isn't used.
+    """
+    key = (user_session.subject, user_session.question_type, user_session.question_unit,
+           user_session.question_amount, question_bank)
+    if QUESTION_SELECTION == 'adaptive':
+        key += (sum(counts[0] for counts in user_session.stats.values()),)
+    return key
 
-        elif user_session.question_type == QuestionType.ENG_VOC_MIX:
-            mix_voc(chat_id,
-                    int(user_session.question_unit) if user_session.question_unit.isnumeric() else 0,
-                    int(user_session.question_amount))
 
-    elif user_session.subject == MenuType.MATH:
+def schedule_prefetch(chat_id):
+    """
+    Preparing the user's next batch of questions in the background, while the user answers the current one,
+    so repeating the questions starts sending right away. It runs after the user's queued updates (see: dispatcher),
+    and is skipped when the dispatcher is full.
+    :param chat_id: the user's chat id.
+    """
+    if dispatcher is None:
+        return
+    try:
+        dispatcher.submit(chat_id, prefetch_questions, chat_id, timeout=0)
+    except queue.Full:
+        pass
 
-        if user_session.question_type == QuestionType.MATH_ALGEBRA:
-            math_built(chat_id, int(user_session.question_amount), "math_alg")
 
-        elif user_session.question_type == QuestionType.MATH_GEOMETRY:
-            math_built(chat_id, int(user_session.question_amount), "math_geo")
+def prefetch_questions(chat_id):
+    """
+    Preparing the next batch of questions of the user's current selection.
+    :param chat_id: the user's chat id.
+    """
+    user_session = users_sessions.get(chat_id)
+    generate = user_session and QUESTION_GENERATORS.get((user_session.subject, user_session.question_type))
+    if generate is None:
+        return
+    key = selection_key(user_session)  # before drawing, a bank reloaded meanwhile makes the batch stale
+    draft = user_session.draft()  # the user's cursors move only if the batch is used (see: call_questions)
+    batch = generate(draft)
+    prefetched.put(chat_id, key, (batch, draft.cursors), batch_bytes(batch))
 
-        elif user_session.question_type == QuestionType.MATH_PROBLEM:
-            math_built(chat_id, int(user_session.question_amount), "math_prob")
 
-        elif user_session.question_type == QuestionType.MATH_MIX:
-            math_full_mix(chat_id, int(user_session.question_amount))
+def session_unit(user_session):
+    """
+    :param user_session: the user's session.
+    :return: the selected unit number, 0 => all units.
+    """
+    return int(user_session.question_unit) if user_session.question_unit.isnumeric() else 0
+
+
+# ________transitions tables_____________
+
+# questions pool key -> (subject, name) in the user's stats, vocabulary units are named by their number
+STATS_NAMES = {
+    "eng:eng_com": ("English", "Sentence completion"),
+    "eng:eng_rephrase": ("English", "Rephrase"),
+    "voc:0": ("English", "Vocabulary of all units"),
+    "math:math_alg": ("Math", "Algebra"),
+    "math:math_geo": ("Math", "Geometry"),
+    "math:math_prob": ("Math", "Problems"),
+}
+
+SELECTED = object()  # stands for the selected option in a session mutation
+RESET = {'subject': None, 'question_type': None, 'question_unit': None, 'question_amount': None}
+
+# (menu, selected option) -> (session fields to set, next menu / questions to call)
+MENU_TRANSITIONS = {
+    # main_menu -> subject menu
+    (MenuType.MAIN, MenuType.ENGLISH): ({'subject': MenuType.ENGLISH}, english_main_menu),
+    (MenuType.MAIN, MenuType.HEBREW): ({'subject': MenuType.HEBREW}, hebrew_menu),
+    (MenuType.MAIN, MenuType.MATH): ({'subject': MenuType.MATH}, math_main_menu),
+    (MenuType.MAIN, MenuType.COMBINATION): ({'subject': MenuType.COMBINATION, 'question_type': QuestionType.FULL_MIX},
+                                            call_questions),
+
+    # english_main_menu -> english_voc_menu / amount_menu
+    (MenuType.ENGLISH, MenuType.ENG_VOC): ({}, english_voc_menu),
+    (MenuType.ENGLISH, QuestionType.ENG_COM): ({'question_type': SELECTED}, amount_menu),
+    (MenuType.ENGLISH, QuestionType.ENG_MIX): ({'question_type': SELECTED}, amount_menu),
+    (MenuType.ENGLISH, QuestionType.ENG_REPHRASE): ({'question_type': SELECTED}, amount_menu),
 
-    elif user_session.subject == MenuType.COMBINATION:
-        all_full_mix(chat_id)
+    # english_voc_menu -> unit_menu
+    **{(MenuType.ENG_VOC, option): ({'question_type': SELECTED}, unit_num_menu)
+       for option in MENU_OPTIONS[MenuType.ENG_VOC]},
 
-    repeat_menu(chat_id)
+    # math_menu -> amount_menu
+    **{(MenuType.MATH, option): ({'question_type': SELECTED}, amount_menu)
+       for option in MENU_OPTIONS[MenuType.MATH]},
+
+    # unit_menu -> amount_menu
+    **{(MenuType.UNIT, option): ({'question_unit': SELECTED}, amount_menu) for option in MENU_OPTIONS[MenuType.UNIT]},
+
+    # amount_menu -> questions
+    **{(MenuType.AMOUNT, option): ({'question_amount': SELECTED}, call_questions)
+       for option in MENU_OPTIONS[MenuType.AMOUNT]},
+
+    # repeat_menu -> questions / main_menu
+    (MenuType.REPEAT, QuestionType.REPEAT): ({}, call_questions),
+    (MenuType.REPEAT, MenuType.MAIN): (RESET, main_menu),
+}
+
+# (subject, question type) -> function preparing the questions of the user's session
+QUESTION_GENERATORS = {
+    (MenuType.ENGLISH, QuestionType.ENG_COM):
+        lambda s: eng_built(s, int(s.question_amount), "eng_com"),
+    (MenuType.ENGLISH, QuestionType.ENG_MIX):
+        lambda s: eng_full_mix(s, int(s.question_amount)),
+    (MenuType.ENGLISH, QuestionType.ENG_REPHRASE):
+        lambda s: eng_built(s, int(s.question_amount), "eng_rephrase"),
+    (MenuType.ENGLISH, QuestionType.ENG_VOC_ENG):
+        lambda s: eng_voc(s, session_unit(s), int(s.question_amount), 0),
+    (MenuType.ENGLISH, QuestionType.ENG_VOC_HEB):
+        lambda s: eng_voc(s, session_unit(s), int(s.question_amount), 1),
+    (MenuType.ENGLISH, QuestionType.ENG_VOC_MIX):
+        lambda s: mix_voc(s, session_unit(s), int(s.question_amount)),
+
+    (MenuType.MATH, QuestionType.MATH_ALGEBRA):
+        lambda s: math_built(s, int(s.question_amount), "math_alg"),
+    (MenuType.MATH, QuestionType.MATH_GEOMETRY):
+        lambda s: math_built(s, int(s.question_amount), "math_geo"),
+    (MenuType.MATH, QuestionType.MATH_PROBLEM):
+        lambda s: math_built(s, int(s.question_amount), "math_prob"),
+    (MenuType.MATH, QuestionType.MATH_MIX):
+        lambda s: math_full_mix(s, int(s.question_amount)),
+
+    (MenuType.COMBINATION, QuestionType.FULL_MIX):
+        lambda s: all_full_mix(s),
+}
 
 
 def get_menu_info(split_list, name_menu):
@@ -597,4 +1067,77 @@ def receive(message):
     """brings up the main menu if the user sends a text message"""
     main_menu(message.chat.id)
 
-bot.infinity_polling(timeout=10, long_polling_timeout = 5)
+def worker_main(index, workers_count, updates):
+    """
+    A bot worker process (see: workers.WorkerPool), handling the updates routed to it on its dispatcher.
+    Forked from the receiving process, so it gets its own sessions store connection, sender and threads.
+    :param index: the worker's index.
+    :param workers_count: the number of workers, each sends at its share of Telegram's global rate.
+    :param updates: the worker's updates queue.
+    """
+    global users_sessions, sender, dispatcher, worker_name
+    worker_name = "Worker {}: ".format(index) if workers_count > 1 else ""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    store = session.SESSION_STORE
+    if store == 'memory':  # each worker would have its own sessions, a chat's worker may change after a restart
+        store = session.SHARED_SESSION_STORE
+        logger.warning("SESSION_STORE=memory can't be shared by the %s workers, using SHARED_SESSION_STORE=%s",
+                       workers_count, store)
+    users_sessions = session.SessionStore(session.create_backend(store))
+    sender = outbound.OutboundQueue(bot, outbound.GLOBAL_RATE / workers_count,
+                                    max(1, outbound.GLOBAL_BURST / workers_count))
+    dispatcher = dispatch.ChatDispatcher()
+    reloader.start()  # a reloaded bank is the worker's own, no longer shared with the other workers since the fork
+    new_users_digest.start()
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT + 1 + index)
+
+    def handle(update):
+        update = types.Update.de_json(update)
+        dispatcher.submit(dispatch.update_chat_id(update), process_update, update)
+
+    try:
+        workers.read_updates(updates, handle)
+    finally:
+        dispatcher.join()
+        sender.join()
+        users_sessions.flush()
+
+
+def exit_if_webhook_set():
+    """
+    Exiting instead of long polling while the bot has a webhook (e.g. the Procfile's web process is scaled up too),
+    Telegram answers getUpdates with 409 Conflict then.
+    """
+    url = bot.get_webhook_info().url
+    if url:
+        sys.exit("The bot's webhook is set ({}), not polling: scale the worker process to 0, "
+                 "or the web process to 0 and remove the webhook".format(url))
+
+
+if __name__ == '__main__':
+    if not API_TOKEN or 'CHAT' not in os.environ:
+        sys.exit("The API_TOKEN and CHAT environment variables must be set")
+    if BOT_MODE != 'webhook':
+        exit_if_webhook_set()
+    if workers.BOT_WORKERS > 1:  # this process receives the updates, the worker processes handle them
+        pool = workers.WorkerPool(worker_main, receive=acknowledge, broadcast=is_admin_command)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # exiting terminates the workers
+        if METRICS_PORT:
+            metrics.serve(METRICS_PORT)
+        if BOT_MODE == 'webhook':
+            webhook.run(bot, os.environ['WEBHOOK_URL'], os.environ['WEBHOOK_SECRET'],
+                        port=int(os.environ.get('PORT', 8443)), handle=pool.route)
+        else:
+            workers.poll_updates(API_TOKEN, pool.route)
+    else:
+        reloader.start()
+        new_users_digest.start()
+        if METRICS_PORT:
+            metrics.serve(METRICS_PORT)
+        dispatcher = dispatch.ChatDispatcher()
+        dispatch.dispatch_updates(bot, dispatcher, process_update, receive=acknowledge)
+        if BOT_MODE == 'webhook':
+            webhook.run(bot, os.environ['WEBHOOK_URL'], os.environ['WEBHOOK_SECRET'], port=int(os.environ.get('PORT', 8443)))
+        else:
+            bot.infinity_polling(timeout=10, long_polling_timeout = 5)
@@ -1,5 +1,4 @@
 import enum
-from json import JSONEncoder
 
 class MenuType(str, enum.Enum):
     """
@@ -60,6 +59,48 @@ class Unit(str, enum.Enum):
     COMBINATION = "COMBINATION"
 
 
+# short codes of menus and options, used to encode a MenuAnswer into the 64 bytes callback data
+MENU_CODES = {
+    MenuType.ENGLISH: "E",
+    MenuType.MATH: "M",
+    MenuType.HEBREW: "H",
+    MenuType.COMBINATION: "C",
+    MenuType.ENG_VOC: "V",
+    MenuType.AMOUNT: "A",
+    MenuType.MAIN: "N",
+    MenuType.UNIT: "U",
+    MenuType.REPEAT: "R",
+}
+OPTION_CODES = {
+    **MENU_CODES,
+    QuestionType.ENG_COM: "EC",
+    QuestionType.ENG_REPHRASE: "ER",
+    QuestionType.ENG_VOC_HEB: "VH",
+    QuestionType.ENG_VOC_ENG: "VE",
+    QuestionType.ENG_VOC_MIX: "VM",
+    QuestionType.ENG_MIX: "EM",
+    QuestionType.MATH_ALGEBRA: "MA",
+    QuestionType.MATH_GEOMETRY: "MG",
+    QuestionType.MATH_PROBLEM: "MP",
+    QuestionType.MATH_MIX: "MM",
+    QuestionType.FULL_MIX: "F",
+    QuestionType.REPEAT: "RP",
+    Unit.COMBINATION: "0",
+}  # amounts and unit numbers are coded by their value
+
+# the options which can be answered on each menu
+MENU_OPTIONS = {
+    MenuType.MAIN: (MenuType.ENGLISH, MenuType.HEBREW, MenuType.MATH, MenuType.COMBINATION),
+    MenuType.ENGLISH: (MenuType.ENG_VOC, QuestionType.ENG_COM, QuestionType.ENG_MIX, QuestionType.ENG_REPHRASE),
+    MenuType.ENG_VOC: (QuestionType.ENG_VOC_ENG, QuestionType.ENG_VOC_HEB, QuestionType.ENG_VOC_MIX),
+    MenuType.MATH: (QuestionType.MATH_ALGEBRA, QuestionType.MATH_GEOMETRY, QuestionType.MATH_PROBLEM,
+                    QuestionType.MATH_MIX),
+    MenuType.UNIT: tuple(Unit),
+    MenuType.AMOUNT: tuple(AmountQuestion),
+    MenuType.REPEAT: (MenuType.MAIN, QuestionType.REPEAT),
+}
+
+
 class MenuAnswer:
     """
     Each call back is represented by MenuAnswer
@@ -71,31 +112,23 @@ class MenuAnswer:
         self.menu_type = menu_type  # MenuType
         self.option = option  # EveryPossibleChoice
 
-    @staticmethod
-    def create_from_call_back(callback):
+    def encode(self):
         """
-        Create instance of MenuAnswer from callback
-        :param callback: call back returned after choosing of user in format {"menu_type":****, "option":****}
-        :return new MenuAnswer which is represented by the callback
+        :return: the callback data of this answer in format "<menu code>:<option code>", e.g. "A:5"
         """
-        if callback['option'] in [e.value for e in MenuType]:
-            option = MenuType(callback['option'])
-
-        elif callback['option'] in [e.value for e in QuestionType]:
-            option = QuestionType(callback['option'])
-
-        elif callback['menu_type'] == MenuType.AMOUNT:
-            option = AmountQuestion(callback['option'])
+        return MENU_CODES[self.menu_type] + ":" + OPTION_CODES.get(self.option, self.option.value)
 
-        else:
-            option = Unit(callback['option'])
-        menu_type = MenuType(callback['menu_type'])
-        return MenuAnswer(menu_type, option)
+    @staticmethod
+    def decode(callback_data):
+        """
+        Finding the MenuAnswer of a callback
+        :param callback_data: call back returned after choosing of user, as made by MenuAnswer.encode
+        :return the MenuAnswer which is represented by the callback, None if it isn't an answer of any menu
+        """
+        return MENU_ANSWERS.get(callback_data)
 
 
-class MenuAnswerEncoder(JSONEncoder):
-    """
-    Class for making MenuAnswer JSON Serializable
-    """
-    def default(self, o):
-        return o.__dict__
+# callback data -> MenuAnswer of every possible answer, built once so decoding is a single lookup
+MENU_ANSWERS = {menu_answer.encode(): menu_answer
+                for menu_answer in (MenuAnswer(menu_type, option)
+                                    for menu_type, options in MENU_OPTIONS.items() for option in options)}
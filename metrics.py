@@ -0,0 +1,213 @@
+import bisect
+import functools
+import threading
+import time
+
+# _______________in process metrics, cheap enough to be always on___________________
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'  # Prometheus' text exposition format
+
+
+class Metric:
+    """
+    A named metric, holding one value per set of label values.
+    :var name: the metric's name.
+    :var documentation: one line describing the metric.
+    :var label_names: names of the labels the metric's values are split by.
+    :var values: label values tuple -> value.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def labels_key(self, labels):
+        """
+        :param labels: label name -> value.
+        :return: the label values ordered as label_names.
+        """
+        return tuple(str(getattr(labels[name], 'value', labels[name])) for name in self.label_names)  # enums by value
+
+
+class Counter(Metric):
+    """A value which only goes up, e.g. number of calls."""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.labels_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.labels_key(labels), 0)
+
+
+class Gauge(Metric):
+    """
+    A value which goes up and down, e.g. queue depth.
+    :var function: returns the value when it is exported, for a gauge without labels read from elsewhere
+                   (e.g. a cache's size), None => the value is set.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, label_names=(), function=None):
+        super().__init__(name, documentation, label_names)
+        self.function = function
+
+    def set(self, value, **labels):
+        self.values[self.labels_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.labels_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        return self.values.get(self.labels_key(labels), 0)
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values (e.g. latency in seconds), counted per bucket upper bound.
+    A value is [count per bucket (the last one is +Inf), sum of values, number of values].
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        self.observe_key(value, self.labels_key(labels))
+
+    def observe_key(self, value, key):
+        """Observing a value of the label values key (see: labels_key), for callers observing the same labels."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            counts[0][index] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def count(self, **labels):
+        counts = self.values.get(self.labels_key(labels))
+        return counts[2] if counts else 0
+
+
+REGISTRY = {}  # name -> Metric of every metric of the bot
+
+
+def register(metric):
+    """
+    :param metric: new Metric.
+    :return: the registered metric of that name (the given one, unless it was registered before).
+    """
+    return REGISTRY.setdefault(metric.name, metric)
+
+
+def counter(name, documentation, label_names=()):
+    return register(Counter(name, documentation, label_names))
+
+
+def gauge(name, documentation, label_names=(), function=None):
+    return register(Gauge(name, documentation, label_names, function))
+
+
+def histogram(name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+    return register(Histogram(name, documentation, label_names, buckets))
+
+
+def timed(histogram, errors=None, **labels):
+    """
+    Decorator observing the run time of every call of the decorated function.
+    :param histogram: the Histogram the run times are observed in.
+    :param errors: Counter of the calls raising an exception, None => not counted.
+    :param labels: the labels of the observations (and of the errors).
+    """
+    key = histogram.labels_key(labels)
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(**labels)
+                raise
+            finally:
+                histogram.observe_key(time.perf_counter() - start, key)
+        return wrapper
+    return decorator
+
+
+# _______________exporting the metrics to Prometheus___________________
+
+
+def exposition(registry=None):
+    """
+    :param registry: name -> Metric, None => REGISTRY.
+    :return: the metrics in Prometheus' text exposition format.
+    """
+    lines = []
+    for metric in (REGISTRY if registry is None else registry).values():
+        lines.append('# HELP {} {}'.format(metric.name, metric.documentation.replace('\\', r'\\').replace('\n', r'\n')))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        if getattr(metric, 'function', None) is not None:
+            lines.append('{} {}'.format(metric.name, metric.function()))
+            continue
+        with metric.lock:  # a consistent copy of the histograms' counts
+            values = [(key, [list(value[0]), value[1], value[2]] if metric.kind == 'histogram' else value)
+                      for key, value in metric.values.items()]
+        for key, value in values:
+            labels = list(zip(metric.label_names, key))
+            if metric.kind != 'histogram':
+                lines.append('{}{} {}'.format(metric.name, labels_text(labels), value))
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(metric.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{} {}'.format(metric.name, labels_text(labels + [('le', bound)]), cumulative))
+            lines.append('{}_sum{} {}'.format(metric.name, labels_text(labels), total))
+            lines.append('{}_count{} {}'.format(metric.name, labels_text(labels), count))
+    return '\n'.join(lines) + '\n'
+
+
+def labels_text(labels):
+    """
+    :param labels: [(label name, value)].
+    :return: the labels in the exposition format, e.g. {method="send_poll"}, empty if there are none.
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"')
+                                         .replace('\n', r'\n')) for name, value in labels) + '}'
+
+
+def serve(port, host='0.0.0.0'):
+    """
+    Serving the metrics on http://<host>:<port>/metrics, on a background thread.
+    :param port: the port to listen on.
+    :param host: the address to listen on.
+    :return: the server.
+    """
+    from flask import Flask, Response  # only needed when the metrics are served
+    from werkzeug.serving import make_server
+
+    app = Flask(__name__)
+    app.add_url_rule('/metrics', 'metrics', lambda: Response(exposition(), content_type=CONTENT_TYPE))
+    server = make_server(host, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
@@ -0,0 +1,410 @@
+import heapq
+import itertools
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque, namedtuple
+
+import requests
+from telebot.apihelper import ApiHTTPException, ApiTelegramException
+from urllib3.exceptions import NewConnectionError
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages per second overall and about one message per second in a chat (short bursts pass)
+GLOBAL_RATE = float(os.environ.get('SEND_GLOBAL_RATE', 30))
+GLOBAL_BURST = float(os.environ.get('SEND_GLOBAL_BURST', 30))
+CHAT_RATE = float(os.environ.get('SEND_CHAT_RATE', 1))
+CHAT_BURST = float(os.environ.get('SEND_CHAT_BURST', 10))
+MAX_RETRIES = int(os.environ.get('SEND_MAX_RETRIES', 5))
+SEND_THREADS = int(os.environ.get('SEND_THREADS', 8))
+MAX_CHAT_BUCKETS = 10000
+
+# bot methods whose first argument is the chat id, the other methods are limited only by the global rate
+# (but UNPACED_METHODS)
+CHAT_METHODS = {'send_message', 'send_poll', 'send_photo', 'send_media_group', 'send_document',
+                'edit_message_reply_markup', 'delete_message'}
+# bot methods taking the chat id as the chat_id keyword argument (their first argument is the text)
+KEYWORD_CHAT_METHODS = {'edit_message_text'}
+# bot methods which aren't messages, so Telegram's sending rates don't apply: sent right away, without a chat
+UNPACED_METHODS = {'answer_callback_query'}
+# bot methods which send something new, repeating them after Telegram got the request sends it twice
+SEND_METHODS = {'send_message', 'send_poll', 'send_photo', 'send_media_group', 'send_document'}
+
+queue_depth = metrics.gauge('outbound_queue_depth', "Calls queued and not sent yet")
+wait_seconds = metrics.histogram('outbound_wait_seconds', "Time calls waited for the rate limits", ['method'])
+api_calls = metrics.counter('outbound_api_calls_total', "Telegram API calls made", ['method'])
+api_retries = metrics.counter('outbound_retries_total', "Telegram API calls retried", ['method', 'reason'])
+call_seconds = metrics.histogram('outbound_call_seconds', "Time Telegram took to answer the calls", ['method'])
+api_errors = metrics.counter('outbound_errors_total', "Telegram API calls failed after their retries", ['method'])
+
+
+class Call(namedtuple('Call', ['method_name', 'args', 'kwargs'])):
+    """A bot method's call, yielded by the jobs sent through the OutboundQueue (see: OutboundQueue.run)."""
+
+
+class Calls:
+    """Building the calls of the jobs: calls.send_poll(chat_id, ...) is the Call of bot.send_poll(chat_id, ...)."""
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: Call(name, args, kwargs)
+
+
+calls = Calls()
+
+
+class TokenBucket:
+    """
+    Rate limiter: tokens are added at a fixed rate up to a burst capacity, each call takes a token.
+    :var rate: tokens added per second.
+    :var capacity: max tokens (the burst size).
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now):
+        """
+        Taking a token, possibly before it is added, so callers are served in the order they reserved.
+        :param now: time.monotonic() of the call.
+        :return: seconds to wait until the reserved token is added.
+        """
+        self.refill(now)
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def pause(self, seconds, now):
+        """
+        Taking no tokens for the given time (e.g. when Telegram asks to retry after it).
+        :param seconds: the pause.
+        :param now: time.monotonic() of the call.
+        """
+        self.refill(now)
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class OutboundQueue:
+    """
+    All the bot's calls to Telegram go through here: each call waits for its turn under a global rate
+    and a per chat rate, is retried after the time Telegram asks on 429 (flood) errors,
+    and is retried with jittered back-off on transient network / server errors
+    (a send only when it failed to connect, a read timeout may come after Telegram sent it).
+    A chat's calls are sent one at a time, in the order they were queued, by a few sender threads:
+    a call waiting for its turn holds no thread (see: schedule), so queueing returns right away
+    and a chat paced by its rate doesn't hold up the other chats' calls.
+    Bot methods are called on the queue with the same arguments, e.g. sender.send_message(chat_id, ...),
+    without waiting for their result. Calls needing the result of the ones before them are sent by a job (see: run).
+    :var chats: chat id -> the chat's queued jobs, the first is running, for every chat with a queued job.
+    :var timers: heap of (time, sequence, function, arguments) of the calls waiting for their turn.
+    :var ready: the tasks for the sender threads, (function, arguments).
+    """
+
+    def __init__(self, bot, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+                 chat_rate=CHAT_RATE, chat_burst=CHAT_BURST, max_retries=MAX_RETRIES, threads=SEND_THREADS):
+        """
+        :param threads: number of sender threads, the calls being sent at once.
+        """
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.threads_count = threads
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_buckets = {}
+        self.chats = {}
+        self.jobs = 0  # number of queued jobs, running or waiting
+        self.timers = []
+        self.sequence = itertools.count()
+        self.ready = queue.SimpleQueue()
+        self.pid = None  # the process the threads were started in
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)  # notified on new timers and on finished jobs
+
+    def __getattr__(self, name):
+        if name in CHAT_METHODS:
+            return lambda chat_id, *args, **kwargs: self.run(chat_id, single(Call(name, (chat_id, *args), kwargs)))
+        if name in KEYWORD_CHAT_METHODS:
+            return lambda *args, **kwargs: self.run(kwargs.get('chat_id'), single(Call(name, args, kwargs)))
+        if name in UNPACED_METHODS:
+            return lambda *args, **kwargs: self.run(None, single(Call(name, args, kwargs)))
+        raise AttributeError(name)
+
+    def run(self, chat_id, job):
+        """
+        Queueing a job after the chat's queued calls and jobs, without waiting.
+        A job is a generator yielding the calls to send one after the other (see: calls), the result of each call
+        is sent back into the job, or its error raised in it, e.g. message = yield calls.send_message(chat_id, text).
+        An error the job doesn't catch is logged, and the chat's next job runs.
+        :param chat_id: the chat the job's calls are sent to, None => only the global rate (and no order).
+        :param job: the job's generator.
+        """
+        with self.lock:
+            self.start()
+            self.jobs += 1
+            queue_depth.inc()  # its first call, counted until the job starts (see: begin)
+            if chat_id is not None:
+                jobs = self.chats.setdefault(chat_id, deque())
+                jobs.append(job)
+                if len(jobs) > 1:
+                    return  # runs when the chat's previous jobs are done (see: finish)
+        self.ready.put((self.begin, (chat_id, job)))
+
+    def call(self, chat_id, method_name, /, *args, **kwargs):
+        """
+        Sending a call after the chat's queued calls and waiting for its result,
+        for the threads which may wait (e.g. a background thread, not the handlers).
+        :param chat_id: the chat the call is sent to, None => only the global rate.
+        :param method_name: the bot method's name.
+        :return: the method's result.
+        :raise: the method's error, after its retries.
+        """
+        done = threading.Event()
+        outcome = {}
+
+        def job():
+            try:
+                outcome['result'] = yield Call(method_name, args, kwargs)
+            except Exception as e:
+                outcome['error'] = e
+            finally:
+                done.set()
+
+        self.run(chat_id, job())
+        done.wait()
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['result']
+
+    def join(self):
+        """Waiting until every queued job is done."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.jobs == 0)
+
+    def start(self):
+        """Starting the threads with the first call in the process (a forked process starts its own), lock held."""
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        threading.Thread(target=self.schedule_loop, name='sender-scheduler', daemon=True).start()
+        for i in range(self.threads_count):
+            threading.Thread(target=self.work, name='sender-{}'.format(i), daemon=True).start()
+
+    def work(self):
+        """Sender thread loop: running the ready tasks, each moves a job a call further."""
+        while True:
+            function, args = self.ready.get()
+            try:
+                function(*args)
+            except Exception:
+                logger.exception("Failed running a send task")
+
+    def begin(self, chat_id, job):
+        """Running the job's first step, whose call is counted when it's scheduled instead (see: run)."""
+        queue_depth.dec()
+        self.step(chat_id, job)
+
+    def step(self, chat_id, job, result=None, error=None):
+        """
+        Running the job until its next call, which is scheduled, or until it's done.
+        :param chat_id: the job's chat id.
+        :param job: the job's generator.
+        :param result: the result of the job's previous call.
+        :param error: the error of the job's previous call, raised in the job.
+        """
+        try:
+            call = job.send(result) if error is None else job.throw(error)
+        except StopIteration:
+            self.finish(chat_id)
+        except Exception:
+            logger.exception("Failed sending to chat %s", chat_id)
+            self.finish(chat_id)
+        else:
+            self.schedule(chat_id, job, call, 0)
+
+    def finish(self, chat_id):
+        """Starting the chat's next job, after its job is done."""
+        next_job = None
+        with self.condition:
+            self.jobs -= 1
+            if chat_id is not None:
+                jobs = self.chats[chat_id]
+                jobs.popleft()
+                if jobs:
+                    next_job = jobs[0]
+                else:
+                    del self.chats[chat_id]
+            self.condition.notify_all()
+        if next_job is not None:
+            self.begin(chat_id, next_job)
+
+    def schedule(self, chat_id, job, call, attempt, delay=0.0):
+        """
+        Sending the call when its turn comes under the chat's rate and then under the global rate,
+        so the global rate isn't spent on calls still waiting for their chat. Until then the call waits in the timers.
+        The UNPACED_METHODS are sent right away (after the delay).
+        :param chat_id: the chat the call is sent to, None => only the global rate.
+        :param job: the call's job.
+        :param call: the Call.
+        :param attempt: number of the call's attempt, from 0.
+        :param delay: min seconds from now, e.g. the back-off before a retry.
+        """
+        queue_depth.inc()  # until it's sent (see: send)
+        if call.method_name in UNPACED_METHODS:
+            task = (chat_id, job, call, attempt)
+            if delay > 0:
+                with self.condition:
+                    self.wait(delay, self.send, task)
+            else:
+                self.ready.put((self.send, task))
+            return
+        task = (chat_id, job, call, attempt, time.monotonic())
+        with self.condition:
+            if chat_id is not None:
+                delay = max(delay, self.chat_bucket(chat_id, task[-1]).reserve(task[-1]))
+            if delay > 0:
+                self.wait(delay, self.take_global_turn, task)
+                return
+        self.take_global_turn(*task)
+
+    def take_global_turn(self, chat_id, job, call, attempt, scheduled):
+        """Sending the call, whose chat's turn came, when its turn under the global rate comes (see: schedule)."""
+        task = (chat_id, job, call, attempt)
+        with self.condition:
+            turn = self.global_bucket.reserve(time.monotonic())
+            if turn > 0:
+                self.wait(turn, self.send, task)
+                wait_seconds.observe(time.monotonic() + turn - scheduled, method=call.method_name)
+                return
+        wait_seconds.observe(time.monotonic() - scheduled, method=call.method_name)
+        self.ready.put((self.send, task))
+
+    def wait(self, seconds, function, task):
+        """Handing the task to the sender threads after the given time (see: schedule_loop), the lock must be held."""
+        heapq.heappush(self.timers, (time.monotonic() + seconds, next(self.sequence), function, task))
+        self.condition.notify_all()
+
+    def schedule_loop(self):
+        """Scheduler thread loop: handing every waiting task to the sender threads when its time comes."""
+        while True:
+            with self.condition:
+                while not self.timers or self.timers[0][0] > time.monotonic():
+                    self.condition.wait(self.timers[0][0] - time.monotonic() if self.timers else None)
+                when, sequence, function, task = heapq.heappop(self.timers)
+            self.ready.put((function, task))
+
+    def chat_bucket(self, chat_id, now):
+        """
+        :param chat_id: the chat's id.
+        :param now: time.monotonic() of the call.
+        :return: the TokenBucket of the chat, the lock must be held.
+        """
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= MAX_CHAT_BUCKETS:  # forgetting idle chats, a full bucket is a new one
+                for idle_chat_id, idle_bucket in list(self.chat_buckets.items()):
+                    idle_bucket.refill(now)
+                    if idle_bucket.tokens >= idle_bucket.capacity:
+                        del self.chat_buckets[idle_chat_id]
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def send(self, chat_id, job, call, attempt):
+        """
+        Calling the bot method, its result goes back to the job, as does its error unless the call is retried.
+        :param chat_id: the chat the call is sent to.
+        :param job: the call's job.
+        :param call: the Call.
+        :param attempt: number of the call's attempt, from 0.
+        """
+        queue_depth.dec()
+        method = metrics.timed(call_seconds, method=call.method_name)(getattr(self.bot, call.method_name))
+        api_calls.inc(method=call.method_name)
+        try:
+            result = method(*call.args, **call.kwargs)
+        except Exception as e:
+            delay = self.retry_delay(chat_id, call.method_name, e, attempt)
+            if delay is not None:
+                self.schedule(chat_id, job, call, attempt + 1, delay)
+                return
+            api_errors.inc(method=call.method_name)
+            self.step(chat_id, job, error=e)
+            return
+        self.step(chat_id, job, result)
+
+    def retry_delay(self, chat_id, method_name, error, attempt):
+        """
+        :param chat_id: the chat the failed call was sent to.
+        :param method_name: the bot method's name.
+        :param error: the call's error.
+        :param attempt: number of the failed attempt, from 0.
+        :return: seconds to wait before retrying the call (besides its turn), None if it isn't retried.
+        """
+        if attempt == self.max_retries:
+            return None
+        if isinstance(error, ApiTelegramException):
+            if error.error_code == 429:
+                retry_after = error.result_json.get('parameters', {}).get('retry_after', 1)
+                api_retries.inc(method=method_name, reason='flood')
+                if method_name in UNPACED_METHODS:  # doesn't take the rates' turns, nor holds up the messages
+                    return float(retry_after)
+                self.pause(chat_id, retry_after)  # the next calls to the chat wait too
+                return 0.0
+            if error.error_code >= 500:
+                api_retries.inc(method=method_name, reason='server')
+                return backoff(attempt)
+            return None
+        if isinstance(error, (ApiHTTPException, requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            if isinstance(error, ApiHTTPException) and error.result.status_code < 500:
+                return None
+            if method_name in SEND_METHODS and not isinstance(error, ApiHTTPException) and not connect_failed(error):
+                return None  # e.g. a read timeout, Telegram may have sent it already
+            api_retries.inc(method=method_name, reason='network')
+            return backoff(attempt)
+        return None
+
+    def pause(self, chat_id, seconds):
+        """
+        Sending nothing to the chat for the given time.
+        :param chat_id: the chat's id, None => nothing is sent to any chat.
+        :param seconds: the pause.
+        """
+        with self.lock:
+            now = time.monotonic()
+            bucket = self.global_bucket if chat_id is None else self.chat_bucket(chat_id, now)
+            bucket.pause(seconds, now)
+
+
+def connect_failed(error):
+    """
+    :param error: a requests error of a call.
+    :return: whether the call failed connecting (timed out, refused...), so the request never reached Telegram.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)
+
+
+def single(call):
+    """:return: a job sending a single call (see: OutboundQueue.run), its result isn't needed."""
+    yield call
+
+
+def backoff(attempt, base=0.5, cap=30):
+    """
+    :param attempt: number of the failed attempt, from 0.
+    :return: seconds to wait before retrying: exponential back-off with full jitter.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
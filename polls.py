@@ -0,0 +1,66 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+POLL_TTL = float(os.environ.get('POLL_TTL', 7 * 24 * 60 * 60))
+MAX_OPEN_POLLS = int(os.environ.get('MAX_OPEN_POLLS', 100000))
+
+open_polls_gauge = metrics.gauge('open_polls', "Sent quiz polls waiting for the user's answer")
+expired_polls = metrics.counter('polls_expired_total', "Quiz polls forgotten before they were answered", ['reason'])
+answers = metrics.counter('poll_answers_total', "Quiz answers received", ['result'])
+
+
+class PollTracker:
+    """
+    The sent quiz polls by poll id, until the user answers them: a poll's entry holds what's needed to score
+    its answer (the user's chat id, the correct option and the asked question).
+    Unanswered polls are forgotten after a TTL, or the oldest ones once there are max_size polls.
+    """
+
+    def __init__(self, ttl=POLL_TTL, max_size=MAX_OPEN_POLLS):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.polls = OrderedDict()  # poll id -> (entry, expiry time), oldest first
+        self.lock = threading.Lock()
+
+    def add(self, poll_id, entry):
+        """
+        :param poll_id: the sent poll's id.
+        :param entry: what the poll's answer is scored by.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.polls[poll_id] = (entry, now + self.ttl)
+            self.expire(now)
+            open_polls_gauge.set(len(self.polls))
+
+    def pop(self, poll_id):
+        """
+        :param poll_id: the answered poll's id.
+        :return: the poll's entry, None if it isn't tracked (e.g. expired, or sent before a restart).
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry, expiry = self.polls.pop(poll_id, (None, None))
+            self.expire(now)
+            open_polls_gauge.set(len(self.polls))
+        if entry is not None and expiry < now:
+            expired_polls.inc(reason='ttl')
+            return None
+        answers.inc(result='tracked' if entry is not None else 'untracked')
+        return entry
+
+    def __len__(self):
+        return len(self.polls)
+
+    def expire(self, now):
+        """Forgetting the polls past their TTL and the oldest ones above max size, the lock must be held."""
+        while self.polls:
+            poll_id, (entry, expiry) = next(iter(self.polls.items()))
+            if expiry >= now and len(self.polls) <= self.max_size:
+                break
+            del self.polls[poll_id]
+            expired_polls.inc(reason='ttl' if expiry < now else 'size')
@@ -0,0 +1,81 @@
+import os
+import threading
+from collections import OrderedDict
+
+import metrics
+
+PREFETCH_MAX_BYTES = int(os.environ.get('PREFETCH_MAX_BYTES', 32 * 1024 * 1024))
+
+prefetch_results = metrics.counter('prefetch_total', "Prefetched question batches by what became of them", ['result'])
+prefetch_bytes = metrics.gauge('prefetch_bytes', "Estimated memory of the prefetched question batches")
+
+
+class PrefetchCache:
+    """
+    The next batch of questions of each user, prepared before the user asks for it (see: main.prefetch),
+    keyed by the user's selection the batch was prepared for, so a batch is used only for that selection.
+    The batches of all the users are capped by their estimated size, the least recently prefetched are dropped.
+    """
+
+    def __init__(self, max_bytes=PREFETCH_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.batches = OrderedDict()  # chat id -> (selection key, batch, estimated bytes), oldest first
+        self.lock = threading.Lock()
+
+    def put(self, chat_id, key, batch, size):
+        """
+        :param chat_id: the user's chat id.
+        :param key: the user's selection the batch was prepared for.
+        :param batch: the prepared batch.
+        :param size: the batch's estimated size in bytes.
+        """
+        with self.lock:
+            self.remove(chat_id)
+            self.batches[chat_id] = (key, batch, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.remove(next(iter(self.batches)))
+                prefetch_results.inc(result='evicted')
+            prefetch_bytes.set(self.size)
+
+    def pop(self, chat_id, key):
+        """
+        :param chat_id: the user's chat id.
+        :param key: the user's current selection.
+        :return: the user's prefetched batch, None if there is none for the current selection.
+        """
+        with self.lock:
+            entry = self.remove(chat_id)
+            prefetch_bytes.set(self.size)
+        if entry is None:
+            prefetch_results.inc(result='miss')
+            return None
+        if entry[0] != key:
+            prefetch_results.inc(result='stale')
+            return None
+        prefetch_results.inc(result='hit')
+        return entry[1]
+
+    def discard(self, chat_id):
+        """Dropping the user's prefetched batch (e.g. when the user's selection changed)."""
+        with self.lock:
+            if self.remove(chat_id) is not None:
+                prefetch_results.inc(result='stale')
+            prefetch_bytes.set(self.size)
+
+    def clear(self):
+        with self.lock:
+            self.batches.clear()
+            self.size = 0
+            prefetch_bytes.set(0)
+
+    def remove(self, chat_id):
+        """:return: the removed entry of the user, None if there is none. The lock must be held."""
+        entry = self.batches.pop(chat_id, None)
+        if entry is not None:
+            self.size -= entry[2]
+        return entry
+
+    def __len__(self):
+        return len(self.batches)
@@ -0,0 +1,132 @@
+import cProfile
+import os
+import pstats
+import threading
+import time
+
+PROFILES_DIR = os.environ.get('PROFILES_DIR', os.getcwd() + '/DATA/profiles')
+PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', 10 * 60))
+TOP_FUNCTIONS = 15
+
+
+class UpdateProfiler:
+    """
+    Profiling the next updates the bot handles with cProfile, on the admin's request (see: main.start_profile):
+    each profiled update's stats are written to PROFILES_DIR, and summed up for the admin (see: report).
+    Profiling turns itself off after the asked number of updates, or after max_seconds.
+    When it is off, checking an update costs a single attribute read (see: wants).
+    The profiled updates run one at a time, the profiler only sees the thread it was enabled on.
+    :var remaining: the number of updates still to profile, 0 => off.
+    :var chat_id: the chat whose updates are profiled, None => every chat's.
+    :var profiles: (update name, chat id, seconds, stats file path) of every profiled update, in order.
+    """
+
+    def __init__(self, directory=PROFILES_DIR, max_seconds=PROFILE_MAX_SECONDS):
+        self.directory = directory
+        self.max_seconds = max_seconds
+        self.remaining = 0
+        self.chat_id = None
+        self.deadline = 0
+        self.profiles = []
+        self.lock = threading.Lock()
+        self.running = threading.Lock()  # held by the profiled update running
+
+    def start(self, count, chat_id=None):
+        """
+        Profiling the next updates, forgetting the previous profiles.
+        :param count: the number of updates to profile.
+        :param chat_id: only this chat's updates are profiled, None => every chat's.
+        """
+        with self.lock:
+            self.profiles = []
+            self.chat_id = chat_id
+            self.deadline = time.monotonic() + self.max_seconds
+            self.remaining = count
+
+    def stop(self):
+        self.remaining = 0
+
+    def wants(self, chat_id):
+        """
+        :param chat_id: the chat of the update to handle.
+        :return: whether the update should be profiled (see: profile).
+        """
+        if not self.remaining:
+            return False
+        if time.monotonic() > self.deadline:
+            self.stop()
+            return False
+        return self.chat_id is None or chat_id == self.chat_id
+
+    def profile(self, chat_id, name, function, *args):
+        """
+        Calling the function under the profiler, if there are updates left to profile (else just calling it).
+        :param chat_id: the update's chat id.
+        :param name: the update's description, e.g. the handler and its callback data.
+        :param function: handles the update.
+        :param args: the function's arguments.
+        """
+        with self.lock:
+            taken = self.remaining > 0  # else the last update was taken by another thread meanwhile
+            if taken:
+                self.remaining -= 1
+        if not taken:
+            return function(*args)
+
+        with self.running:
+            profiler = cProfile.Profile()
+            start = time.perf_counter()
+            try:
+                return profiler.runcall(function, *args)
+            finally:
+                seconds = time.perf_counter() - start
+                with self.lock:
+                    self.profiles.append((name, chat_id, seconds, self.save(profiler, len(self.profiles) + 1, name)))
+
+    def save(self, profiler, number, name):
+        """
+        :return: path of the file the profile's stats were written to, None if they couldn't be written.
+        """
+        path = os.path.join(self.directory, '{}-{}-{:03d}-{}.prof'.format(  # the pid: the workers share the directory
+            time.strftime('%Y%m%d-%H%M%S'), os.getpid(), number, ''.join(c if c.isalnum() else '_' for c in name)))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            profiler.dump_stats(path)
+        except OSError:
+            return None
+        return path
+
+    def report(self):
+        """
+        :return: (the profiled updates and the functions taking the most cumulative time over all of them,
+                  path of a file with the stats of all of them, None if there are none).
+        """
+        with self.lock:
+            profiles = list(self.profiles)
+            state = "on, {} updates left".format(self.remaining) if self.remaining else "off"
+        lines = ["Profiling is {}. {} profiled updates:".format(state, len(profiles))]
+        lines += ["{} (chat {}): {:.1f} ms".format(name, chat_id, seconds * 1000)
+                  for name, chat_id, seconds, path in profiles]
+        paths = [path for name, chat_id, seconds, path in profiles if path is not None]
+        if not paths:
+            return "\n".join(lines), None
+
+        stats = pstats.Stats(*paths).sort_stats('cumulative')
+        lines += ["", "Top functions by cumulative time:", top_functions(stats)]
+        combined_path = os.path.join(self.directory, 'combined-{}.prof'.format(os.getpid()))
+        stats.dump_stats(combined_path)
+        return "\n".join(lines), combined_path
+
+
+def top_functions(stats, limit=TOP_FUNCTIONS):
+    """
+    :param stats: pstats.Stats sorted by cumulative time.
+    :param limit: the number of functions.
+    :return: a line per function: cumulative ms, calls and the function's name, file and line.
+    """
+    lines = []
+    for file_name, line, function_name in stats.fcn_list[:limit]:
+        calls, primitive_calls, total_time, cumulative_time, callers = stats.stats[(file_name, line, function_name)]
+        lines.append("{:9.1f} ms {:6d}x {} ({}:{})".format(cumulative_time * 1000, calls, function_name,
+                                                             os.path.basename(file_name), line))
+    return "\n".join(lines)
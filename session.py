@@ -1,11 +1,283 @@
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from bank import DrawCursor, WeightTree
+from menu import MenuType, QuestionType, AmountQuestion, Unit
+
+logger = logging.getLogger(__name__)
+
+SESSION_STORE = os.environ.get('SESSION_STORE', 'memory')  # memory | sqlite:///<path> | mongodb://<host>/...
+# used instead of memory when the sessions must be shared by processes (the bot's workers), logged when it is
+SHARED_SESSION_STORE = os.environ.get('SHARED_SESSION_STORE', 'sqlite:///' + os.getcwd() + '/DATA/sessions.db')
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 10000))
+MEMORY_STORE_SIZE = int(os.environ.get('MEMORY_STORE_SIZE', 100000))  # sessions kept by SESSION_STORE=memory
+SESSION_TTL = float(os.environ.get('SESSION_TTL', 24 * 60 * 60))
+FLUSH_INTERVAL = float(os.environ.get('SESSION_FLUSH_INTERVAL', 5))
+FLUSH_BATCH_SIZE = int(os.environ.get('SESSION_FLUSH_BATCH_SIZE', 500))
+
+
 class Session:
     '''
     A unique data structure for each user in order to keep their state in the menu
     '''
+    __slots__ = ('subject', 'question_amount', 'question_unit', 'question_type', 'cursors', 'weights', 'stats',
+                 'menu_message_id', 'menu_edits')
+
+    # field -> enum of its value
+    FIELDS = {'subject': MenuType, 'question_amount': AmountQuestion,
+              'question_unit': Unit, 'question_type': QuestionType}
+
     def __init__(self):
         self.subject = None
         self.question_amount = None
         self.question_unit = None
         self.question_type = None
+        self.cursors = {}  # questions pool key -> DrawCursor, so the user's draws don't repeat questions
+        self.weights = {}  # questions pool key -> WeightTree, by the user's answers (adaptive selection)
+        self.stats = {}  # questions pool key -> [answers, right answers]
+        # the newest menu, -its id once it was closed (the later messages are live), None => unknown (any is live)
+        self.menu_message_id = None
+        self.menu_edits = 0  # times the menus were edited into another menu (see: CallbackGuard), not saved
+
+    def count_answer(self, pool_key, correct):
+        """
+        :param pool_key: the pool the answered question was drawn from (e.g. "voc:3").
+        :param correct: whether the user answered right.
+        """
+        counts = self.stats.get(pool_key)
+        if counts is None:
+            counts = self.stats[pool_key] = [0, 0]
+        counts[0] += 1
+        counts[1] += correct
+
+    def draft(self):
+        """
+        :return: a copy of the session to draw questions for later, its draws don't move this session's cursors
+                 until they're taken (see: main.prefetch_questions).
+        """
+        draft = Session()
+        for field in self.__slots__:
+            setattr(draft, field, getattr(self, field))
+        draft.cursors = {pool_key: cursor.copy() for pool_key, cursor in self.cursors.items()}
+        return draft
+
+    def to_dict(self):
+        """
+        :return: the session as a JSON serializable dict.
+        """
+        values = {field: getattr(self, field) for field in self.FIELDS}
+        data = {field: None if value is None else value.value for field, value in values.items()}
+        data['cursors'] = {pool_key: cursor.to_dict() for pool_key, cursor in self.cursors.items()}
+        data['weights'] = {pool_key: weights.to_dict() for pool_key, weights in self.weights.items()}
+        data['stats'] = {pool_key: list(counts) for pool_key, counts in self.stats.items()}  # written later
+        data['menu_message_id'] = self.menu_message_id
+        return data
+
+    @staticmethod
+    def from_dict(data):
+        """
+        :param data: a session as returned by to_dict.
+        :return: new Session.
+        """
+        user_session = Session()
+        for field, enum_type in Session.FIELDS.items():
+            if data.get(field) is not None:
+                setattr(user_session, field, enum_type(data[field]))
+        user_session.cursors = {pool_key: DrawCursor.from_dict(cursor)
+                                for pool_key, cursor in data.get('cursors', {}).items()}
+        user_session.weights = {pool_key: WeightTree.from_dict(weights)
+                                for pool_key, weights in data.get('weights', {}).items()}
+        user_session.stats = {pool_key: list(counts) for pool_key, counts in data.get('stats', {}).items()}
+        user_session.menu_message_id = data.get('menu_message_id')
+        return user_session
+
+
+# _______________sessions storage___________________
+
+class MemoryBackend:
+    """
+    Keeping the saved sessions in the process memory (lost on restart), at most max_size of them:
+    the sessions of the users who didn't come back for the longest are forgotten.
+    Every backend has load(chat_id) -> session dict or None, and save_many({chat_id: session dict}).
+    """
+
+    def __init__(self, max_size=MEMORY_STORE_SIZE):
+        self.max_size = max_size
+        self.sessions = OrderedDict()  # chat id -> session dict, least recently used first
+        self.lock = threading.Lock()
+
+    def load(self, chat_id):
+        with self.lock:
+            data = self.sessions.get(chat_id)
+            if data is not None:
+                self.sessions.move_to_end(chat_id)
+        return data
+
+    def save_many(self, sessions):
+        with self.lock:
+            for chat_id, data in sessions.items():
+                self.sessions[chat_id] = data
+                self.sessions.move_to_end(chat_id)
+            while len(self.sessions) > self.max_size:
+                self.sessions.popitem(last=False)
+
+
+class SqliteBackend:
+    """
+    Keeping the saved sessions in a SQLite file, as JSON per chat id.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')  # bot worker processes share the file
+            self.connection.execute('CREATE TABLE IF NOT EXISTS sessions (chat_id INTEGER PRIMARY KEY, data TEXT)')
+
+    def load(self, chat_id):
+        with self.lock:
+            row = self.connection.execute('SELECT data FROM sessions WHERE chat_id = ?', (chat_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_many(self, sessions):
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO sessions VALUES (?, ?)',
+                                        [(chat_id, json.dumps(data)) for chat_id, data in sessions.items()])
+
+
+class MongoBackend:
+    """
+    Keeping the saved sessions in a MongoDB collection, a document per chat id.
+    """
+
+    def __init__(self, uri, collection='sessions'):
+        import pymongo  # only needed when sessions are kept in MongoDB
+
+        self.pymongo = pymongo
+        self.collection = pymongo.MongoClient(uri).get_default_database('PsychometryBot')[collection]
+
+    def load(self, chat_id):
+        document = self.collection.find_one({'_id': chat_id})
+        return document and document['data']
+
+    def save_many(self, sessions):
+        self.collection.bulk_write([self.pymongo.ReplaceOne({'_id': chat_id}, {'_id': chat_id, 'data': data},
+                                                            upsert=True) for chat_id, data in sessions.items()])
+
+
+def create_backend(url=SESSION_STORE):
+    """
+    :param url: where to keep the sessions: memory | sqlite:///<path> | mongodb://<host>/<db>
+    :return: the backend for the url.
+    """
+    if url.startswith('sqlite:///'):
+        return SqliteBackend(url[len('sqlite:///'):])
+    if url.startswith('mongodb://') or url.startswith('mongodb+srv://'):
+        return MongoBackend(url)
+    return MemoryBackend()
+
+
+class SessionStore:
+    """
+    The users' sessions by chat id: the recently used sessions are cached in memory (LRU, with a max size and
+    an idle TTL), the rest are loaded from the backend when the user comes back.
+    Saved sessions are written to the backend in batches by a background thread (write-behind),
+    so handlers never wait for the backend to write.
+    """
+
+    def __init__(self, backend=None, max_size=SESSION_CACHE_SIZE, ttl=SESSION_TTL,
+                 flush_interval=FLUSH_INTERVAL, batch_size=FLUSH_BATCH_SIZE):
+        self.backend = backend if backend is not None else create_backend()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.cache = OrderedDict()  # chat id -> (Session, last used time), least recently used first
+        self.pending = {}  # chat id -> session dict waiting to be written
+        self.lock = threading.Lock()
+        self.flush_needed = threading.Event()
+        threading.Thread(target=self.flush_loop, name='session-flush', daemon=True).start()
+        atexit.register(self.flush)
+
+    def get(self, chat_id):
+        """
+        :param chat_id: the user's chat id.
+        :return: the user's Session, None if the user has no session.
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.cache.get(chat_id)
+            if entry is not None:
+                self.cache.move_to_end(chat_id)
+                self.cache[chat_id] = (entry[0], now)
+                return entry[0]
+            data = self.pending.get(chat_id)
+
+        if data is None:
+            data = self.backend.load(chat_id)
+            if data is None:
+                return None
+        user_session = Session.from_dict(data)
+        with self.lock:
+            entry = self.cache.get(chat_id)
+            if entry is not None:  # loaded by another thread meanwhile, its session is the one being changed
+                return entry[0]
+            self.cache[chat_id] = (user_session, now)
+            self.evict(now)
+        return user_session
+
+    def __setitem__(self, chat_id, user_session):
+        with self.lock:
+            self.cache[chat_id] = (user_session, time.monotonic())
+            self.cache.move_to_end(chat_id)
+            self.evict(time.monotonic())
+        self.save(chat_id)
+
+    def __len__(self):
+        return len(self.cache)
+
+    def save(self, chat_id):
+        """
+        Queueing the user's session to be written to the backend.
+        :param chat_id: the user's chat id.
+        """
+        with self.lock:
+            entry = self.cache.get(chat_id)
+            if entry is None:
+                return
+            self.pending[chat_id] = entry[0].to_dict()
+            if len(self.pending) >= self.batch_size:
+                self.flush_needed.set()
+
+    def evict(self, now):
+        """Dropping the least recently used sessions above max size and the idle ones, the lock must be held."""
+        while self.cache:
+            chat_id, (user_session, used) = next(iter(self.cache.items()))
+            if len(self.cache) <= self.max_size and now - used < self.ttl:
+                break
+            del self.cache[chat_id]
 
+    def flush(self):
+        """Writing the queued sessions to the backend."""
+        with self.lock:
+            sessions, self.pending = self.pending, {}
+        if sessions:
+            try:
+                self.backend.save_many(sessions)
+            except Exception:
+                logger.exception("Failed saving %d sessions", len(sessions))
+                with self.lock:  # newer saves of the same sessions win
+                    self.pending = {**sessions, **self.pending}
 
+    def flush_loop(self):
+        while True:
+            self.flush_needed.wait(self.flush_interval)
+            self.flush_needed.clear()
+            self.flush()
@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)  # the bank and the DATA paths are relative to the working directory
+os.environ['SESSION_STORE'] = 'memory'
+
+
+@pytest.fixture
+def bot_main(monkeypatch, tmp_path):
+    """
+    The bot's main module with a recording stub instead of the Telegram API (see: RecordingSender),
+    fresh sessions, guards and prefetched batches, and a file_id cache of its own. The bank is the bundled DB's.
+    """
+    import callbacks
+    import main
+    import prefetch
+    from file_cache import FileIdCache
+    from session import SessionStore, MemoryBackend
+    from tests.stubs import RecordingSender
+
+    monkeypatch.setattr(main, 'sender', RecordingSender())
+    monkeypatch.setattr(main, 'users_sessions', SessionStore(MemoryBackend(), flush_interval=3600))
+    monkeypatch.setattr(main, 'prefetched', prefetch.PrefetchCache())
+    monkeypatch.setattr(main, 'callback_guard', callbacks.CallbackGuard())
+    monkeypatch.setattr(main, 'photo_cache', FileIdCache(str(tmp_path / 'file_ids.json')))
+    monkeypatch.setattr(main, 'dispatcher', None)
+    yield main
+    main.open_polls.polls.clear()
+
@@ -0,0 +1,31 @@
+"""Stand-ins for the Telegram API, for the tests."""
+from tools.stub_sender import StubSender
+
+
+class RecordingSender(StubSender):
+    """StubSender keeping every call: (method name, args, kwargs, result)."""
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    def __getattr__(self, name):
+        call = super().__getattr__(name)
+
+        def record(*args, **kwargs):
+            result = call(*args, **kwargs)
+            if name == 'edit_message_text':  # Telegram returns the edited message
+                result.message_id = kwargs['message_id']
+            self.sent.append((name, args, kwargs, result))
+            return result
+        return record
+
+    def methods(self):
+        return [name for name, args, kwargs, result in self.sent]
+
+    def last_menu(self):
+        """:return: (the reply markup, message id) of the last menu sent or edited, Nones if there is none."""
+        for name, args, kwargs, result in reversed(self.sent):
+            if kwargs.get('reply_markup'):
+                return kwargs['reply_markup'], result.message_id
+        return None, None
@@ -0,0 +1,142 @@
+import itertools
+import random
+from collections import Counter
+
+import bank
+from bank import QuestionBank, BankReloader, DrawCursor, WeightTree
+
+
+def write_bank(tmp_path, tables):
+    """
+    Writing a bank's compiled DB, with a stand-in MS Excel file it was compiled from.
+    :return: (path, compiled path) of the bank.
+    """
+    path, compiled_path = str(tmp_path / 'DB.xlsx'), str(tmp_path / 'DB.sqlite')
+    with open(path, 'wb') as file:
+        file.write(b'stand-in')
+    bank.write_compiled(tables, path, compiled_path)
+    return path, compiled_path
+
+
+def without_eng_com(tables):
+    """:return: the bundled DB's tables without most of its English sentence completion questions."""
+    eng_rows, voc_rows, math_rows = tables
+    eng_com = [row for row in eng_rows if row[6] == 'eng_com']
+    return [[row for row in eng_rows if row[6] != 'eng_com'] + eng_com[:3], voc_rows, math_rows]
+
+
+def test_reload_hands_over_a_valid_bank(tmp_path):
+    reloaded = []
+    reloader = BankReloader(reloaded.append, *write_bank(tmp_path, QuestionBank.read_compiled()))
+    new_bank, seconds, problems = reloader.reload()
+
+    assert problems == []
+    assert reloaded == [new_bank]
+    assert len(new_bank) == len(QuestionBank(*QuestionBank.read_compiled()))
+
+
+def test_reload_keeps_the_current_bank_when_the_new_one_is_invalid(tmp_path):
+    reloaded = []
+    reloader = BankReloader(reloaded.append, *write_bank(tmp_path, without_eng_com(QuestionBank.read_compiled())))
+    new_bank, seconds, problems = reloader.reload()
+
+    assert new_bank is None and reloaded == []
+    assert problems == ["eng_built eng_com: 3 questions, at least 10 needed"]
+
+
+def test_reload_keeps_the_current_bank_when_the_file_is_malformed(tmp_path):
+    path = tmp_path / 'DB.xlsx'
+    path.write_bytes(b'not an MS Excel file')
+    reloaded = []
+    new_bank, seconds, problems = BankReloader(reloaded.append, str(path), str(tmp_path / 'DB.sqlite')).reload()
+
+    assert new_bank is None and reloaded == []
+    assert len(problems) == 1
+
+
+def test_reload_command_reports_the_result(bot_main, monkeypatch, tmp_path):
+    current_bank = bot_main.question_bank
+    monkeypatch.setattr(bot_main, 'question_bank', current_bank)
+    tables = QuestionBank.read_compiled()
+    invalid_paths = write_bank(tmp_path, without_eng_com(tables))
+    monkeypatch.setattr(bot_main, 'reloader', BankReloader(bot_main.swap_bank, *invalid_paths))
+    bot_main.report_reload(bot_main.chat)
+    assert bot_main.question_bank is current_bank
+    reply = bot_main.sender.sent[-1][1][1]
+    assert reply.startswith("The questions bank wasn't reloaded") and "eng_built eng_com: 3 questions" in reply
+
+    valid_dir = tmp_path / 'valid'
+    valid_dir.mkdir()
+    monkeypatch.setattr(bot_main, 'reloader', BankReloader(bot_main.swap_bank, *write_bank(valid_dir, tables)))
+    bot_main.report_reload(bot_main.chat)
+    assert bot_main.question_bank is not current_bank
+    assert bot_main.sender.sent[-1][1][1].endswith(": {} questions".format(len(bot_main.question_bank)))
+
+
+def test_cursor_does_not_repeat_until_the_pool_is_exhausted():
+    cursor = DrawCursor()
+    first_pass = list(itertools.chain.from_iterable(cursor.take(7, 20) for i in range(2)))
+    first_pass += cursor.take(6, 20)
+    assert sorted(first_pass) == list(range(20))
+
+    partial = DrawCursor()
+    taken = partial.take(15, 20)
+    crossing = partial.take(10, 20)  # the 5 left of the first pass, then 5 of the next pass
+    assert len(set(crossing)) == 10 and set(crossing[:5]) == set(range(20)) - set(taken)
+
+
+def test_cursor_survives_a_pool_change():
+    cursor = DrawCursor()
+    cursor.take(10, 20)
+    grown = list(itertools.chain.from_iterable(cursor.take(5, 25) for i in range(5)))
+    assert sorted(grown) == list(range(25))  # shuffled again for the new pool, every new question is drawn
+    assert sorted(cursor.take(12, 12)) == list(range(12))  # and for a smaller one
+
+
+def test_cursor_round_trips_through_its_dict():
+    for pool_size in (20, 0x10000 + 5):  # 2 and 4 bytes indexes
+        cursor = DrawCursor()
+        cursor.take(3, pool_size)
+        loaded = DrawCursor.from_dict(cursor.to_dict())
+        assert loaded.order == cursor.order and loaded.order.typecode == cursor.order.typecode
+        assert loaded.next == 3
+        assert loaded.take(5, pool_size) == cursor.take(5, pool_size)
+
+
+def test_weight_tree_updates_match_the_weights():
+    rng = random.Random(1)
+    tree, weights = WeightTree(37), [WeightTree.BASE_WEIGHT] * 37
+    for i in range(500):
+        index, correct = rng.randrange(37), rng.random() < 0.5
+        tree.record(index, correct)
+        weight = weights[index]
+        weights[index] = (max(WeightTree.MIN_WEIGHT, weight // 2) if correct
+                          else min(WeightTree.MAX_WEIGHT, weight * 2))
+    assert [tree.weight(index) for index in range(37)] == weights
+    assert [tree.prefix_sum(count) for count in range(38)] == list(itertools.accumulate(weights, initial=0))
+    starts = list(itertools.accumulate(weights, initial=0))
+    for value in range(tree.total()):
+        assert starts[tree.find(value)] <= value < starts[tree.find(value) + 1]
+
+
+def test_weighted_draw_follows_the_weights(monkeypatch):
+    monkeypatch.setattr(bank, 'random', random.Random(2))
+    tree = WeightTree(4)
+    tree.record(0, False)  # 8
+    tree.record(0, False)  # 16
+    tree.record(3, True)  # 2
+    draws = Counter(tree.sample(1)[0] for i in range(26000))
+    weights = [16, 4, 4, 2]
+    for index, weight in enumerate(weights):
+        assert abs(draws[index] / 26000 - weight / sum(weights)) < 0.01
+
+    samples = [tree.sample(4) for i in range(100)]
+    assert all(sorted(sample) == [0, 1, 2, 3] for sample in samples)  # all different
+    assert [tree.weight(index) for index in range(4)] == weights  # a draw doesn't change the weights
+
+
+def test_weight_tree_round_trips_through_its_dict():
+    tree = WeightTree(10)
+    tree.record(4, False)
+    loaded = WeightTree.from_dict(tree.to_dict())
+    assert loaded.tree == tree.tree and len(loaded) == 10 and loaded.weight(4) == 2 * WeightTree.BASE_WEIGHT
@@ -0,0 +1,69 @@
+import queue
+import re
+import time
+from types import SimpleNamespace
+
+import digest
+from digest import NewUsersDigest
+
+TIMEOUT = 5
+
+
+def new_chat(chat_id, username=None, first_name=None, last_name=None, title=None):
+    return SimpleNamespace(id=chat_id, username=username, first_name=first_name, last_name=last_name, title=title)
+
+
+def test_digest_is_sent_once_size_users_are_waiting():
+    sent = queue.Queue()
+    new_users = NewUsersDigest(sent.put, interval=3600, size=3)
+    new_users.start()
+    new_users.add(new_chat(1))
+    new_users.add(new_chat(2))
+    time.sleep(0.05)
+    assert sent.empty()
+
+    new_users.add(new_chat(3))
+    assert sent.get(timeout=TIMEOUT).splitlines()[1:] == ['1', '2', '3']
+    assert new_users.count == 0
+
+
+def test_digest_is_sent_every_interval():
+    sent = queue.Queue()
+    new_users = NewUsersDigest(sent.put, interval=0.05, size=100)
+    new_users.start()
+    start = time.monotonic()
+    new_users.add(new_chat(1))
+    assert sent.get(timeout=TIMEOUT).splitlines()[1:] == ['1']
+    assert time.monotonic() - start < 1
+    new_users.add(new_chat(2))
+    assert sent.get(timeout=TIMEOUT).splitlines()[1:] == ['2']  # a digest per interval with new users
+
+
+def test_digest_message_lists_the_chats_and_counts_the_rest():
+    sent = []
+    new_users = NewUsersDigest(sent.append, size=1000)
+    new_users.add(new_chat(1, username='dana', first_name='Dana', last_name='Levi'))
+    new_users.add(new_chat(-2, title='Study group'))
+    for chat_id in range(3, digest.MAX_LISTED + 6):
+        new_users.add(new_chat(chat_id))
+    new_users.flush()
+
+    lines = sent[0].splitlines()
+    assert re.fullmatch(r"{} new users since \d\d:\d\d:".format(digest.MAX_LISTED + 5), lines[0])
+    assert lines[1:3] == ['1 @dana Dana Levi', '-2 Study group']
+    assert len(lines) == 1 + digest.MAX_LISTED + 1 and lines[-1] == "... and 5 more"
+
+    new_users.flush()
+    assert len(sent) == 1  # nothing waiting, nothing sent
+
+
+def test_failed_digest_is_dropped():
+    def fail(text):
+        raise ConnectionError("Telegram is down")
+
+    new_users = NewUsersDigest(fail)
+    new_users.add(new_chat(1))
+    failed = digest.digests.get(result='failed')
+    new_users.flush()
+    assert digest.digests.get(result='failed') == failed + 1
+    assert new_users.count == 0 and new_users.listed == []
@@ -0,0 +1,103 @@
+import queue
+import random
+import threading
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+
+import pytest
+
+import dispatch
+from tests.updates import message_update
+
+TIMEOUT = 5
+
+
+def fake_bot():
+    """:return: stand-in for the TeleBot, dispatch_updates replaces its process_new_updates."""
+    return SimpleNamespace(last_update_id=0, process_new_updates=None)
+
+
+def test_chat_updates_run_in_order_while_chats_run_in_parallel():
+    dispatcher = dispatch.ChatDispatcher(workers=8)
+    bot = fake_bot()
+    handled = defaultdict(list)
+    running = set()
+    overlapping = []  # updates which started while another update of their chat was running
+    most_running = [0]
+    lock = threading.Lock()
+
+    def handle(update):
+        chat_id = update.message.chat.id
+        with lock:
+            if chat_id in running:
+                overlapping.append(update)
+            running.add(chat_id)
+            most_running[0] = max(most_running[0], len(running))
+        time.sleep(random.uniform(0, 0.002))
+        with lock:
+            running.discard(chat_id)
+            handled[chat_id].append(int(update.message.text))
+
+    dispatch.dispatch_updates(bot, dispatcher, handle)
+    updates = [message_update(chat_id, str(number)) for number in range(30) for chat_id in range(1, 21)]
+    for start in range(0, len(updates), 7):
+        bot.process_new_updates(updates[start:start + 7])
+    dispatcher.join()
+
+    assert not overlapping
+    assert handled == {chat_id: list(range(30)) for chat_id in range(1, 21)}
+    assert most_running[0] > 1
+    assert bot.last_update_id == updates[-1].update_id
+
+
+def test_slow_chat_does_not_block_other_chats():
+    dispatcher = dispatch.ChatDispatcher(workers=8)
+    bot = fake_bot()
+    released = threading.Event()
+    handled = []
+
+    def handle(update):
+        chat_id = update.message.chat.id
+        if update.message.text == 'slow':
+            handled.append((chat_id, released.wait(TIMEOUT)))
+        else:
+            handled.append((chat_id, True))
+            if chat_id == 9:
+                released.set()
+
+    dispatch.dispatch_updates(bot, dispatcher, handle)
+    # chats 1 and 9 used to share a worker (hash(chat_id) % 8)
+    bot.process_new_updates([message_update(1, 'slow'), message_update(1, 'after'), message_update(9, 'fast')])
+    dispatcher.join()
+
+    assert handled == [(9, True), (1, True), (1, True)]
+
+
+def test_submit_times_out_when_full():
+    dispatcher = dispatch.ChatDispatcher(workers=1, queue_size=2)
+    released = threading.Event()
+    dispatcher.submit(1, released.wait, TIMEOUT)
+    dispatcher.submit(2, released.wait, TIMEOUT)
+    with pytest.raises(queue.Full):
+        dispatcher.submit(3, print, timeout=0)
+    released.set()
+    dispatcher.join()
+
+
+def test_updates_are_received_before_waiting_behind_their_chat():
+    dispatcher = dispatch.ChatDispatcher(workers=8)
+    bot = fake_bot()
+    released = threading.Event()
+    received = []
+
+    def handle(update):
+        if update.message.text == 'slow':
+            released.wait(TIMEOUT)
+
+    dispatch.dispatch_updates(bot, dispatcher, handle, receive=lambda update: received.append(update.message.text))
+    bot.process_new_updates([message_update(1, 'slow'), message_update(1, 'tap')])
+
+    assert received == ['slow', 'tap']  # while the chat's slow update still runs
+    released.set()
+    dispatcher.join()
@@ -0,0 +1,49 @@
+import json
+import multiprocessing
+
+from file_cache import FileIdCache
+
+FILES_PER_PROCESS = 20
+
+
+def photo(tmp_path, name):
+    path = tmp_path / name
+    path.write_bytes(name.encode())
+    return str(path)
+
+
+def upload(cache_path, paths):
+    """A worker process saving the file_ids of the photos it uploaded."""
+    cache = FileIdCache(cache_path)
+    for path in paths:
+        cache.set(path, 'id-' + path)
+
+
+def test_saves_merge_the_entries_of_other_processes(tmp_path):
+    cache_path = str(tmp_path / 'file_ids.json')
+    first, second = FileIdCache(cache_path), FileIdCache(cache_path)  # as in two worker processes
+    one, two, three = (photo(tmp_path, name) for name in ('one.png', 'two.png', 'three.png'))
+    first.set(one, 'id-one')
+    first.set(two, 'id-two')
+    second.set(three, 'id-three')
+    second.discard(one)  # e.g. Telegram didn't accept it anymore
+
+    assert json.load(open(cache_path)).keys() == {two, three}
+    assert second.get(two) == 'id-two'  # read back with its save
+    assert FileIdCache(cache_path).get(one) is None
+
+
+def test_concurrent_processes_keep_every_entry(tmp_path):
+    cache_path = str(tmp_path / 'file_ids.json')
+    groups = [[photo(tmp_path, '{}-{}.png'.format(group, number)) for number in range(FILES_PER_PROCESS)]
+              for group in range(4)]
+    processes = [multiprocessing.get_context('fork').Process(target=upload, args=(cache_path, paths))
+                 for paths in groups]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    cache = FileIdCache(cache_path)
+    assert all(cache.get(path) == 'id-' + path for paths in groups for path in paths)
+    assert not list(tmp_path.glob('*.tmp'))
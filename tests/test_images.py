@@ -0,0 +1,40 @@
+import os
+
+from PIL import Image
+
+import bank
+from tools import optimize_images
+
+
+def test_transparent_image_is_flattened_onto_white(tmp_path):
+    source_path, optimized_path = str(tmp_path / 'source.png'), str(tmp_path / 'optimized' / 'source.png')
+    image = Image.new('RGBA', (40, 20), (0, 0, 0, 0))
+    image.paste((200, 0, 0, 255), (0, 0, 20, 20))
+    image.save(source_path)
+
+    assert optimize_images.optimize(source_path, optimized_path) == (40, 20)
+    optimized = Image.open(optimized_path).convert('RGBA')
+    assert optimized.getpixel((5, 5)) == (200, 0, 0, 255)
+    assert optimized.getpixel((30, 5)) == (255, 255, 255, 255)  # not black, as the dropped alpha left it
+
+
+def test_resolve_image_falls_back_to_the_original(tmp_path):
+    source_path, optimized_path = str(tmp_path / 'source.png'), str(tmp_path / 'optimized.png')
+    Image.new('RGB', (10, 10), (0, 0, 200)).save(source_path)
+    Image.new('P', (10, 10)).save(optimized_path)
+    stat = os.stat(source_path)
+    manifest = {source_path: {'path': optimized_path, 'source_bytes': stat.st_size, 'source_mtime': stat.st_mtime,
+                              'source_sha256': bank.file_hash(source_path)}}
+    assert bank.resolve_image(source_path, manifest) == optimized_path
+    assert bank.resolve_image(str(tmp_path / 'other.png'), manifest) == str(tmp_path / 'other.png')
+
+    os.utime(source_path, (stat.st_atime, stat.st_mtime + 10))  # touched, the same content
+    assert bank.resolve_image(source_path, manifest) == optimized_path
+
+    Image.new('RGB', (10, 10), (0, 200, 0)).save(source_path)  # changed since it was optimized
+    manifest[source_path]['source_bytes'] = os.path.getsize(source_path)
+    assert bank.resolve_image(source_path, manifest) == source_path
+
+    os.remove(optimized_path)  # e.g. DATA/OPTIMIZED wasn't deployed
+    manifest = {source_path: dict(manifest[source_path], source_sha256=bank.file_hash(source_path))}
+    assert bank.resolve_image(source_path, manifest) == source_path
@@ -0,0 +1,263 @@
+import itertools
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import keyboards
+import main
+from menu import MenuType, QuestionType, AmountQuestion, MenuAnswer
+from session import Session
+from tests.stubs import RecordingSender
+from tests.updates import message_update, callback_update
+
+MENU_ID = 50  # the tapped menu's message id
+FULL_MIX_AMOUNT = 20
+
+# the menu functions -> the keyboard of the menu they show
+MENU_KEYBOARDS = {
+    main.main_menu: keyboards.MAIN_MENU,
+    main.hebrew_menu: keyboards.MAIN_MENU,
+    main.english_main_menu: keyboards.ENGLISH_MAIN_MENU,
+    main.english_voc_menu: keyboards.ENGLISH_VOC_MENU,
+    main.math_main_menu: keyboards.MATH_MAIN_MENU,
+    main.unit_num_menu: keyboards.UNIT_NUM_MENU,
+    main.amount_menu: keyboards.AMOUNT_MENU,
+    main.repeat_menu: keyboards.REPEAT_MENU,
+}
+
+chat_ids = itertools.count(2000)
+
+
+def selected_session():
+    """:return: a session in the middle of a complete selection, so any transition to the questions has one."""
+    user_session = Session()
+    user_session.subject, user_session.question_type = MenuType.ENGLISH, QuestionType.ENG_COM
+    user_session.question_amount = AmountQuestion.FIVE
+    return user_session
+
+
+def buttons(markup):
+    """:return: the callback data of the menu's buttons which are menu answers."""
+    return [button['callback_data'] for row in json.loads(markup)['inline_keyboard'] for button in row
+            if MenuAnswer.decode(button['callback_data']) is not None]
+
+
+@pytest.mark.parametrize('menu_type, option', list(main.MENU_TRANSITIONS),
+                         ids=lambda value: getattr(value, 'value', value))
+def test_menu_transition(bot_main, menu_type, option):
+    chat_id = next(chat_ids)
+    user_session = selected_session()
+    bot_main.users_sessions[chat_id] = user_session
+    fields = {field: getattr(user_session, field) for field in Session.FIELDS}
+    mutation, next_action = main.MENU_TRANSITIONS[(menu_type, option)]
+
+    bot_main.make_action(MenuAnswer.decode(MenuAnswer(menu_type, option).encode()), chat_id, MENU_ID)
+
+    fields.update({field: option if value is main.SELECTED else value for field, value in mutation.items()})
+    assert {field: getattr(user_session, field) for field in Session.FIELDS} == fields
+    sender = bot_main.sender
+    if next_action is main.call_questions:
+        amount = FULL_MIX_AMOUNT if user_session.subject == MenuType.COMBINATION else int(user_session.question_amount)
+        assert sender.methods()[0] == 'edit_message_reply_markup'  # the tapped menu's buttons are removed
+        assert sender.sent[0][1] == (chat_id, MENU_ID)
+        assert sender.calls['send_poll'] == amount
+        assert len(bot_main.open_polls) == amount
+        assert sender.last_menu()[0] == keyboards.REPEAT_MENU
+        assert sender.methods()[-1] == 'send_message'  # below the questions
+    else:
+        assert sender.methods() == ['edit_message_text']
+        name, args, kwargs, result = sender.sent[0]
+        assert kwargs == {'chat_id': chat_id, 'message_id': MENU_ID, 'reply_markup': MENU_KEYBOARDS[next_action]}
+
+
+def test_every_menu_path_ends_in_questions(bot_main):
+    """
+    Walking every path of buttons from the main menu (a chat per path), until the path asks for questions:
+    each one gets a batch of its amount and the repeat menu, repeating gets another batch and the menu resets.
+    Hebrew leads back to the main menu, it's walked once.
+    """
+    sender = bot_main.sender
+    reached = set()
+    paths = [[]]
+    completed = 0
+    while paths:
+        path = paths.pop()
+        chat_id = next(chat_ids)
+        bot_main.process_update(message_update(chat_id, '/start'))
+        for data in path:
+            markup, message_id = sender.last_menu()
+            assert data in buttons(markup)
+            sender.sent.clear()
+            sender.calls.clear()
+            bot_main.process_update(callback_update(chat_id, data, message_id))
+            menu_answer = MenuAnswer.decode(data)
+            reached.add((menu_answer.menu_type, menu_answer.option))
+
+        markup, message_id = sender.last_menu()
+        if markup != keyboards.REPEAT_MENU:
+            assert not sender.calls['send_poll']
+            paths += [path + [data] for data in buttons(markup) if data != 'N:H']  # hebrew: see below
+            continue
+
+        user_session = bot_main.users_sessions.get(chat_id)
+        amount = FULL_MIX_AMOUNT if user_session.subject == MenuType.COMBINATION else int(user_session.question_amount)
+        assert sender.calls['send_poll'] == amount, path
+        for data in ('R:RP', 'R:N'):
+            markup, message_id = sender.last_menu()
+            sender.sent.clear()
+            sender.calls.clear()
+            bot_main.process_update(callback_update(chat_id, data, message_id))
+            reached.add((MenuAnswer.decode(data).menu_type, MenuAnswer.decode(data).option))
+            if data == 'R:RP':
+                assert sender.calls['send_poll'] == amount, path
+        assert sender.last_menu()[0] == keyboards.MAIN_MENU
+        assert all(getattr(user_session, field) is None for field in Session.FIELDS)
+        completed += 1
+
+    hebrew_chat = next(chat_ids)
+    bot_main.process_update(message_update(hebrew_chat, '/start'))
+    bot_main.process_update(callback_update(hebrew_chat, 'N:H', sender.last_menu()[1]))
+    reached.add((MenuType.MAIN, MenuType.HEBREW))
+    assert sender.last_menu()[0] == keyboards.MAIN_MENU
+
+    assert reached == set(main.MENU_TRANSITIONS)
+    assert completed == 3 * 11 * 3 + 3 * 3 + 4 * 3 + 1  # vocabulary, other english, math, everything mixed
+
+
+class DeferredSender(RecordingSender):
+    """RecordingSender keeping the jobs until they're released, as if they waited for their rate."""
+
+    def __init__(self):
+        super().__init__()
+        self.jobs = []
+
+    def run(self, chat_id, job):
+        self.jobs.append((chat_id, job))
+
+    def release(self):
+        while self.jobs:
+            super().run(*self.jobs.pop(0))
+
+
+def test_batch_asked_while_one_is_sending_is_dropped(bot_main, monkeypatch):
+    sender = DeferredSender()
+    monkeypatch.setattr(bot_main, 'sender', sender)
+    chat_id = next(chat_ids)
+    bot_main.users_sessions[chat_id] = selected_session()
+
+    bot_main.call_questions(chat_id, MENU_ID)
+    bot_main.call_questions(chat_id, MENU_ID)  # e.g. repeat tapped before the batch was sent
+    sender.release()
+    assert sender.calls['send_poll'] == 5
+
+    bot_main.call_questions(chat_id)  # once it was sent
+    sender.release()
+    assert sender.calls['send_poll'] == 10
+
+
+def test_taps_on_a_replaced_menu_are_dropped(bot_main):
+    sender = bot_main.sender
+    chat_id = next(chat_ids)
+    bot_main.process_update(message_update(chat_id, '/start'))
+    first_menu = sender.last_menu()[1]
+    bot_main.process_update(callback_update(chat_id, MenuAnswer(MenuType.MAIN, MenuType.ENGLISH).encode(), first_menu))
+    sender.sent.clear()
+
+    bot_main.process_update(message_update(chat_id, 'hello'))  # brings up a new main menu
+    markup, second_menu = sender.last_menu()
+    assert markup == keyboards.MAIN_MENU and second_menu != first_menu
+    assert sender.sent[-1][:2] == ('edit_message_reply_markup', (chat_id, first_menu))  # the replaced menu's buttons
+    sender.sent.clear()
+
+    bot_main.process_update(callback_update(chat_id, MenuAnswer(MenuType.ENGLISH, QuestionType.ENG_COM).encode(),
+                                            first_menu))
+    assert sender.sent == []
+    assert bot_main.users_sessions.get(chat_id).question_type is None
+    bot_main.process_update(callback_update(chat_id, MenuAnswer(MenuType.MAIN, MenuType.MATH).encode(), second_menu))
+    assert sender.last_menu() == (keyboards.MATH_MAIN_MENU, second_menu)
+
+
+class TappingSender(RecordingSender):
+    """RecordingSender handling a tap on a sent menu before the send's response is back to its job."""
+
+    def __init__(self, bot_main):
+        super().__init__()
+        self.bot_main = bot_main
+        self.taps = {}  # the menu's keyboard -> callback data tapped on the menu as soon as it's sent
+
+    def __getattr__(self, name):
+        call = super().__getattr__(name)
+
+        def send(*args, **kwargs):
+            result = call(*args, **kwargs)
+            data = self.taps.pop(kwargs.get('reply_markup'), None)
+            if name == 'send_message' and data is not None:
+                self.bot_main.process_update(callback_update(args[0], data, result.message_id))
+            return result
+        return send
+
+
+def test_tap_handled_before_its_menu_send_was_recorded(bot_main, monkeypatch):
+    sender = TappingSender(bot_main)
+    monkeypatch.setattr(bot_main, 'sender', sender)
+    chat_id = next(chat_ids)
+    bot_main.users_sessions[chat_id] = Session()
+    bot_main.process_update(message_update(chat_id, '/start'))
+    first_menu = sender.last_menu()[1]
+
+    sender.taps[keyboards.MAIN_MENU] = MenuAnswer(MenuType.MAIN, MenuType.ENGLISH).encode()
+    bot_main.process_update(message_update(chat_id, 'hello'))
+    second_menu = bot_main.users_sessions.get(chat_id).menu_message_id
+    assert second_menu > first_menu
+    assert ('edit_message_reply_markup', (chat_id, second_menu)) not in [call[:2] for call in sender.sent]
+    assert sender.last_menu() == (keyboards.ENGLISH_MAIN_MENU, second_menu)
+
+    bot_main.process_update(callback_update(chat_id, MenuAnswer(MenuType.ENGLISH, QuestionType.ENG_COM).encode(),
+                                            second_menu))
+    sender.taps[keyboards.REPEAT_MENU] = MenuAnswer(MenuType.REPEAT, QuestionType.REPEAT).encode()
+    bot_main.process_update(callback_update(chat_id, MenuAnswer(MenuType.AMOUNT, AmountQuestion.FIVE).encode(),
+                                            second_menu))
+    assert sender.calls['send_poll'] == 10  # the repeat menu's tap wasn't dropped while its send was in flight
+    assert sender.last_menu()[0] == keyboards.REPEAT_MENU
+
+
+def test_admin_commands_are_answered_by_each_worker(bot_main, monkeypatch):
+    monkeypatch.setattr(bot_main, 'worker_name', "Worker 1: ")
+    admin = {'message': {'chat': {'id': bot_main.chat}, 'text': '/profile@PsychometryBot 5'}}
+    assert bot_main.is_admin_command(admin)
+    assert not bot_main.is_admin_command({'message': {'chat': {'id': bot_main.chat}, 'text': '/start'}})
+    assert not bot_main.is_admin_command({'message': {'chat': {'id': bot_main.chat + 1}, 'text': '/reload'}})
+
+    bot_main.process_update(message_update(bot_main.chat, '/profile 5'))
+    bot_main.profiler.stop()
+    assert bot_main.sender.sent[-1][1][1].startswith("Worker 1: Profiling the next 5 updates")
+
+
+def test_same_button_tapped_again_on_the_menu_edited_back(bot_main, monkeypatch):
+    sender = DeferredSender()
+    monkeypatch.setattr(bot_main, 'sender', sender)
+    chat_id = next(chat_ids)
+    bot_main.users_sessions[chat_id] = Session()
+    bot_main.process_update(message_update(chat_id, '/start'))
+    sender.release()
+    menu = sender.last_menu()[1]
+    hebrew = MenuAnswer(MenuType.MAIN, MenuType.HEBREW).encode()  # edits the main menu back into the main menu
+    bot_main.process_update(callback_update(chat_id, hebrew, menu))
+    bot_main.process_update(callback_update(chat_id, hebrew, menu))  # a double tap, before the menu was edited
+    sender.release()
+    assert sender.methods().count('edit_message_text') == 1
+
+    bot_main.process_update(callback_update(chat_id, hebrew, menu))  # within the TTL, on the menu shown again
+    sender.release()
+    assert sender.methods().count('edit_message_text') == 2
+
+
+def test_polling_exits_while_a_webhook_is_set(bot_main, monkeypatch):
+    webhook = SimpleNamespace(url='')
+    monkeypatch.setattr(bot_main.bot, 'get_webhook_info', lambda: webhook)
+    bot_main.exit_if_webhook_set()
+
+    webhook.url = 'https://bot.example.com/telegram'
+    with pytest.raises(SystemExit, match='webhook is set'):
+        bot_main.exit_if_webhook_set()
@@ -0,0 +1,56 @@
+import re
+
+import metrics
+from menu import MenuType, QuestionType, AmountQuestion, MenuAnswer
+import outbound
+from tests.updates import message_update, callback_update, poll_answer_update
+from tools.stub_sender import StubSender
+
+CHAT_ID = 4000
+# 5 English sentence completion questions
+SELECTION = [MenuAnswer(MenuType.MAIN, MenuType.ENGLISH), MenuAnswer(MenuType.ENGLISH, QuestionType.ENG_COM),
+             MenuAnswer(MenuType.AMOUNT, AmountQuestion.FIVE)]
+SAMPLE = re.compile(r'^(\w+(?:\{.*\})?) (\S+)$')
+
+
+def samples():
+    """:return: sample name with its labels -> value, of the current metrics exposition."""
+    return {match.group(1): float(match.group(2))
+            for match in map(SAMPLE.match, metrics.exposition().splitlines()) if match}
+
+
+def increase(before, after, name):
+    return after.get(name, 0) - before.get(name, 0)
+
+
+def receive(bot_main, update):
+    """Handling the update as the bot does when it's received (see: main.acknowledge)."""
+    bot_main.acknowledge(update)
+    bot_main.process_update(update)
+
+
+def test_updates_are_measured(bot_main, monkeypatch):
+    sender = outbound.OutboundQueue(StubSender(), global_rate=1000, global_burst=1000, chat_rate=1000, chat_burst=1000)
+    monkeypatch.setattr(bot_main, 'sender', sender)  # the real queue, sending to a stub of Telegram's API
+    before = samples()
+
+    bot_main.process_update(message_update(CHAT_ID, '/start'))
+    sender.join()
+    for menu_answer in SELECTION:
+        receive(bot_main, callback_update(CHAT_ID, menu_answer.encode(), message_id=1))
+        sender.join()
+    for poll_id in list(bot_main.open_polls.polls):
+        bot_main.process_update(poll_answer_update(CHAT_ID, poll_id, 0))
+    after = samples()
+
+    assert increase(before, after, 'handler_seconds_count{handler="callback"}') == 3
+    assert increase(before, after, 'handler_seconds_count{handler="call_questions"}') == 1
+    assert increase(before, after, 'handler_seconds_count{handler="poll_answer"}') == 5
+    assert increase(before, after, 'menu_answers_total{menu="MAIN_MENU",option="ENGLISH_MENU"}') == 1
+    assert increase(before, after, 'menu_answers_total{menu="AMOUNT_MENU",option="5"}') == 1
+    assert increase(before, after, 'outbound_api_calls_total{method="send_poll"}') == 5
+    assert increase(before, after, 'outbound_wait_seconds_count{method="send_poll"}') == 5
+    assert increase(before, after, 'outbound_call_seconds_count{method="answer_callback_query"}') == 3
+    assert after.get('outbound_queue_depth', 0) == 0  # every call was sent
+    assert after['active_sessions'] == 1
+    assert increase(before, after, 'poll_answers_total{result="tracked"}') == 5
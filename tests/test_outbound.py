@@ -0,0 +1,187 @@
+import socket
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+import requests
+from telebot.apihelper import ApiTelegramException
+
+import outbound
+from outbound import calls
+
+TIMEOUT = 5
+
+
+class FakeBot:
+    """Standing in for the TeleBot: records every call with its time, fails the calls it was told to fail."""
+
+    def __init__(self):
+        self.sent = []  # (method name, args, time.monotonic())
+        self.failures = {}  # method name -> errors to raise on its next calls
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        def method(*args, **kwargs):
+            with self.lock:
+                self.sent.append((name, args, time.monotonic()))
+                message_id = len(self.sent)
+                errors = self.failures.get(name)
+                if errors:
+                    raise errors.pop(0)
+            return SimpleNamespace(message_id=message_id)
+        return method
+
+
+def api_error(error_code, **parameters):
+    return ApiTelegramException('sendMessage', None, {'error_code': error_code, 'description': 'error',
+                                                      'parameters': parameters})
+
+
+def texts(bot, chat_id):
+    return [args[1] for name, args, sent_time in bot.sent if args and args[0] == chat_id]
+
+
+def test_paced_chat_does_not_hold_up_other_chats():
+    bot = FakeBot()
+    sender = outbound.OutboundQueue(bot, global_rate=1000, global_burst=1000, chat_rate=10, chat_burst=1, threads=1)
+    start = time.monotonic()
+    for number in range(5):
+        sender.send_message(1, str(number))
+    sender.send_message(2, 'other')
+    sender.join()
+
+    assert texts(bot, 1) == ['0', '1', '2', '3', '4']
+    times = {args[:2]: sent_time - start for name, args, sent_time in bot.sent}
+    assert times[(2, 'other')] < 0.05  # not after chat 1's paced messages, though a single thread sends
+    assert times[(1, '4')] >= 0.35  # chat 1 is paced at 10 messages per second
+
+
+def test_job_gets_its_calls_results_and_errors_in_order():
+    bot = FakeBot()
+    bot.failures['edit_message_text'] = [api_error(400)]
+    sender = outbound.OutboundQueue(bot, threads=4)
+    results = []
+
+    def job(chat_id):
+        message = yield calls.send_message(chat_id, 'question')
+        results.append(message.message_id)
+        try:
+            yield calls.edit_message_text('menu', chat_id=chat_id, message_id=message.message_id)
+        except ApiTelegramException as e:
+            results.append(e.error_code)
+            yield calls.send_message(chat_id, 'menu')
+
+    sender.run(1, job(1))
+    sender.send_message(1, 'after')
+    sender.join()
+
+    assert results == [1, 400]
+    assert [name for name, args, sent_time in bot.sent] == ['send_message', 'edit_message_text', 'send_message',
+                                                            'send_message']
+    assert texts(bot, 1) == ['question', 'menu', 'after']
+
+
+def test_flood_error_is_retried():
+    bot = FakeBot()
+    bot.failures['send_message'] = [api_error(429, retry_after=0)]
+    sender = outbound.OutboundQueue(bot, chat_rate=100, threads=1)
+    assert sender.call(1, 'send_message', 1, 'text').message_id == 2
+    assert texts(bot, 1) == ['text', 'text']
+
+
+def test_failed_job_does_not_stop_the_chat():
+    bot = FakeBot()
+    bot.failures['send_message'] = [api_error(400)]
+    sender = outbound.OutboundQueue(bot, threads=1)
+    sender.send_message(1, 'failing')
+    sender.send_message(1, 'next')
+    done = threading.Event()
+    threading.Thread(target=lambda: (sender.join(), done.set()), daemon=True).start()
+    assert done.wait(TIMEOUT)
+    assert texts(bot, 1) == ['failing', 'next']
+
+
+def test_send_is_not_retried_after_a_read_timeout():
+    bot = FakeBot()
+    bot.failures['send_message'] = [requests.exceptions.ReadTimeout()]
+    sender = outbound.OutboundQueue(bot, threads=1)
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        sender.call(1, 'send_message', 1, 'text')
+    assert texts(bot, 1) == ['text']
+
+
+def test_send_is_retried_when_it_failed_to_connect():
+    bot = FakeBot()
+    bot.failures['send_message'] = [requests.exceptions.ConnectTimeout()]
+    bot.failures['edit_message_reply_markup'] = [requests.exceptions.ReadTimeout()]
+    sender = outbound.OutboundQueue(bot, threads=1)
+    sender.call(1, 'send_message', 1, 'text')
+    sender.call(1, 'edit_message_reply_markup', 1, 'menu')
+    assert texts(bot, 1) == ['text', 'text', 'menu', 'menu']
+
+
+def test_refused_connection_failed_to_connect():
+    with socket.socket() as unused:  # a port nothing listens on
+        unused.bind(('127.0.0.1', 0))
+        port = unused.getsockname()[1]
+    with pytest.raises(requests.exceptions.ConnectionError) as refused:
+        requests.post('http://127.0.0.1:{}'.format(port), timeout=1)
+    assert outbound.connect_failed(refused.value)
+    assert not outbound.connect_failed(requests.exceptions.ReadTimeout())
+    assert not outbound.connect_failed(requests.exceptions.ConnectionError("Connection aborted."))
+
+
+def test_callback_answers_are_not_paced():
+    bot = FakeBot()
+    sender = outbound.OutboundQueue(bot, global_rate=10, global_burst=1, chat_rate=10, chat_burst=1, threads=1)
+    start = time.monotonic()
+    for number in range(3):
+        sender.send_message(1, str(number))
+    sender.answer_callback_query('callback')
+    sender.join()
+
+    times = {name: sent_time - start for name, args, sent_time in bot.sent}
+    assert times['answer_callback_query'] < 0.05  # not after the paced messages
+    assert times['send_message'] >= 0.15
+
+
+def test_flood_error_of_a_callback_answer_pauses_only_the_answer():
+    bot = FakeBot()
+    bot.failures['answer_callback_query'] = [api_error(429, retry_after=0.2)]
+    sender = outbound.OutboundQueue(bot, global_rate=1000, global_burst=1000, threads=1)
+    start = time.monotonic()
+    sender.answer_callback_query('callback')
+    sender.send_message(1, 'text')
+    sender.join()
+
+    times = [(name, sent_time - start) for name, args, sent_time in bot.sent]
+    assert [name for name, sent_time in times] == ['answer_callback_query', 'send_message', 'answer_callback_query']
+    assert times[1][1] < 0.1  # the messages weren't paused
+    assert times[2][1] >= 0.2  # the answer waited its retry_after
+
+
+def test_queue_depth_counts_the_calls_not_sent_yet():
+    bot = FakeBot()
+    sent = threading.Event()
+    unblock = threading.Event()
+    send_message = bot.__getattr__('send_message')
+
+    def blocked_send(*args, **kwargs):
+        sent.set()
+        unblock.wait(TIMEOUT)
+        return send_message(*args, **kwargs)
+
+    bot.send_message = blocked_send
+    sender = outbound.OutboundQueue(bot, global_rate=1000, global_burst=1000, chat_rate=1000, chat_burst=1000,
+                                    threads=1)
+    depth = outbound.queue_depth.get()
+    sender.send_message(1, 'sending')
+    assert sent.wait(TIMEOUT)
+    sender.send_message(1, 'waiting for the chat')
+    sender.send_message(2, 'waiting for a thread')
+    assert outbound.queue_depth.get() - depth == 2
+
+    unblock.set()
+    sender.join()
+    assert outbound.queue_depth.get() == depth
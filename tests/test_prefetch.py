@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+from menu import MenuType, QuestionType, AmountQuestion
+from session import Session
+from tests.updates import poll_answer_update
+
+CHAT_ID = 3000
+POOL_KEY = "eng:eng_com"
+
+
+def selected_session():
+    """:return: a session which selected 5 English sentence completion questions."""
+    user_session = Session()
+    user_session.subject, user_session.question_type = MenuType.ENGLISH, QuestionType.ENG_COM
+    user_session.question_amount = AmountQuestion.FIVE
+    return user_session
+
+
+def asked_indexes(bot_main, amount=5):
+    """:return: the pool indexes of the last polls sent."""
+    return [entry[2][0][1] for entry, expiry in list(bot_main.open_polls.polls.values())[-amount:]]
+
+
+def run_now(chat_id, function, *args, timeout=None):
+    function(*args)
+
+
+def test_prefetch_moves_the_cursor_only_when_its_batch_is_used(bot_main):
+    user_session = bot_main.users_sessions[CHAT_ID] = selected_session()
+    bot_main.call_questions(CHAT_ID)
+    cursor = user_session.cursors[POOL_KEY]
+    order = cursor.order.tolist()
+    assert cursor.next == 5
+
+    bot_main.prefetch_questions(CHAT_ID)
+    assert user_session.cursors[POOL_KEY].next == 5
+    bot_main.call_questions(CHAT_ID)  # repeating takes the prefetched batch and its cursor
+    assert asked_indexes(bot_main) == order[5:10]
+    assert user_session.cursors[POOL_KEY].next == 10
+
+    bot_main.prefetch_questions(CHAT_ID)
+    bot_main.prefetched.discard(CHAT_ID)  # e.g. the user went to another menu
+    assert user_session.cursors[POOL_KEY].next == 10
+    bot_main.call_questions(CHAT_ID)
+    assert asked_indexes(bot_main) == order[10:15]  # the discarded batch's questions aren't skipped
+
+
+def test_adaptive_prefetch_is_drawn_again_after_an_answer(bot_main, monkeypatch):
+    monkeypatch.setattr(bot_main, 'QUESTION_SELECTION', 'adaptive')
+    user_session = bot_main.users_sessions[CHAT_ID] = selected_session()
+    bot_main.call_questions(CHAT_ID)
+    bot_main.prefetch_questions(CHAT_ID)
+    prefetched_key = bot_main.selection_key(user_session)
+
+    poll_id = next(iter(bot_main.open_polls.polls))
+    bot_main.process_update(poll_answer_update(CHAT_ID, poll_id, 0))
+    assert bot_main.selection_key(user_session) != prefetched_key  # the batch drawn before the answer is stale
+
+    monkeypatch.setattr(bot_main, 'dispatcher', SimpleNamespace(submit=run_now))
+    poll_id = next(iter(bot_main.open_polls.polls))
+    bot_main.process_update(poll_answer_update(CHAT_ID, poll_id, 0))
+    assert bot_main.prefetched.pop(CHAT_ID, bot_main.selection_key(user_session)) is not None
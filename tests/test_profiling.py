@@ -0,0 +1,61 @@
+import os
+
+import profiling
+from menu import MenuType, MenuAnswer
+from tests.updates import message_update, callback_update
+
+CHAT_ID = 5000
+OTHER_CHAT_ID = 5001
+
+
+def replies(bot_main):
+    """:return: the texts sent to the admin."""
+    return [args[1] for name, args, kwargs, result in bot_main.sender.sent
+            if name == 'send_message' and args[0] == bot_main.chat]
+
+
+def test_profiling_stops_after_the_asked_updates(bot_main, monkeypatch, tmp_path):
+    monkeypatch.setattr(bot_main, 'profiler', profiling.UpdateProfiler(str(tmp_path)))
+    bot_main.process_update(message_update(bot_main.chat, '/profile 2'))
+    assert replies(bot_main)[-1] == "Profiling the next 2 updates (for up to 10 minutes)"
+
+    for i in range(3):
+        bot_main.process_update(message_update(CHAT_ID, '/start'))
+    assert [name for name, chat_id, seconds, path in bot_main.profiler.profiles] == ['message /start'] * 2
+    assert not bot_main.profiler.wants(CHAT_ID)
+    assert all(os.path.isfile(path) for name, chat_id, seconds, path in bot_main.profiler.profiles)
+
+
+def test_profiling_only_the_asked_chat(bot_main, monkeypatch, tmp_path):
+    monkeypatch.setattr(bot_main, 'profiler', profiling.UpdateProfiler(str(tmp_path)))
+    bot_main.process_update(message_update(bot_main.chat, '/profile 5 {}'.format(CHAT_ID)))
+    bot_main.process_update(message_update(OTHER_CHAT_ID, '/start'))
+    bot_main.process_update(message_update(CHAT_ID, '/start'))
+    assert [chat_id for name, chat_id, seconds, path in bot_main.profiler.profiles] == [CHAT_ID]
+
+
+def test_profiling_stops_after_its_time(bot_main, monkeypatch, tmp_path):
+    monkeypatch.setattr(bot_main, 'profiler', profiling.UpdateProfiler(str(tmp_path), max_seconds=0))
+    bot_main.process_update(message_update(bot_main.chat, '/profile 5'))
+    bot_main.process_update(message_update(CHAT_ID, '/start'))
+    assert bot_main.profiler.profiles == [] and bot_main.profiler.remaining == 0
+
+
+def test_profile_report_sends_the_profiled_updates_and_their_stats(bot_main, monkeypatch, tmp_path):
+    monkeypatch.setattr(bot_main, 'profiler', profiling.UpdateProfiler(str(tmp_path)))
+    bot_main.process_update(message_update(bot_main.chat, '/profile 2'))
+    bot_main.process_update(message_update(CHAT_ID, '/start'))
+    bot_main.process_update(callback_update(CHAT_ID, MenuAnswer(MenuType.MAIN, MenuType.ENGLISH).encode(),
+                                            message_id=bot_main.sender.last_menu()[1]))
+    bot_main.process_update(message_update(bot_main.chat, '/profile_report'))
+
+    report = replies(bot_main)[-1].splitlines()
+    assert report[0] == "Profiling is off. 2 profiled updates:"
+    assert report[1].startswith("message /start (chat {}): ".format(CHAT_ID)) and report[1].endswith(" ms")
+    assert report[2].startswith("callback {} (chat {}): ".format(MenuAnswer(MenuType.MAIN, MenuType.ENGLISH).encode(),
+                                                                 CHAT_ID))
+    assert report[4] == "Top functions by cumulative time:"
+    assert len(report[5:]) == profiling.TOP_FUNCTIONS and "process_new_updates" in "\n".join(report[5:])
+    name, args, kwargs, result = bot_main.sender.sent[-1]
+    assert name == 'send_document' and kwargs['visible_file_name'] == 'profile.prof'
+    assert os.path.isfile(tmp_path / 'combined-{}.prof'.format(os.getpid()))
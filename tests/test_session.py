@@ -0,0 +1,214 @@
+import time
+from types import SimpleNamespace
+
+from bank import DrawCursor, WeightTree
+from menu import MenuType, QuestionType, AmountQuestion, Unit
+from tests.updates import message_update, poll_answer_update
+import polls
+import session
+from session import Session, SessionStore, MemoryBackend, SqliteBackend
+
+TIMEOUT = 5
+
+
+def store(backend=None, **options):
+    """:return: SessionStore whose background flush only runs when asked (by the batch size)."""
+    options.setdefault('flush_interval', 3600)
+    return SessionStore(backend if backend is not None else MemoryBackend(), **options)
+
+
+def user_session(subject=MenuType.ENGLISH):
+    user_session = Session()
+    user_session.subject = subject
+    return user_session
+
+
+class FailingBackend(MemoryBackend):
+    """MemoryBackend failing its next writes."""
+
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    def save_many(self, sessions):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("backend down")
+        super().save_many(sessions)
+
+
+def test_least_recently_used_session_is_evicted():
+    sessions = store(max_size=2)
+    for chat_id in (1, 2):
+        sessions[chat_id] = user_session()
+    assert sessions.get(1) is not None  # 2 is now the least recently used
+    sessions[3] = user_session()
+
+    assert set(sessions.cache) == {1, 3}
+    assert len(sessions) == 2
+
+
+def test_idle_session_is_evicted():
+    sessions = store(ttl=0.05)
+    sessions[1] = user_session()
+    time.sleep(0.1)
+    sessions[2] = user_session()
+
+    assert set(sessions.cache) == {2}
+
+
+def test_evicted_session_is_loaded_back():
+    backend = MemoryBackend()
+    sessions = store(backend, max_size=1)
+    sessions[1] = user_session(MenuType.MATH)
+    sessions[2] = user_session()
+    assert sessions.get(1).subject == MenuType.MATH  # from the sessions waiting to be written
+
+    sessions.flush()
+    sessions[3] = user_session()
+    assert 1 not in sessions.cache
+    assert sessions.get(1).subject == MenuType.MATH  # from the backend
+
+
+def test_saves_are_written_behind_in_batches():
+    backend = MemoryBackend()
+    sessions = store(backend, batch_size=3)
+    sessions[1] = user_session()
+    sessions[2] = user_session()
+    assert backend.sessions == {}  # the handlers don't wait for the backend
+
+    sessions.get(1).subject = MenuType.MATH
+    sessions.save(1)
+    sessions[3] = user_session()  # the batch is full, the background thread writes it
+    deadline = time.monotonic() + TIMEOUT
+    while len(backend.sessions) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert set(backend.sessions) == {1, 2, 3}
+    assert backend.sessions[1]['subject'] == MenuType.MATH.value
+    assert sessions.pending == {}
+
+
+def test_failed_write_is_retried_with_newer_saves_winning():
+    backend = FailingBackend(failures=1)
+    sessions = store(backend)
+    sessions[1] = user_session()
+    sessions.flush()
+    assert backend.sessions == {}
+
+    sessions.get(1).subject = MenuType.MATH
+    sessions.save(1)
+    sessions.flush()
+    assert backend.sessions[1]['subject'] == MenuType.MATH.value
+
+
+def test_memory_backend_forgets_the_least_recently_used_sessions():
+    backend = MemoryBackend(max_size=2)
+    backend.save_many({1: {'subject': None}, 2: {'subject': None}})
+    assert backend.load(1) is not None  # 2 is now the least recently used
+    backend.save_many({3: {'subject': None}})
+
+    assert set(backend.sessions) == {1, 3}
+
+
+class RacingBackend(MemoryBackend):
+    """MemoryBackend whose first load lets another thread get the same session meanwhile."""
+
+    def __init__(self):
+        super().__init__()
+        self.store = None
+
+    def load(self, chat_id):
+        store, self.store = self.store, None
+        if store is not None:
+            self.other = store.get(chat_id)
+        return super().load(chat_id)
+
+
+def test_concurrent_gets_share_the_session():
+    backend = RacingBackend()
+    backend.save_many({1: user_session(MenuType.MATH).to_dict()})
+    sessions = store(backend)
+    backend.store = sessions
+
+    assert sessions.get(1) is backend.other
+
+
+def test_sqlite_round_trip(tmp_path):
+    path = str(tmp_path / 'sessions.db')
+    saved = Session()
+    saved.subject, saved.question_type = MenuType.ENGLISH, QuestionType.ENG_VOC_ENG
+    saved.question_unit, saved.question_amount = Unit.THREE, AmountQuestion.TEN
+    saved.cursors['voc:3'] = DrawCursor()
+    saved.cursors['voc:3'].take(4, 50)
+    saved.weights['voc:3'] = WeightTree(50)
+    saved.weights['voc:3'].record(7, correct=False)
+    saved.count_answer('voc:3', True)
+    saved.menu_message_id = 42
+    sessions = store(SqliteBackend(path))
+    sessions[1] = saved
+    sessions.flush()
+
+    loaded = store(SqliteBackend(path)).get(1)  # as after a restart
+
+    assert loaded is not saved
+    assert loaded.to_dict() == saved.to_dict()
+    assert loaded.cursors['voc:3'].take(46, 50) == saved.cursors['voc:3'].take(46, 50)
+    assert store(SqliteBackend(path)).get(2) is None
+
+
+def test_create_backend(tmp_path):
+    assert isinstance(session.create_backend('memory'), MemoryBackend)
+    backend = session.create_backend('sqlite:///' + str(tmp_path / 'sessions.db'))
+    assert isinstance(backend, SqliteBackend) and backend.load(1) is None
+
+
+def test_answers_are_counted_per_pool():
+    saved = user_session()
+    saved.count_answer('eng:eng_com', True)
+    saved.count_answer('eng:eng_com', False)
+    saved.count_answer('voc:3', True)
+    data = saved.to_dict()
+    saved.count_answer('voc:3', True)  # after the dict was queued to be written
+
+    assert saved.stats == {'eng:eng_com': [2, 1], 'voc:3': [2, 2]}
+    assert data['stats'] == {'eng:eng_com': [2, 1], 'voc:3': [1, 1]}
+
+
+def test_quiz_answers_are_scored_into_the_stats(bot_main):
+    chat_id = 5000
+    bot_main.users_sessions[chat_id] = user_session()
+    for poll_id, pool_key in (('right', 'eng:eng_com'), ('wrong', 'eng:eng_com'), ('unit', 'voc:3')):
+        bot_main.track_poll(chat_id, SimpleNamespace(poll=SimpleNamespace(id=poll_id)), 2, [(pool_key, 0, 10)])
+
+    for poll_id, option_id in (('right', 2), ('wrong', 0), ('unit', 2), ('right', 2), ('unknown', 2)):
+        bot_main.process_update(poll_answer_update(chat_id, poll_id, option_id))
+
+    assert bot_main.users_sessions.get(chat_id).stats == {'eng:eng_com': [2, 1], 'voc:3': [1, 1]}
+    assert len(bot_main.open_polls) == 0
+
+
+def test_expired_poll_is_not_scored():
+    tracker = polls.PollTracker(ttl=0.01)
+    tracker.add('poll', (1, 0, []))
+    time.sleep(0.02)
+    assert tracker.pop('poll') is None
+    assert len(tracker) == 0
+
+
+def test_stats_command(bot_main):
+    chat_id = 5001
+    bot_main.users_sessions[chat_id] = user_session()
+    bot_main.process_update(message_update(chat_id, '/stats'))
+    assert bot_main.sender.sent[-1][1] == (chat_id, "You haven't answered any question yet")
+
+    saved = bot_main.users_sessions.get(chat_id)
+    for pool_key, correct in (('voc:3', True), ('eng:eng_com', False), ('math:math_alg', True), ('voc:0', False),
+                              ('eng:eng_com', True)):
+        saved.count_answer(pool_key, correct)
+    bot_main.process_update(message_update(chat_id, '/stats'))
+
+    assert bot_main.sender.sent[-1][1][1] == "\n".join([
+        "Your answers:", "", "English: 2/4 (50%)", " Sentence completion: 1/2 (50%)",
+        " Vocabulary of all units: 0/1 (0%)", " Vocabulary unit 3: 1/1 (100%)", "", "Math: 1/1 (100%)",
+        " Algebra: 1/1 (100%)"])
@@ -0,0 +1,77 @@
+import multiprocessing
+import os
+import time
+
+import workers
+
+TIMEOUT = 5
+
+
+def update(chat_id, text):
+    return {'update_id': 1, 'message': {'message_id': 1, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'},
+                                        'text': text}}
+
+
+def echo_worker(results):
+    """:return: worker_main reporting (worker index, text) of every update it gets, exiting on "exit"."""
+    def worker_main(index, workers_count, updates):
+        while True:
+            text = updates.get()['message']['text']
+            if text == 'exit':
+                os._exit(1)
+            results.put((index, text))
+    return worker_main
+
+
+def stuck_worker(index, workers_count, updates):
+    time.sleep(TIMEOUT * 2)
+
+
+def received(results, count):
+    return sorted(results.get(timeout=TIMEOUT) for i in range(count))
+
+
+def stop(pool):
+    for process in pool.processes:
+        process.terminate()
+
+
+def test_updates_are_routed_by_chat_and_broadcast_to_every_worker():
+    results = multiprocessing.get_context('fork').Queue()
+    pool = workers.WorkerPool(echo_worker(results), workers=2,
+                              broadcast=lambda update: update['message']['text'] == 'admin')
+    pool.route(update(4, 'even'))
+    pool.route(update(7, 'odd'))
+    pool.route(update(7, 'admin'))
+
+    assert received(results, 4) == [(0, 'admin'), (0, 'even'), (1, 'admin'), (1, 'odd')]
+    stop(pool)
+
+
+def test_exited_worker_is_started_again(monkeypatch):
+    monkeypatch.setattr(workers, 'SUPERVISE_INTERVAL', 0.05)
+    results = multiprocessing.get_context('fork').Queue()
+    pool = workers.WorkerPool(echo_worker(results), workers=2)
+    exited = pool.processes[1]
+    pool.route(update(1, 'exit'))
+    deadline = time.monotonic() + TIMEOUT
+    while pool.processes[1] is exited and time.monotonic() < deadline:
+        time.sleep(0.05)
+    pool.route(update(1, 'after'))
+
+    assert received(results, 1) == [(1, 'after')]
+    assert exited.exitcode == 1
+    stop(pool)
+
+
+def test_update_of_a_stuck_worker_is_dropped(monkeypatch):
+    monkeypatch.setattr(workers, 'ROUTE_TIMEOUT', 0.05)
+    pool = workers.WorkerPool(stuck_worker, workers=2, queue_size=1)
+    dropped = workers.dropped_updates.get()
+    start = time.monotonic()
+    for number in range(3):
+        pool.route(update(1, str(number)))
+
+    assert workers.dropped_updates.get() - dropped == 2
+    assert time.monotonic() - start < 1
+    stop(pool)
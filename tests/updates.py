@@ -0,0 +1,34 @@
+"""Telegram updates as the bot receives them, for the tests."""
+import itertools
+import time
+
+from telebot import types
+
+update_ids = itertools.count(1)
+
+
+def user(chat_id):
+    return {'id': chat_id, 'is_bot': False, 'first_name': 'User'}
+
+
+def message_update(chat_id, text, message_id=1):
+    """:return: telebot Update of a text message (a command if the text starts with /)."""
+    entities = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text.startswith('/') else []
+    return types.Update.de_json({'update_id': next(update_ids), 'message': {
+        'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'},
+        'from': user(chat_id), 'text': text, 'entities': entities}})
+
+
+def callback_update(chat_id, data, message_id=1):
+    """:return: telebot Update of a tap on a button with the callback data, on the message with the id."""
+    return types.Update.de_json({'update_id': next(update_ids), 'callback_query': {
+        'id': str(next(update_ids)), 'from': user(chat_id), 'chat_instance': str(chat_id), 'data': data,
+        'message': {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'},
+                    'text': 'menu'}}})
+
+
+def poll_answer_update(chat_id, poll_id, option_id):
+    """:return: telebot Update of the user's answer to a quiz."""
+    return types.Update.de_json({'update_id': next(update_ids), 'poll_answer': {
+        'poll_id': poll_id, 'option_ids': [option_id], 'option_persistent_ids': [str(option_id)],
+        'user': user(chat_id)}})
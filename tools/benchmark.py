@@ -0,0 +1,189 @@
+"""
+Microbenchmarks for drawing questions from the questions DB.
+Run from the repository root: python -m tools.benchmark
+"""
+import random
+import subprocess
+import sys
+import time
+import timeit
+
+import bank
+from bank import QuestionBank
+
+
+def legacy_get_rand_sample_info_eng_built(eng_questions, num_samples=1, qtype="eng_com"):
+    """The English sentences questions generator the bot used before the bank was indexed."""
+    data = eng_questions.copy()
+    data = data[data['type'] == qtype]
+
+    samples = data.sample(n=num_samples)
+    question, options, correct_option_id = [], [], []
+    for i in range(num_samples):
+        question.append(samples['question'].iloc[i])
+        options.append([
+            samples['answer1'].iloc[i], samples['answer2'].iloc[i],
+            samples['answer3'].iloc[i], samples['answer4'].iloc[i]
+        ])
+        correct_option_id.append(samples['correct_answer'].iloc[i] - 1)
+    return question, options, correct_option_id
+
+
+def legacy_get_rand_sample_info_math_built(math_questions, num_samples=1, qtype="math_alg"):
+    """The math questions generator the bot used before the bank was indexed."""
+    data = math_questions.copy()
+    data = data[data['type'] == qtype]
+
+    samples = data.sample(n=num_samples)
+    question, correct_option_id = [], []
+    for i in range(num_samples):
+        question.append(samples['question_dir'].iloc[i])
+        correct_option_id.append(samples['correct_answer'].iloc[i] - 1)
+    return question, correct_option_id
+
+
+def legacy_get_rand_sample_info_eng_voc(eng_voc, unit, num_samples=1, qtype=0, retries=3):
+    """
+    The vocabulary question generator the bot used before the bank was indexed.
+    :param retries: the samples tried before falling back to grouping by word, 0 => always grouping.
+    """
+    data = eng_voc.copy()
+    col_names = ('english', 'hebrew')
+
+    if qtype == 0:
+        main, secondary = col_names
+    else:
+        main, secondary = col_names[::-1]
+
+    if unit != 0:
+        data = data[data['unit'] == unit]
+
+    valid_sample = False
+    for i in range(retries):
+        samples = data.sample(n=4 * num_samples)
+        if samples['english'].nunique() == 4 * num_samples:
+            valid_sample = True
+            break
+
+    if not valid_sample:
+        # the columns are selected so newer pandas versions keep the grouping column too
+        samples = data.groupby(
+            col_names[0])[list(data.columns)].apply(lambda df: df.sample(1)).sample(n=4 * num_samples)
+    options = samples[secondary].to_list()
+    options = [options[i:i + 4] for i in range(0, len(options), 4)]
+    correct_option_id = [random.randint(0, 3) for i in range(num_samples)]
+    question = ["Choose the correct translation of the word:\n" + str(samples[main].iloc[index * 4 + i])
+                for index, i in enumerate(correct_option_id)]
+    return question, options, correct_option_id
+
+
+def report(name, legacy, indexed, number):
+    """
+    Timing both draws and printing the per-draw cost.
+    :param name: the benchmark's name.
+    :param legacy: callable generating a draw's questions the old way.
+    :param indexed: callable generating a draw's questions from the indexed bank.
+    :param number: the number of draws to time.
+    """
+    legacy_time = min(timeit.repeat(legacy, number=number, repeat=3)) / number
+    indexed_time = min(timeit.repeat(indexed, number=number, repeat=3)) / number
+    print(f"{name:<28} legacy {legacy_time * 1e6:10.1f} us | indexed {indexed_time * 1e6:8.1f} us"
+          f" | x{legacy_time / indexed_time:.0f}")
+
+
+def cold_start_time(statement, repeat=3):
+    """
+    :param statement: python code loading the bank, run in a new interpreter so imports are paid too.
+    :param repeat: the number of runs.
+    :return: the best wall time of the runs, in seconds.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def startup():
+    """Comparing a cold start from the MS Excel DB and from the compiled DB."""
+    bank.compile_db()
+    xlsx_time = cold_start_time("from bank import QuestionBank; QuestionBank(*QuestionBank.read_excel())")
+    compiled_time = cold_start_time("from bank import QuestionBank; QuestionBank.load()")
+    print(f"{'startup':<28} xlsx {xlsx_time * 1e3:12.1f} ms | compiled {compiled_time * 1e3:7.1f} ms"
+          f" | x{xlsx_time / compiled_time:.0f}")
+
+
+def generators(number=200):
+    """Comparing the questions generators drawing from the indexed bank with the copy-and-filter ones."""
+    import pandas as pd
+
+    import main as bot_main
+
+    xls = pd.ExcelFile(bank.DB_PATH)
+    eng_questions = pd.read_excel(xls, 'engBuiltQuestions')
+    math_questions = pd.read_excel(xls, 'mathBuiltQuestions')
+
+    for qtype in ("eng_com", "eng_rephrase"):
+        report(f"eng_built {qtype} k=10",
+               lambda: legacy_get_rand_sample_info_eng_built(eng_questions, 10, qtype),
+               lambda: bot_main.get_rand_sample_info_eng_built(10, qtype), number)
+    for qtype in ("math_alg", "math_geo"):
+        report(f"math_built {qtype} k=10",
+               lambda: legacy_get_rand_sample_info_math_built(math_questions, 10, qtype),
+               lambda: bot_main.get_rand_sample_info_math_built(10, qtype), number)
+
+
+def voc_generator(number=50):
+    """Comparing the vocabulary question generator with the one retrying pandas samples."""
+    import pandas as pd
+
+    import main as bot_main
+
+    eng_voc = pd.read_excel(bank.DB_PATH, 'wordVoc')
+    for unit in (0, 1, 5):
+        report(f"voc generator unit={unit} k=10",
+               lambda: legacy_get_rand_sample_info_eng_voc(eng_voc, unit, 10),
+               lambda: bot_main.get_rand_sample_info_eng_voc(unit, 10), number)
+
+
+def adaptive_draws(user_counts=(1000, 10000), num_samples=10, number=20000):
+    """
+    Draws per second of the adaptive selection, each user with their own weights of the all units vocabulary
+    (the largest pool), compared with drawing by a plain list of weights.
+    :param user_counts: the numbers of users to spread the draws over.
+    :param num_samples: the number of questions in a draw.
+    :param number: the number of draws to time.
+    """
+    pool_size = len(QuestionBank.load().voc[0])
+    for users in user_counts:
+        trees = []
+        for i in range(users):
+            tree = bank.WeightTree(pool_size)
+            for index in random.sample(range(pool_size), 50):  # a user's answers so far
+                tree.record(index, random.random() < 0.7)
+            trees.append(tree)
+        weight_lists = [[tree.weight(index) for index in range(pool_size)] for tree in trees[:100]]
+        population = range(pool_size)
+
+        start = time.perf_counter()
+        for i in range(number):
+            trees[i % users].sample(num_samples)
+        tree_rate = number / (time.perf_counter() - start)
+        start = time.perf_counter()
+        for i in range(number // 100):
+            random.choices(population, weights=weight_lists[i % len(weight_lists)], k=num_samples)
+        list_rate = number // 100 / (time.perf_counter() - start)
+        print(f"{'adaptive ' + str(users) + ' users k=' + str(num_samples):<28} weights list {list_rate:8.0f}/s"
+              f" | fenwick {tree_rate:8.0f}/s | {len(trees[0].tree) * trees[0].tree.itemsize / 1024:.1f} KB/user")
+
+
+def main():
+    startup()
+    generators()
+    voc_generator()
+    adaptive_draws()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+Local fake of the Telegram Bot API for load tests: the bot is pointed at it with TELEGRAM_API_URL
+(e.g. http://127.0.0.1:8081/bot{0}/{1}), receives the updates pushed to the fake by getUpdates,
+and its calls are recorded and answered like Telegram does, after a configurable latency and with
+a configurable share of 429 (flood) errors.
+Run from the repository root: python -m tools.fake_telegram [port]
+"""
+import collections
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+
+from flask import Flask, jsonify, request
+
+# the calls sending to a chat or editing a sent message, recorded for the load test (see: FakeTelegram.listeners)
+SEND_METHODS = {'sendMessage', 'sendPoll', 'sendPhoto', 'sendMediaGroup', 'editMessageText', 'editMessageReplyMarkup'}
+
+
+class FakeTelegram:
+    """
+    The fake's state: the updates waiting for the bot and the calls the bot made.
+    :var latency: seconds every call takes.
+    :var flood_rate: share of the send calls answered with 429 (flood) errors.
+    :var retry_after: the retry_after of the 429 errors.
+    :var calls: method name -> number of calls.
+    :var listeners: called with (method name, chat id, params, result) after every successful send call.
+    """
+
+    def __init__(self, latency=0.0, flood_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.updates = collections.deque()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.condition = threading.Condition()
+        self.calls = collections.Counter()
+        self.floods = 0
+        self.listeners = []
+        self.polling = threading.Event()  # set on the bot's first getUpdates
+
+    def push_update(self, update):
+        """
+        Queueing an update for the bot.
+        :param update: the update without its update_id (JSON dict).
+        """
+        with self.condition:
+            update['update_id'] = next(self.update_ids)
+            self.updates.append(update)
+            self.condition.notify_all()
+
+    def get_updates(self, offset, timeout):
+        """
+        :param offset: the first update id not confirmed by the bot yet.
+        :param timeout: seconds to wait for an update when there is none.
+        :return: the waiting updates from the offset on.
+        """
+        self.polling.set()
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.updates and self.updates[0]['update_id'] < offset:
+                self.updates.popleft()
+            while not self.updates and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+            return list(self.updates)
+
+    def call(self, method_name, params, files):
+        """
+        :param method_name: the Bot API method.
+        :param params: the call's parameters.
+        :param files: the call's uploaded files.
+        :return: (HTTP status, response JSON).
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        self.calls[method_name] += 1
+        if method_name == 'getUpdates':
+            return 200, {'ok': True, 'result': self.get_updates(int(params.get('offset', 0)),
+                                                                float(params.get('timeout', 0)))}
+        if method_name in SEND_METHODS and random.random() < self.flood_rate:
+            self.floods += 1
+            return 429, {'ok': False, 'error_code': 429,
+                         'description': 'Too Many Requests: retry after {}'.format(self.retry_after),
+                         'parameters': {'retry_after': self.retry_after}}
+
+        result = self.result(method_name, params, files)
+        if method_name in SEND_METHODS:
+            for listener in self.listeners:
+                listener(method_name, int(params['chat_id']), params, result)
+        return 200, {'ok': True, 'result': result}
+
+    def result(self, method_name, params, files):
+        """:return: the result Telegram returns for the call."""
+        if method_name == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'FakeBot'}
+        if method_name == 'sendMessage':
+            return self.message(params['chat_id'], text=params.get('text', ''))
+        if method_name == 'editMessageText':
+            return self.message(params['chat_id'], int(params['message_id']), text=params['text'])
+        if method_name == 'editMessageReplyMarkup':
+            return self.message(params['chat_id'], int(params['message_id']), text='menu')
+        if method_name == 'sendPhoto':
+            return self.message(params['chat_id'], photo=self.photo())
+        if method_name == 'sendMediaGroup':
+            return [self.message(params['chat_id'], photo=self.photo()) for media in json.loads(params['media'])]
+        if method_name == 'sendPoll':
+            options = [option if isinstance(option, str) else option['text']
+                       for option in json.loads(params['options'])]
+            return self.message(params['chat_id'], poll={
+                'id': str(next(self.message_ids)), 'question': params['question'],
+                'options': [{'text': option, 'voter_count': 0, 'persistent_id': str(i)}
+                            for i, option in enumerate(options)],
+                'total_voter_count': 0, 'is_closed': False, 'is_anonymous': False, 'type': 'quiz',
+                'allows_multiple_answers': False, 'correct_option_id': int(params.get('correct_option_id', 0))})
+        return True
+
+    def message(self, chat_id, message_id=None, **content):
+        """
+        :param message_id: the id of the edited message, None => a new message.
+        :return: the message JSON.
+        """
+        return {'message_id': message_id or next(self.message_ids), 'date': int(time.time()),
+                'chat': {'id': int(chat_id), 'type': 'private'}, **content}
+
+    def photo(self):
+        file_id = 'fake-photo-{}'.format(next(self.message_ids))
+        return [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 720}]
+
+
+def create_app(fake):
+    """
+    :param fake: the FakeTelegram.
+    :return: Flask app serving the Bot API methods at /bot<token>/<method>.
+    """
+    app = Flask(__name__)
+
+    @app.route('/bot<token>/<method_name>', methods=['GET', 'POST'])
+    def bot_api(token, method_name):
+        status, response = fake.call(method_name, request.values.to_dict(), request.files)
+        return jsonify(response), status
+
+    return app
+
+
+if __name__ == '__main__':
+    create_app(FakeTelegram()).run(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8081, threaded=True)
@@ -0,0 +1,183 @@
+"""
+Load test of the bot against a local fake of the Telegram Bot API (see: tools.fake_telegram):
+the bot runs as its own process, pointed at the fake, while simulated users click through the menus
+with the callback data of the keyboards the bot sent them, and answer the quizzes.
+Reports the latency from each click's update until the bot sent the step's last message (the next menu),
+the updates per second and the API calls per question.
+Run from the repository root: python -m tools.load_test [--users N] [--latency S] [--flood-rate R] ...
+"""
+import argparse
+import collections
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+from tools.fake_telegram import FakeTelegram, create_app
+
+TOKEN = '0:loadtest'
+ADMIN_CHAT = 1
+FIRST_USER_CHAT = 1000
+STEP_TIMEOUT = 60
+
+# scenario -> the callback data clicked one after the other, after /start
+SCENARIOS = {
+    'english completion': ['N:E', 'E:EC', 'A:5', 'R:RP', 'R:N'],
+    'vocabulary unit': ['N:E', 'E:V', 'V:VE', 'U:3', 'A:5', 'R:N'],
+    'math algebra': ['N:M', 'M:MA', 'A:5', 'R:RP', 'R:N'],
+    'full mix': ['N:C', 'R:N'],
+}
+
+
+class User:
+    """
+    A simulated user: waits for the bot's menu, clicks the next button of its scenario and answers every quiz.
+    :var chat_id: the user's chat id (and user id).
+    :var menus: (send time, reply markup, message id) of the menus the bot sent the user.
+    """
+
+    def __init__(self, fake, chat_id):
+        self.fake = fake
+        self.chat_id = chat_id
+        self.menus = []
+        self.condition = threading.Condition()
+
+    def sent(self, method_name, params, result):
+        """Called by the fake for every message the bot sent the user."""
+        if method_name == 'sendPoll':
+            poll = result['poll']
+            option_id = random.randrange(len(poll['options']))
+            self.fake.push_update({'poll_answer': {
+                'poll_id': poll['id'], 'option_ids': [option_id], 'option_persistent_ids': [str(option_id)],
+                'user': {'id': self.chat_id, 'is_bot': False, 'first_name': 'User'}}})
+        elif params.get('reply_markup'):
+            with self.condition:
+                self.menus.append((time.perf_counter(), json.loads(params['reply_markup']), result['message_id']))
+                self.condition.notify_all()
+
+    def step(self, update):
+        """
+        Pushing an update and waiting for the menu ending the bot's answer to it.
+        :param update: the update.
+        :return: (seconds from the update until the menu, the menu's markup, its message id), Nones on timeout.
+        """
+        with self.condition:
+            seen = len(self.menus)
+        start = time.perf_counter()
+        self.fake.push_update(update)
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.menus) > seen, STEP_TIMEOUT):
+                return None, None, None
+            sent_time, markup, message_id = self.menus[-1]
+        return sent_time - start, markup, message_id
+
+    def run(self, clicks, latencies, errors):
+        """
+        Going through a scenario.
+        :param clicks: the callback data to click, in order.
+        :param latencies: list the latency of every step is added to.
+        :param errors: list the failures are added to.
+        """
+        user = {'id': self.chat_id, 'is_bot': False, 'first_name': 'User'}
+        chat = {'id': self.chat_id, 'type': 'private'}
+        latency, markup, message_id = self.step({'message': {'message_id': 1, 'date': int(time.time()), 'chat': chat,
+                                                 'from': user, 'text': '/start',
+                                                 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]}})
+        for data in clicks:
+            if latency is None:
+                errors.append('timeout')
+                return
+            latencies.append(latency)
+            buttons = [button['callback_data'] for row in markup['inline_keyboard'] for button in row]
+            if data not in buttons:
+                errors.append('no button {} in {}'.format(data, buttons))
+                return
+            latency, markup, message_id = self.step({'callback_query': {
+                'id': str(random.getrandbits(32)), 'from': user, 'chat_instance': str(self.chat_id), 'data': data,
+                'message': {'message_id': message_id, 'date': int(time.time()), 'chat': chat, 'text': 'menu'}}})
+        if latency is None:
+            errors.append('timeout')
+        else:
+            latencies.append(latency)
+
+
+def start_bot(api_url, args, work_dir):
+    """
+    :return: the bot's process, pointed at the fake.
+    """
+    env = dict(os.environ, API_TOKEN=TOKEN, CHAT=str(ADMIN_CHAT), TELEGRAM_API_URL=api_url,
+               BOT_WORKERS=str(args.workers), BOT_MODE='polling', SESSION_STORE='memory',
+               FILE_ID_CACHE=os.path.join(work_dir, 'file_ids.json'))
+    if args.unlimited:  # measuring the bot itself, not Telegram's rate limits
+        env.update(SEND_GLOBAL_RATE='1000000', SEND_GLOBAL_BURST='1000000',
+                   SEND_CHAT_RATE='1000000', SEND_CHAT_BURST='1000000')
+    return subprocess.Popen([sys.executable, 'main.py'], env=env)
+
+
+def percentile(values, percent):
+    return statistics.quantiles(values, n=100)[percent - 1] if len(values) > 1 else values[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50, help="concurrent simulated users")
+    parser.add_argument('--latency', type=float, default=0.02, help="seconds every fake API call takes")
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="share of sends answered with 429")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after of the 429 errors")
+    parser.add_argument('--workers', type=int, default=1, help="the bot's BOT_WORKERS")
+    parser.add_argument('--unlimited', action='store_true', help="lift the bot's outbound rate limits")
+    args = parser.parse_args()
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    fake = FakeTelegram(args.latency, args.flood_rate, args.retry_after)
+    users = {FIRST_USER_CHAT + i: User(fake, FIRST_USER_CHAT + i) for i in range(args.users)}
+    fake.listeners.append(lambda method_name, chat_id, params, result:
+                          chat_id in users and users[chat_id].sent(method_name, params, result))
+    server = make_server('127.0.0.1', 0, create_app(fake), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        bot = start_bot('http://127.0.0.1:{}/bot{{0}}/{{1}}'.format(server.server_port), args, work_dir)
+        try:
+            if not fake.polling.wait(60):
+                sys.exit("The bot didn't start polling")
+            latencies, errors = [], []
+            threads = [threading.Thread(target=user.run, args=(random.choice(list(SCENARIOS.values())),
+                                                               latencies, errors))
+                       for user in users.values()]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            bot.terminate()
+            bot.wait()
+            server.shutdown()
+
+    calls = collections.Counter(fake.calls)
+    del calls['getUpdates']
+    updates = next(fake.update_ids) - 1
+    questions = calls['sendPoll'] or 1
+    print(f"{args.users} users, {len(latencies)} steps, {len(errors)} failed users, {elapsed:.1f} s")
+    if latencies:
+        print(f"step latency: p50 {percentile(latencies, 50) * 1e3:.0f} ms | p95 {percentile(latencies, 95) * 1e3:.0f} ms"
+              f" | p99 {percentile(latencies, 99) * 1e3:.0f} ms")
+    print(f"updates: {updates} ({updates / elapsed:.1f}/s)")
+    print(f"API calls: {sum(calls.values())} ({sum(calls.values()) / questions:.2f} per question), "
+          f"{fake.floods} answered 429 | " + ", ".join(f"{method} {count}" for method, count in calls.most_common()))
+    for error in sorted(set(errors)):
+        print("failed: " + error)
+
+
+if __name__ == '__main__':
+    main()
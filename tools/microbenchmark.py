@@ -0,0 +1,169 @@
+"""
+Microbenchmarks of the bot's hot paths: the question generators, decoding menu answers, building menu keyboards
+and handling menu selections (make_action), with a stub instead of the Telegram API.
+The bank dependent ones run against the bundled DB and against a synthetic bank SCALE times larger.
+The results are compared with the baseline in tools/benchmark_baseline.json (measured on the machine that saved it),
+any benchmark slower than its baseline by more than the tolerance fails the run.
+Run from the repository root: python -m tools.microbenchmark [--save] [--tolerance 1.5] [--scale 100]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+import bank
+from bank import QuestionBank, VOC_SHEET
+from menu import MenuType, QuestionType, AmountQuestion, Unit, MenuAnswer
+from tools.benchmark import legacy_get_rand_sample_info_eng_voc
+from tools.stub_sender import StubSender
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'benchmark_baseline.json')
+CHAT_ID = 1000
+MENU_ID = 1
+
+
+def bank_tables():
+    """:return: the rows of every sheet of the bundled DB (see: QuestionBank.load)."""
+    if bank.is_compiled_fresh():
+        return QuestionBank.read_compiled()
+    return QuestionBank.read_excel()
+
+
+def scaled_tables(tables, scale):
+    """
+    :param tables: the rows of every sheet of the bundled DB.
+    :param scale: the number of copies of every question and word.
+    :return: the rows of every sheet of a DB scale times larger, the copied words are distinct words.
+    """
+    eng_rows, voc_rows, math_rows = tables
+    return ([(question + " ({})".format(copy), *rest) for copy in range(scale) for question, *rest in eng_rows],
+            [(english + " {}".format(copy) if copy else english, hebrew, unit)
+             for copy in range(scale) for english, hebrew, unit in voc_rows],
+            [row for copy in range(scale) for row in math_rows])
+
+
+def measure(function):
+    """
+    :param function: callable doing one call of the benchmark.
+    :return: the best time of a call of 3 runs, in microseconds.
+    """
+    timer = timeit.Timer(function)
+    number, seconds = timer.autorange()
+    return min([seconds] + timer.repeat(repeat=2, number=number)) / number * 1e6
+
+
+def menu_benchmarks(bot_main):
+    """:return: name -> callable, of the benchmarks which don't depend on the bank."""
+    import keyboards
+
+    answers = [menu_answer.encode() for menu_answer in
+               (MenuAnswer(MenuType.MAIN, MenuType.ENGLISH), MenuAnswer(MenuType.UNIT, Unit.THREE),
+                MenuAnswer(MenuType.REPEAT, QuestionType.REPEAT))]
+    navigate = MenuAnswer.decode(MenuAnswer(MenuType.MAIN, MenuType.ENGLISH).encode())
+    return {
+        "menu answer decode": lambda: [MenuAnswer.decode(data) for data in answers],
+        "menu answer encode": lambda: MenuAnswer(MenuType.AMOUNT, AmountQuestion.FIVE).encode(),
+        "unit keyboard build": lambda: keyboards.keyboard(keyboards.unit_rows()),
+        "make_action navigation": lambda: bot_main.make_action(navigate, CHAT_ID, MENU_ID),  # edits the tapped menu
+    }
+
+
+def bank_benchmarks(bot_main, words_table):
+    """
+    :param words_table: the bank's vocabulary as a pandas DataFrame, for the generator before the bank was indexed.
+    :return: name -> callable, of the benchmarks drawing from the current bank.
+    """
+    from session import Session
+
+    user_session = Session()
+    questions = MenuAnswer.decode(MenuAnswer(MenuType.AMOUNT, AmountQuestion.TEN).encode())
+
+    def ask_questions():
+        current = bot_main.users_sessions.get(CHAT_ID)
+        current.subject, current.question_type = MenuType.ENGLISH, QuestionType.ENG_COM
+        bot_main.make_action(questions, CHAT_ID)
+
+    return {
+        "eng_built eng_com k=10": lambda: bot_main.get_rand_sample_info_eng_built(10, "eng_com", user_session),
+        "eng_voc unit=0 k=10": lambda: bot_main.get_rand_sample_info_eng_voc(0, 10, 0, user_session),
+        "eng_voc unit=3 k=10": lambda: bot_main.get_rand_sample_info_eng_voc(3, 10, 0, user_session),
+        "eng_voc legacy groupby unit=3 k=10": lambda: legacy_get_rand_sample_info_eng_voc(words_table, 3, 10,
+                                                                                          retries=0),
+        "math_built math_alg k=10": lambda: bot_main.get_rand_sample_info_math_built(10, "math_alg", user_session),
+        "make_action questions k=10": ask_questions,
+    }
+
+
+def run(scale):
+    """
+    :param scale: the synthetic bank's size, in copies of the bundled DB.
+    :return: group -> benchmark name -> microseconds per call, the groups are the menus and every bank.
+    """
+    import pandas as pd
+    from session import Session
+
+    os.environ.setdefault('SESSION_STORE', 'memory')
+    import main as bot_main
+
+    bot_main.sender = StubSender()
+    bot_main.users_sessions[CHAT_ID] = Session()
+    results = {"menus": {name: measure(function) for name, function in menu_benchmarks(bot_main).items()}}
+
+    tables = bank_tables()
+    for group, group_tables in (("bundled", tables), ("x{}".format(scale), scaled_tables(tables, scale))):
+        bot_main.swap_bank(QuestionBank(*group_tables))
+        words_table = pd.DataFrame(group_tables[1], columns=list(VOC_SHEET[1]))
+        results[group] = {name: measure(function)
+                          for name, function in bank_benchmarks(bot_main, words_table).items()}
+        bot_main.open_polls.polls.clear()  # the stub's polls are never answered
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Printing every result next to its baseline.
+    :return: the names of the benchmarks slower than their baseline by more than the tolerance.
+    """
+    regressions = []
+    for group, group_results in results.items():
+        print(group)
+        for name, micros in group_results.items():
+            base = baseline.get(group, {}).get(name)
+            line = f"  {name:<36} {micros:10.1f} us"
+            if base:
+                line += f" | baseline {base:10.1f} us | x{micros / base:.2f}"
+                if micros > base * tolerance:
+                    line += "  REGRESSION"
+                    regressions.append(group + ": " + name)
+            print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--save', action='store_true', help="save the results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=1.5, help="slowdown factor counted as a regression")
+    parser.add_argument('--scale', type=int, default=100, help="the synthetic bank's size, in copies of the DB")
+    args = parser.parse_args()
+
+    results = run(args.scale)
+    try:
+        with open(BASELINE_PATH, encoding='utf-8') as file:
+            baseline = json.load(file)
+    except OSError:
+        baseline = {}
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save:
+        with open(BASELINE_PATH, 'w', encoding='utf-8') as file:
+            json.dump({group: {name: round(micros, 2) for name, micros in group_results.items()}
+                       for group, group_results in results.items()}, file, indent=2, ensure_ascii=False)
+            file.write("\n")
+        print("saved the baseline to " + BASELINE_PATH)
+    elif regressions:
+        sys.exit("slower than the baseline: " + ", ".join(regressions))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Build step optimizing the math questions' images before they are uploaded to Telegram:
+images are scaled down to the size Telegram displays, flattened onto white when they have transparency,
+reduced to a palette when they have few enough colors to do so losslessly, and saved with PNG optimization.
+The optimized images are written under DATA/OPTIMIZED with a manifest of their dimensions and hashes,
+the bank sends them instead of the originals (see: bank.resolve_image).
+Run from the repository root: python -m tools.optimize_images
+"""
+import glob
+import json
+import os
+import shutil
+import sys
+
+from PIL import Image, ImageChops
+
+import bank
+
+MAX_SIDE = 1280  # Telegram shows photos at up to 1280 pixels on their long side
+SOURCE_GLOB = 'DATA/MATH/*/*.png'
+
+
+def optimize(source_path, optimized_path):
+    """
+    Writing the optimized version of an image, or a copy of it when optimizing doesn't make it smaller
+    (unless it was flattened, see: on_white).
+    :param source_path: path to the original image.
+    :param optimized_path: path to write the optimized image to.
+    :return: the optimized image's (width, height).
+    """
+    image = Image.open(source_path)
+    image.load()
+    original_size = image.size
+    if max(image.size) > MAX_SIDE:
+        image.thumbnail((MAX_SIDE, MAX_SIDE), Image.LANCZOS)
+
+    transparent = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    if transparent:
+        image = on_white(image)
+    rgb = image.convert('RGB')
+    colors = rgb.getcolors(256)
+    if colors is not None:
+        palette = rgb.quantize(colors=len(colors), dither=Image.Dither.NONE)
+        if ImageChops.difference(palette.convert('RGB'), rgb).getbbox() is None:  # kept every pixel's color
+            image = palette
+
+    os.makedirs(os.path.dirname(optimized_path), exist_ok=True)
+    image.save(optimized_path, optimize=True)
+    unchanged = image.size == original_size and not transparent  # the original is as good, when it's smaller
+    if unchanged and os.path.getsize(optimized_path) >= os.path.getsize(source_path):
+        shutil.copyfile(source_path, optimized_path)
+    return image.size
+
+
+def on_white(image):
+    """
+    :param image: an image with transparency.
+    :return: the image drawn over a white background, as the questions are read (Telegram's photos have no alpha).
+    """
+    image = image.convert('RGBA')
+    return Image.alpha_composite(Image.new('RGBA', image.size, (255, 255, 255, 255)), image).convert('RGB')
+
+
+def main(source_glob=SOURCE_GLOB):
+    manifest = {}
+    for source_path in sorted(glob.glob(source_glob)):
+        source_path = source_path.replace(os.sep, '/')
+        optimized_path = bank.OPTIMIZED_DIR + '/' + os.path.relpath(source_path, 'DATA').replace(os.sep, '/')
+        width, height = optimize(source_path, optimized_path)
+        stat = os.stat(source_path)
+        manifest[source_path] = {
+            'path': optimized_path,
+            'width': width,
+            'height': height,
+            'bytes': os.path.getsize(optimized_path),
+            'sha256': bank.file_hash(optimized_path),
+            'source_bytes': stat.st_size,
+            'source_mtime': stat.st_mtime,
+            'source_sha256': bank.file_hash(source_path),
+        }
+    with open(bank.IMAGES_MANIFEST_PATH, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=1)
+
+    source_bytes = sum(entry['source_bytes'] for entry in manifest.values())
+    optimized_bytes = sum(entry['bytes'] for entry in manifest.values())
+    print(f"{len(manifest)} images: {source_bytes / 1e6:.2f} MB -> {optimized_bytes / 1e6:.2f} MB"
+          f" ({100 * (1 - optimized_bytes / max(source_bytes, 1)):.0f}% saved)")
+
+    missing = check_question_images()
+    for question_dir in missing:
+        print("Missing image: " + question_dir)
+    return not missing
+
+
+def check_question_images():
+    """
+    :return: the question_dir of every math question whose image doesn't exist.
+    """
+    question_bank = bank.QuestionBank.load()
+    return [question_dir for questions in question_bank.math_built.values()
+            for question_dir, correct_option_id in questions if not os.path.isfile(question_dir)]
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,47 @@
+"""
+Stub of the Telegram API the benchmarks, the webhook harness and the tests run the bot's handlers with.
+"""
+import itertools
+from collections import Counter
+from types import SimpleNamespace
+
+
+class StubSender:
+    """
+    Standing in for the bot's OutboundQueue (main.sender): counts the calls and returns messages shaped like
+    Telegram's, without any network. The jobs run right away, on the caller's thread.
+    """
+
+    def __init__(self):
+        self.calls = Counter()
+        self.message_ids = itertools.count(1)
+
+    def run(self, chat_id, job):
+        """Running the job's calls one after the other (see: outbound.OutboundQueue.run)."""
+        result, error = None, None
+        while True:
+            try:
+                call = job.send(result) if error is None else job.throw(error)
+            except StopIteration:
+                return
+            result, error = None, None
+            try:
+                result = getattr(self, call.method_name)(*call.args, **call.kwargs)
+            except Exception as e:
+                error = e
+
+    def call(self, chat_id, method_name, /, *args, **kwargs):
+        return getattr(self, method_name)(*args, **kwargs)
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls[name] += 1
+            if name == 'send_media_group':
+                return [self.message() for media in args[1]]
+            return self.message()
+        return call
+
+    def message(self):
+        message_id = next(self.message_ids)
+        return SimpleNamespace(message_id=message_id, poll=SimpleNamespace(id=str(message_id)),
+                               photo=[SimpleNamespace(file_id='stub-{}'.format(message_id))])
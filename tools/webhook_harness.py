@@ -0,0 +1,100 @@
+"""
+Local harness for the webhook mode: serves the webhook app on localhost, POSTs recorded updates
+to it (as many chats as asked, each chat replaying the recording) and measures the latency from
+the POST until the bot's handlers (main.process_update) finished the update on its dispatcher worker,
+with a stub instead of the Telegram API (tools.stub_sender.StubSender).
+Run from the repository root: python -m tools.webhook_harness [chats]
+"""
+import copy
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+
+import requests
+from werkzeug.serving import make_server
+
+import dispatch
+import webhook
+
+RECORDED_UPDATES = os.path.join(os.path.dirname(__file__), 'recorded_updates.json')
+SECRET = 'harness-secret'
+
+
+def replay(updates, chats):
+    """
+    :param updates: the recorded updates.
+    :param chats: the number of chats to replay the recording as.
+    :return: the updates of all the chats, with unique update ids and the chat ids changed.
+    """
+    replayed = []
+    for chat_index in range(chats):
+        for update in updates:
+            update = copy.deepcopy(update)
+            update['update_id'] = len(replayed) + 1
+            for kind in ('message', 'callback_query', 'poll_answer'):
+                if kind in update:
+                    body = update[kind]
+                    for user in (body.get('from'), body.get('user'),
+                                 body.get('chat'), body.get('message', {}).get('chat')):
+                        if user is not None:
+                            user['id'] += chat_index
+            replayed.append(update)
+    return replayed
+
+
+def main(chats=50):
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    handled = {}  # update id -> time its handler ran
+
+    os.environ.setdefault('SESSION_STORE', 'memory')
+    import main as bot_main
+    from tools.stub_sender import StubSender
+
+    bot_main.sender = StubSender()
+
+    def process_and_record(update):
+        tap = update.callback_query
+        if tap is not None:  # the recording's taps are on its own menus, not the ones the stub sent
+            user_session = bot_main.users_sessions.get(tap.message.chat.id)
+            if user_session is not None and user_session.menu_message_id:
+                tap.message.message_id = abs(user_session.menu_message_id)
+        bot_main.process_update(update)
+        handled[update.update_id] = time.perf_counter()
+
+    bot_main.dispatcher = dispatch.ChatDispatcher()
+    dispatch.dispatch_updates(bot_main.bot, bot_main.dispatcher, process_and_record, receive=bot_main.acknowledge)
+    app = webhook.create_app(bot_main.bot, SECRET)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}{}'.format(server.server_port, webhook.WEBHOOK_PATH)
+
+    with open(RECORDED_UPDATES, encoding='utf-8') as file:
+        updates = replay(json.load(file), chats)
+
+    session = requests.Session()
+    sent = {}
+    start = time.perf_counter()
+    for update in updates:
+        sent[update['update_id']] = time.perf_counter()
+        session.post(url, json=update, headers={webhook.SECRET_HEADER: SECRET}).raise_for_status()
+    while len(handled) < len(updates) and time.perf_counter() - start < 30:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+
+    rejected = session.post(url, json=updates[0], headers={webhook.SECRET_HEADER: 'wrong'}).status_code
+    latencies = sorted((handled[update_id] - sent[update_id]) * 1e3 for update_id in sent if update_id in handled)
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"{len(latencies)}/{len(updates)} updates handled in {elapsed:.2f} s ({len(updates) / elapsed:.0f} / s)")
+    print(f"latency ms: p50 {quantiles[49]:.2f} | p95 {quantiles[94]:.2f} | p99 {quantiles[98]:.2f}"
+          f" | max {latencies[-1]:.2f}")
+    print("API calls: " + ", ".join(f"{method} {count}" for method, count in bot_main.sender.calls.most_common()))
+    print(f"wrong secret token -> HTTP {rejected}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,80 @@
+import hmac
+import logging
+import queue
+import threading
+
+from flask import Flask, abort, request
+from telebot import types
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PATH = '/telegram'
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def create_app(bot, secret_token, path=WEBHOOK_PATH, queue_size=10000, handle=None):
+    """
+    Flask app receiving the bot's updates from Telegram: each update is checked for the webhook's
+    secret token, queued and acknowledged right away, a background thread hands the queued updates
+    to the bot's handlers.
+    :param bot: the TeleBot.
+    :param secret_token: the secret token the webhook was set with.
+    :param path: the URL path Telegram posts the updates to.
+    :param queue_size: max number of updates waiting to be handled.
+    :param handle: called with every queued update (JSON dict), None => the bot's handlers.
+    :return: the Flask app, its update queue is app.config['UPDATES'].
+    """
+    if handle is None:
+        handle = lambda update: bot.process_new_updates([types.Update.de_json(update)])
+    app = Flask(__name__)
+    updates = queue.Queue(maxsize=queue_size)
+    app.config['UPDATES'] = updates
+
+    @app.route(path, methods=['POST'])
+    def receive_update():
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), secret_token):
+            abort(403)
+        update = request.get_json(silent=True)
+        if update is None:
+            abort(400)
+        try:
+            updates.put_nowait(update)
+        except queue.Full:
+            abort(503)  # Telegram sends the update again later
+        return ''
+
+    threading.Thread(target=handle_updates, args=(handle, updates), name='webhook-updates', daemon=True).start()
+    return app
+
+
+def handle_updates(handle, updates):
+    """
+    Handing the queued updates to be handled, one after the other.
+    :param handle: called with every update.
+    :param updates: queue of updates as received (JSON dicts).
+    """
+    while True:
+        update = updates.get()
+        try:
+            handle(update)
+        except Exception:
+            logger.exception("Failed handling an update")
+        finally:
+            updates.task_done()
+
+
+def run(bot, url, secret_token, host='0.0.0.0', port=8443, path=WEBHOOK_PATH, handle=None):
+    """
+    Setting the bot's webhook and serving it.
+    :param bot: the TeleBot.
+    :param url: the public base URL of the server (e.g. https://<app>.herokuapp.com).
+    :param secret_token: the token Telegram sends with every update, 1-256 characters of A-Z, a-z, 0-9, _ and -.
+    :param host: the address to listen on.
+    :param port: the port to listen on.
+    :param path: the URL path Telegram posts the updates to.
+    :param handle: called with every update (JSON dict), None => the bot's handlers.
+    """
+    app = create_app(bot, secret_token, path, handle=handle)
+    bot.remove_webhook()
+    bot.set_webhook(url=url.rstrip('/') + path, secret_token=secret_token)
+    app.run(host=host, port=port, threaded=True)
@@ -0,0 +1,135 @@
+import gc
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+from telebot import apihelper
+
+import dispatch
+import metrics
+from outbound import backoff
+
+logger = logging.getLogger(__name__)
+
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', 1))
+WORKER_QUEUE_SIZE = int(os.environ.get('WORKER_QUEUE_SIZE', 1000))
+ROUTE_TIMEOUT = float(os.environ.get('WORKER_ROUTE_TIMEOUT', 10))  # seconds an update waits for room in its worker
+SUPERVISE_INTERVAL = 1
+
+worker_restarts = metrics.counter('worker_restarts_total', "Bot worker processes started again after they exited")
+dropped_updates = metrics.counter('worker_dropped_updates_total', "Updates dropped because their worker was stuck")
+
+
+class WorkerPool:
+    """
+    N worker processes handling the updates, with this process as the only one receiving them (polling or webhook):
+    each update is routed by its chat id, so all the updates of a chat are handled by the same worker, in order.
+    The workers are forked after the bot loaded the questions bank, so they share its memory instead of each
+    loading a copy of it (copy on write, the loaded objects are frozen out of the garbage collector's reach).
+    A worker which died is forked again with a new queue (the updates waiting in its queue are lost), and an update
+    whose worker's queue stays full is dropped, so a stuck worker doesn't hold up the other workers' chats.
+    :var queues: the updates queue of every worker.
+    :var processes: the worker processes.
+    """
+
+    def __init__(self, worker_main, workers=BOT_WORKERS, queue_size=WORKER_QUEUE_SIZE, receive=None, broadcast=None):
+        """
+        :param worker_main: run by each worker process with (worker index, number of workers, its updates queue),
+                            handling the update dicts it gets from the queue.
+        :param workers: number of worker processes.
+        :param queue_size: max number of updates waiting for each worker.
+        :param receive: called in this process with every update dict before it's routed
+                        (e.g. acknowledging the callbacks), None => nothing.
+        :param broadcast: called with every update dict, whether the update is routed to all the workers
+                          (e.g. the admin's commands), None => none is.
+        """
+        self.worker_main = worker_main
+        self.queue_size = queue_size
+        self.receive = receive
+        self.broadcast = broadcast
+        self.context = multiprocessing.get_context('fork')
+        self.queues = [None] * workers
+        self.processes = [None] * workers
+        for index in range(workers):
+            self.start_worker(index)
+        threading.Thread(target=self.supervise, name='worker-supervisor', daemon=True).start()
+
+    def start_worker(self, index):
+        """Forking the worker with a new updates queue."""
+        self.queues[index] = self.context.Queue(maxsize=self.queue_size)
+        gc.freeze()  # collections in the workers don't write to the shared objects' pages
+        self.processes[index] = self.context.Process(target=self.worker_main,
+                                                     args=(index, len(self.processes), self.queues[index]),
+                                                     name='bot-worker-{}'.format(index), daemon=True)
+        self.processes[index].start()
+        gc.unfreeze()
+
+    def supervise(self):
+        """Supervisor thread loop: starting again the workers which exited."""
+        while True:
+            time.sleep(SUPERVISE_INTERVAL)
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.error("Bot worker %s exited (code %s), starting it again", index, process.exitcode)
+                    worker_restarts.inc()
+                    self.start_worker(index)
+
+    def route(self, update):
+        """
+        Queueing an update on the worker of its chat, or on every worker if it's broadcast.
+        :param update: the update as received from Telegram (JSON dict).
+        """
+        if self.receive is not None:
+            self.receive(update)
+        if self.broadcast is not None and self.broadcast(update):
+            indexes = range(len(self.queues))
+        else:
+            indexes = [(dispatch.update_json_chat_id(update) or 0) % len(self.queues)]
+        for index in indexes:
+            try:
+                self.queues[index].put(update, timeout=ROUTE_TIMEOUT)
+            except queue.Full:
+                logger.error("Bot worker %s is stuck, dropped update %s", index, update.get('update_id'))
+                dropped_updates.inc()
+
+
+def poll_updates(token, route, timeout=10, long_polling_timeout=5):
+    """
+    Long polling Telegram for updates, handing each update to route (e.g. WorkerPool.route) as a JSON dict.
+    :param token: the bot's API token.
+    :param route: called with every update.
+    """
+    offset = None
+    failures = 0
+    while True:
+        try:
+            updates = apihelper.get_updates(token, offset, None, timeout, None, long_polling_timeout)
+        except Exception:
+            logger.exception("Failed getting updates")
+            time.sleep(backoff(failures))
+            failures += 1
+            continue
+        failures = 0
+        for update in updates:
+            offset = update['update_id'] + 1
+            route(update)
+
+
+def read_updates(updates, handle):
+    """
+    Worker loop: handing the updates routed to the worker to handle, one after the other.
+    :param updates: the worker's updates queue.
+    :param handle: called with every update dict.
+    """
+    while True:
+        try:
+            update = updates.get()
+        except (EOFError, OSError, queue.Empty):  # the receiving process is gone
+            return
+        try:
+            handle(update)
+        except Exception:
+            logger.exception("Failed handling an update")